@@ -0,0 +1,7 @@
+"""Helpers shared by the chapters of *Causal Inference with Python*.
+
+The notebooks only need pandas, statsmodels and linearmodels to run. The
+modules in this package are optional: they make the book build faster and
+scale the chapter methods to datasets far larger than the ones used in the
+text.
+"""
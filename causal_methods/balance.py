@@ -0,0 +1,134 @@
+"""Balance tables: many outcomes regressed on one design.
+
+Chapters 8 and 9 check covariate balance with one regression per
+covariate::
+
+    for var in control:
+        reg = smf.ols(var + "~ 1 + assettreat + C(block13)", df)
+        result.append(reg.fit().pvalues[104])
+
+which rebuilds and refactorizes the same design, 104 strata dummies
+included, for every covariate. ``balance_table`` builds the design once,
+absorbs the strata instead of expanding them into dummies, factorizes it
+once per pattern of missing values among the covariates and solves for all
+covariates sharing that pattern as one matrix right-hand side. Standard
+errors for the treatment coefficient are computed for all covariates in the
+same pass::
+
+    balance_table(df, control, 'assettreat', strata='block13')
+    balance_table(df, control, 'guest_black', cov_type='cluster',
+                  groups='name_by_city')
+"""
+
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+from causal_methods import covariance
+from causal_methods.covariance import check_cov_type
+from causal_methods.fixed_effects import Absorber
+from causal_methods.regression import solve
+
+
+def _missing_patterns(values):
+    """Group the columns of ``values`` by their pattern of missing rows.
+
+    Returns a list of (row mask, column positions).
+    """
+    observed = ~np.isnan(values)
+    packed = np.packbits(observed, axis=0)
+    _, first, which = np.unique(packed.T, axis=0, return_index=True,
+                                return_inverse=True)
+    which = which.ravel()
+    return [(observed[:, first[g]], np.flatnonzero(which == g))
+            for g in range(len(first))]
+
+
+def _treatment_variance(X, resid, bread, cov_type, groups=None, k=None,
+                        column=1):
+    """Variance of the coefficient in ``column`` for every column of
+    ``resid``, without looping over outcomes.
+
+    ``k`` counts the parameters for the degrees of freedom, including
+    absorbed fixed effects.
+    """
+    n = X.shape[0]
+    k = X.shape[1] if k is None else k
+    if cov_type == "nonrobust":
+        return bread[column, column] * (resid**2).sum(axis=0) / (n - k)
+    # Influence of each row on the treatment coefficient, one column per
+    # outcome
+    g = X @ bread[column]
+    return covariance.robust_cov(g[:, None] * resid, None, cov_type, groups,
+                                 k, diagonal=True)
+
+
+def balance_table(data, covariates, treatment, strata=None, controls=(),
+                  cov_type="nonrobust", groups=None):
+    """Regress each covariate on ``1 + treatment [+ controls] [+ C(strata)]``.
+
+    Returns a DataFrame with one row per covariate: the covariate mean in
+    each treatment group (as in ``df.groupby(treatment)[covariates].mean()``),
+    the treatment coefficient, its standard error, p-value and the number
+    of observations used. Rows with a missing treatment, control, stratum
+    or cluster are dropped for every covariate; missing covariate values
+    only drop rows for that covariate, as ``missing='drop'`` does.
+
+    ``cov_type`` is one of ``covariance.COV_TYPES``; ``"cluster"`` needs
+    ``groups``, the name of the cluster column (or a list of two names for
+    two-way clustering). P-values use the t distribution for the classical
+    covariance and the normal otherwise, like statsmodels. The strata are
+    absorbed (see ``fixed_effects``), and the degrees of freedom count them
+    as the dummy regression would.
+    """
+    check_cov_type(cov_type, groups)
+    covariates = list(covariates)
+    controls = list(controls)
+
+    design = [treatment] + controls
+    clusters = [groups] if isinstance(groups, str) else list(groups or [])
+    needed = design + clusters + ([strata] if strata is not None else [])
+    frame = data.dropna(subset=needed)
+    X = frame[design].to_numpy(float)
+    if strata is None:
+        X = np.column_stack([np.ones(len(frame)), X])
+        strata_codes = None
+    else:
+        strata_codes = pd.factorize(frame[strata])[0]
+    column = 1 if strata is None else 0
+    cluster_labels = (frame[clusters].to_numpy()
+                      if cov_type == "cluster" else None)
+
+    values = frame[covariates].to_numpy(float)
+    coef = np.full(len(covariates), np.nan)
+    var = np.full(len(covariates), np.nan)
+    nobs = np.zeros(len(covariates), dtype=int)
+    df_resid = np.zeros(len(covariates), dtype=int)
+    for rows, cols in _missing_patterns(values):
+        Xr, Yr = X[rows], values[rows][:, cols]
+        k = Xr.shape[1]
+        if strata_codes is not None:
+            absorber = Absorber(strata_codes[rows])
+            Xr, Yr = absorber.demean(Xr), absorber.demean(Yr)
+            k += absorber.df_absorbed
+        beta, bread, resid = solve(Xr, Yr)
+        coef[cols] = beta[column]
+        var[cols] = _treatment_variance(
+            Xr, resid, bread, cov_type,
+            None if cluster_labels is None else cluster_labels[rows],
+            k=k, column=column)
+        nobs[cols] = rows.sum()
+        df_resid[cols] = rows.sum() - k
+
+    se = np.sqrt(var)
+    t = np.abs(coef / se)
+    if cov_type == "nonrobust":
+        pvalue = 2 * stats.t.sf(t, df_resid)
+    else:
+        pvalue = 2 * stats.norm.sf(t)
+    table = data.groupby(treatment)[covariates].mean().T
+    table["diff"] = coef
+    table["std err"] = se
+    table["p-value"] = pvalue
+    table["nobs"] = nobs
+    return table
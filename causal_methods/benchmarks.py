@@ -0,0 +1,665 @@
+"""Benchmarks of the chapters' estimators on synthetic data.
+
+Each chapter's method is timed on data generated with the columns of its
+dataset (``lakisha_aer.dta``, ``finaldata.dta``, ``Airbnb.csv``, ...), at
+sizes from a thousand to ten million rows, once with this package
+(``"package"``) and once with the code of the chapter (``"reference"``:
+statsmodels, linearmodels, rdd). Every run records the best wall-clock
+time over a few repeats, the peak memory allocated by the estimator
+(traced with ``tracemalloc``) and one estimate, so that swapping a backend
+cannot silently change the numbers::
+
+    python -m causal_methods.benchmarks --sizes 1000 100000 \\
+        --save benchmarks.json
+    python -m causal_methods.benchmarks --sizes 1000 100000 \\
+        --baseline benchmarks.json
+
+The second call compares the new timings with the stored baseline and
+exits with status 1 if a benchmark became slower or used more memory than
+``--tolerance`` allows, or if an estimate changed. ``--against
+reference`` compares the package with the chapters' code instead.
+A (benchmark, backend) pair that takes longer than ``--budget`` seconds
+is not run at the larger sizes. The reference backends build dense dummy
+designs, which need several GB of memory from about a million rows on;
+run them at the smaller sizes only (``--backends package``).
+"""
+
+import argparse
+import itertools
+import json
+import platform
+import sys
+import time
+import warnings
+
+import numpy as np
+import pandas as pd
+
+from causal_methods import profiling
+
+SIZES = (10**3, 10**4, 10**5, 10**6, 10**7)
+BACKENDS = ("package", "reference")
+
+
+def _binary(rng, n, p=0.5):
+    return (rng.random(n) < p).astype(float)
+
+
+def _choice(rng, values, n, p=None):
+    return np.asarray(values)[rng.choice(len(values), n, p=p)]
+
+
+# Generators: a DataFrame of ``n`` rows with the chapter's columns
+
+def chess(n, rng):
+    """Chapter 1, ``Chess.xls``: centipede games of titled players."""
+    titles = np.array(["GM", "IM", "FM", "Other"])
+    title = rng.choice(4, n, p=[0.1, 0.2, 0.3, 0.4])
+    # Stronger players stop earlier (node 1 is the rational choice)
+    stop = rng.random(n) < np.array([0.9, 0.6, 0.45, 0.3])[title]
+    node = np.where(stop, 1, rng.integers(2, 7, n))
+    return pd.DataFrame({
+        "Title1": titles[title],
+        "ELORating1": np.array([2550., 2400, 2300, 2100])[title]
+        + rng.normal(0, 80, n),
+        "EndNode": node})
+
+
+def resumes(n, rng):
+    """Chapter 2, ``lakisha_aer.dta``: callbacks of fictitious resumes."""
+    frame = pd.DataFrame({
+        "race": _choice(rng, ["b", "w"], n),
+        "education": rng.integers(0, 5, n).astype(float),
+        "yearsexp": rng.integers(1, 27, n).astype(float),
+        "h": _binary(rng, n)})
+    for column in ("volunteer", "military", "email", "workinschool",
+                   "honors", "computerskills", "specialskills"):
+        frame[column] = _binary(rng, n, 0.3)
+    p = 0.08 - 0.03 * (frame["race"] == "b") + 0.01 * frame["h"]
+    frame["call"] = _binary(rng, n, p.to_numpy())
+    return frame
+
+
+def elections(n, rng):
+    """Chapter 3, Meyersson (2014): Islamic win margin in 1994 and the
+    share of women completing high school."""
+    margin = np.clip(rng.normal(-0.1, 0.25, n), -1, 1)
+    share = 0.15 + 0.1 * margin + 0.03 * (margin >= 0) \
+        + rng.normal(0, 0.05, n)
+    return pd.DataFrame({"iwm94": margin, "hischshr1520f": share})
+
+
+def municipalities(n, rng):
+    """Chapter 4, ``finaldata.dta``: municipalities along the language
+    border of Vaud and Fribourg."""
+    distance = rng.uniform(-50, 50, n)
+    vaud = (distance >= 0).astype(float)
+    prot = np.clip(0.2 + 0.6 * vaud + 0.003 * distance
+                   + rng.normal(0, 0.15, n), 0, 1)
+    return pd.DataFrame({
+        "borderdis": distance, "vaud": vaud, "t_dist": distance * vaud,
+        "prot1980s": prot,
+        "pfl": 45 - 8 * prot + 0.02 * distance + rng.normal(0, 3, n),
+        "reineink_pc_mean": 50000 + 5000 * prot + rng.normal(0, 4000, n),
+        "Ecoplan_gini": 0.3 + 0.02 * prot + rng.normal(0, 0.03, n)})
+
+
+def firms(n, rng):
+    """Chapter 5, ``MS_data_all_years_regs.dta``: firms in 1929 and 1931
+    in the St. Louis and Atlanta Fed districts."""
+    n_firms = max(n // 2, 2)
+    louis = _binary(rng, n_firms)
+    level = rng.normal(11, 1.5, n_firms)
+    frame = pd.DataFrame({
+        "firmid": np.repeat(np.arange(n_firms), 2),
+        "censusyear": np.tile([1929, 1931], n_firms),
+        "st_louis_fed": np.repeat(louis, 2),
+        "industrycode": np.repeat(rng.integers(100, 140, n_firms), 2)
+        .astype(float)})
+    frame["year_1931"] = (frame["censusyear"] == 1931).astype(float)
+    frame["log_total_output_value"] = np.repeat(level, 2) \
+        - 0.5 * frame["year_1931"] \
+        - 0.2 * frame["st_louis_fed"] * frame["year_1931"] \
+        + rng.normal(0, 0.5, len(frame))
+    return frame.iloc[:n].reset_index(drop=True)
+
+
+def canadian_resumes(n, rng):
+    """Chapter 6, ``oreopoulos.dta``: callbacks in the Canadian resume
+    experiment."""
+    ethnicities = ["Canada", "Indian", "Chinese", "Chn-Cdn", "Greek",
+                   "British", "Pakistani"]
+    frame = pd.DataFrame({
+        "name_ethnicity": _choice(rng, ethnicities, n),
+        "female": _binary(rng, n),
+        "type": rng.integers(0, 5, n).astype(float),
+        "fall_data": rng.integers(0, 3, n).astype(float),
+        "occupation_type": rng.integers(1, 21, n).astype(float),
+        "city": _choice(rng, ["Toronto", "Montreal", "Vancouver"], n)})
+    frame["name"] = frame["name_ethnicity"] + " " \
+        + rng.integers(0, 8, n).astype(str)
+    for column in ("ba_quality", "extracurricular_skills",
+                   "language_skills", "ma", "exp_highquality"):
+        frame[column] = _binary(rng, n, 0.4)
+    p = 0.16 - 0.05 * (frame["name_ethnicity"] != "Canada") \
+        + 0.01 * frame["female"]
+    frame["callback"] = _binary(rng, n, p.to_numpy())
+    return frame
+
+
+def airbnb(n, rng):
+    """Chapter 8, ``Airbnb.csv``: host responses to guests with black and
+    white sounding names."""
+    hosts = rng.integers(0, max(n // 3, 1), n)
+    frame = pd.DataFrame({
+        "guest_black": _binary(rng, n),
+        "name_by_city": pd.Series(hosts).map("host%d".__mod__),
+        "host_race_black": _binary(rng, n, 0.07),
+        "host_gender_M": _binary(rng, n, 0.3),
+        "shared_property": _binary(rng, n, 0.3),
+        "ten_reviews": _binary(rng, n, 0.7),
+        "log_price": rng.normal(5, 0.6, n)})
+    frame["host_gender_F"] = _binary(rng, n, 0.5)
+    frame["host_race_white"] = 1 - frame["host_race_black"]
+    p = 0.49 - 0.08 * frame["guest_black"]
+    yes = _binary(rng, n, p.to_numpy())
+    yes[rng.random(n) < 0.02] = np.nan
+    frame["yes"] = yes
+    frame.loc[rng.random(n) < 0.01, "name_by_city"] = None
+    return frame
+
+
+# Controls of chapter 9's regressions, in the order of the chapter
+STOCK_CONTROLS = (
+    "right_2013", "left_2013", "male", "age", "age2", "postsecondary",
+    "BA_student", "college_grad", "married", "tradestock6all", "r_trad",
+    "r_relig", "r_ultra", "g_jerusalem", "g_north", "g_haifa", "g_telaviv",
+    "g_south", "g_wb", "C(newses)", "willingrisk1to10", "patient",
+    "plitscore")
+
+
+def stock_survey(n, rng):
+    """Chapter 9, ``replicationdata.dta``: Israeli voters randomly given
+    stock within 104 strata."""
+    frame = pd.DataFrame({
+        "block13": rng.integers(1, 105, n).astype(float),
+        "assettreat": _binary(rng, n),
+        "age": rng.integers(18, 70, n).astype(float),
+        "newses": rng.integers(1, 6, n).astype(float),
+        "willingrisk1to10": rng.integers(1, 11, n).astype(float),
+        "patient": rng.integers(1, 11, n).astype(float),
+        "plitscore": rng.integers(0, 6, n).astype(float),
+        "vote_wgt": rng.uniform(0.5, 2, n)})
+    frame["age2"] = frame["age"]**2
+    for column in ("male", "postsecondary", "BA_student", "college_grad",
+                   "married", "tradestock6all"):
+        frame[column] = _binary(rng, n)
+    religion = rng.choice(4, n, p=[0.5, 0.25, 0.15, 0.1])
+    for j, column in enumerate(["r_sec", "r_trad", "r_relig", "r_ultra"]):
+        frame[column] = (religion == j).astype(float)
+    region = rng.integers(0, 7, n)
+    for j, column in enumerate(["g_jerusalem", "g_north", "g_haifa",
+                                "g_center", "g_telaviv", "g_south",
+                                "g_wb"]):
+        frame[column] = (region == j).astype(float)
+    vote = rng.choice(3, n, p=[0.4, 0.4, 0.2])
+    frame["right_2013"] = (vote == 0).astype(float)
+    frame["left_2013"] = (vote == 1).astype(float)
+    comply = _binary(rng, n, 0.8)
+    frame["asset_comp"] = frame["assettreat"] * comply
+    p = 0.2 + 0.4 * frame["left_2013"] + 0.04 * frame["asset_comp"]
+    left = _binary(rng, n, p.to_numpy())
+    left[rng.random(n) < 0.1] = np.nan
+    frame["left_s3"] = left
+    return frame
+
+
+# Chapter methods: each returns one estimate, compared across runs
+
+def proportions_package(chess):
+    from causal_methods.proportions import count_table, pairwise_tests
+    tests = pairwise_tests(count_table(chess, "Title1", "EndNode"),
+                           levels=[1], adjust=None)
+    return tests["z"].iloc[0]
+
+
+def proportions_reference(chess):
+    from statsmodels.stats.proportion import proportions_ztest
+    nodes, lengths = {}, {}
+    for title in sorted(chess["Title1"].unique()):
+        players = chess[chess["Title1"] == title]
+        nodes[title] = players.groupby("EndNode").size()
+        lengths[title] = len(players)
+    z = []
+    for a, b in itertools.combinations(sorted(nodes), 2):
+        count = np.array([nodes[a].get(1, 0), nodes[b].get(1, 0)])
+        nobs = np.array([lengths[a], lengths[b]])
+        z.append(proportions_ztest(count, nobs)[0])
+    return z[0]
+
+
+# Regressors of chapter 2's multiple regression
+OTHER_FACTORS = ("college", "yearsexp", "volunteer", "military", "email",
+                 "workinschool", "honors", "computerskills",
+                 "specialskills")
+
+
+def _resume_columns(df):
+    df = df.copy()
+    df["college"] = np.where(df["education"] == 4, 1, 0)
+    df["Intercept"] = 1
+    df["Treatment"] = np.where(df["race"] == "b", 1, 0)
+    df["h_Treatment"] = df["h"] * df["Treatment"]
+    return df
+
+
+def ols_package(df):
+    from causal_methods.regression import ols
+    df = _resume_columns(df)
+    multiple = ols(df["call"],
+                   df[["Intercept", "Treatment"] + list(OTHER_FACTORS)])
+    ols(df["call"], df[["Intercept", "Treatment", "h", "h_Treatment"]])
+    return multiple.params["Treatment"]
+
+
+def ols_reference(df):
+    import statsmodels.api as sm
+    df = _resume_columns(df)
+    multiple = sm.OLS(df["call"],
+                      df[["Intercept", "Treatment"] + list(OTHER_FACTORS)],
+                      missing="drop").fit()
+    sm.OLS(df["call"], df[["Intercept", "Treatment", "h", "h_Treatment"]],
+           missing="drop").fit()
+    return multiple.params["Treatment"]
+
+
+def rd_package(df):
+    from causal_methods.rd import RDData
+    rd = RDData(df["hischshr1520f"], df["iwm94"], cutoff=0)
+    return rd.fit(rd.optimal_bandwidth()).params["treated"]
+
+
+def rd_reference(df):
+    from rdd import rdd
+    h = rdd.optimal_bandwidth(df["hischshr1520f"], df["iwm94"], cut=0)
+    window = rdd.truncated_data(df, "iwm94", h, cut=0)
+    model = rdd.rdd(window, "iwm94", "hischshr1520f", cut=0,
+                    verbose=False)
+    return model.fit().params["TREATED"]
+
+
+# Outcomes of chapter 4, before and after renaming
+LEISURE_OUTCOMES = ("pfl", "reineink_pc_mean", "Ecoplan_gini")
+LEISURE_NAMES = ("Preference_for_Leisure", "Mean_Income_(CHF)",
+                 "Gini_1996")
+
+
+def fuzzy_rd_package(df):
+    # ``t_dist`` is the distance on the Vaud side: separate slopes.
+    # linearmodels' "robust" covariance is HC0
+    from causal_methods.fuzzy_rd import FuzzyRD
+    table = FuzzyRD(df[list(LEISURE_OUTCOMES)], df["prot1980s"],
+                    df["borderdis"], slopes="separate").sweep(
+        [5], cov_type="HC0")
+    return table["tau"].iloc[table.index.get_level_values("outcome")
+                             .get_loc("pfl")]
+
+
+def fuzzy_rd_reference(df):
+    from linearmodels.iv import IV2SLS
+    df = df.rename(columns=dict(zip(LEISURE_OUTCOMES, LEISURE_NAMES)))
+    df = df.rename(columns={"prot1980s": "Share_of_Protestants",
+                            "borderdis": "Border_Distance_in_Km"})
+    df5 = df[df["Border_Distance_in_Km"] >= -5]
+    df5 = df5[df5["Border_Distance_in_Km"] <= 5]
+    estimates = []
+    for outcome in LEISURE_NAMES:
+        iv = ("Q('%s') ~ 1 + Border_Distance_in_Km + t_dist"
+              " + [Share_of_Protestants ~ vaud]" % outcome)
+        result = IV2SLS.from_formula(iv, df5).fit(cov_type="robust")
+        estimates.append(result.params["Share_of_Protestants"])
+    return estimates[0]
+
+
+def _random_effects(y, X):
+    # Neither backend has its own random-effects estimator
+    from linearmodels import RandomEffects
+    return RandomEffects(y, X).fit(cov_type="clustered",
+                                   cluster_entity=True)
+
+
+def panel_package(df):
+    from causal_methods.panel import did, panel_ols
+    y = df["log_total_output_value"]
+    treated, post = df["st_louis_fed"], df["year_1931"]
+    entity, time = df["firmid"], df["censusyear"]
+    pooled = did(y, treated, post, entity, time)
+    did(y, treated, post, entity, time, entity_effects=True)
+    X = pd.DataFrame({"const": 1.0, "st_louis_fed": treated,
+                      "year_1931": post, "louis_1931": treated * post,
+                      "industrycode": df["industrycode"]})
+    panel_ols(y, X, entity, time)
+    _random_effects(y.set_axis(pd.MultiIndex.from_arrays([entity, time])),
+                    X[["const", "st_louis_fed"]].set_axis(
+                        pd.MultiIndex.from_arrays([entity, time])))
+    return pooled.params["st_louis_fed:year_1931"]
+
+
+def panel_reference(df):
+    from linearmodels import PanelOLS
+    df = df.set_index(["firmid", "censusyear"])
+    Y = df["log_total_output_value"]
+    df["const"] = 1
+    df["louis_1931"] = df["st_louis_fed"] * df["year_1931"]
+    dd = ["const", "st_louis_fed", "year_1931", "louis_1931"]
+    pooled = PanelOLS(Y, df[dd]).fit(cov_type="clustered",
+                                     cluster_entity=True)
+    # st_louis_fed is constant within firms
+    PanelOLS(Y, df[dd], entity_effects=True, drop_absorbed=True).fit(
+        cov_type="clustered", cluster_entity=True)
+    PanelOLS(Y, df[dd + ["industrycode"]]).fit(cov_type="clustered",
+                                               cluster_entity=True)
+    _random_effects(Y, df[["const", "st_louis_fed"]])
+    return pooled.params["louis_1931"]
+
+
+# Chapter 6: the four models of Tables 1-4, on four subsamples of the
+# 2009 wave
+CONTROLS_1 = "+ ba_quality + extracurricular_skills + language_skills"
+CONTROLS_2 = "+ ma + exp_highquality"
+CALLBACK_MODELS = {
+    "model1": "female + C(type)",
+    "model2": "female*C(type)",
+    "model3": "female*C(type)" + CONTROLS_1 + CONTROLS_2,
+    "model4": "female*C(type) " + CONTROLS_1 + CONTROLS_2
+              + "+ C(occupation_type) + C(city) + C(name)"}
+ETHNICITIES = ("Indian", "Chinese", "Chn-Cdn", "Greek")
+
+
+def grid_package(df):
+    from causal_methods.grid import SpecificationGrid
+    df2 = df[df.fall_data == 2]
+    grid = SpecificationGrid(
+        "callback", CALLBACK_MODELS,
+        subsamples={name: "name_ethnicity in ['Canada', %r]" % name
+                    for name in ETHNICITIES},
+        cov_types="HC1")
+    results = grid.run(df2)
+    return results.iloc[0].params["female"]
+
+
+def grid_reference(df):
+    import statsmodels.formula.api as smf
+    df2 = df[df.fall_data == 2]
+    Canada = df2.name_ethnicity == "Canada"
+    sample = [df2[Canada | (df2.name_ethnicity == name)]
+              for name in ETHNICITIES]
+    results = []
+    for rhs in CALLBACK_MODELS.values():
+        for data in sample:
+            results.append(smf.ols("callback ~ " + rhs, data)
+                           .fit(cov_type="HC1"))
+    return results[0].params["female"]
+
+
+# Chapter 8: the first two columns of the table
+AIRBNB_COLUMNS = (["guest_black"],
+                  ["guest_black", "host_race_black", "host_gender_M"])
+
+
+def cluster_package(df):
+    from causal_methods.regression import ols
+    df = df.assign(const=1.0)
+    results = [ols(df["yes"], df[["const"] + X], cov_type="cluster",
+                   groups=df["name_by_city"])
+               for X in AIRBNB_COLUMNS]
+    return results[0].bse["guest_black"]
+
+
+def cluster_reference(df):
+    import statsmodels.api as sm
+    df["const"] = 1
+    results = []
+    for X in AIRBNB_COLUMNS:
+        subset = df.dropna(subset=["yes", "name_by_city"] + X)
+        results.append(sm.OLS(subset["yes"], subset[["const"] + X]).fit(
+            cov_type="cluster", cov_kwds={"groups": subset["name_by_city"]}))
+    return results[0].bse["guest_black"]
+
+
+def control_function_package(df):
+    # The strata are absorbed (Frisch-Waugh-Lovell) instead of expanded
+    # into 104 dense dummies; the coefficients are the same
+    from causal_methods.fixed_effects import Absorber
+    from causal_methods.formula import design
+    from causal_methods.iv import IV
+    df = df.dropna(subset=["left_s3"])
+    d = design("1 + " + " + ".join(STOCK_CONTROLS), df)
+    df = df[d.rows]
+    columns = np.column_stack([
+        d.X[:, 1:].toarray(),
+        df[["asset_comp", "assettreat", "left_s3"]].to_numpy(float)])
+    demeaned = Absorber(df["block13"]).demean(columns)
+    names = d.names[1:] + ["asset_comp", "assettreat", "left_s3"]
+    demeaned = pd.DataFrame(demeaned, columns=names)
+    iv = IV(demeaned[names[:-3]], demeaned["asset_comp"],
+            demeaned["assettreat"])
+    iv.first_stage()
+    return iv.control_function(demeaned["left_s3"]).params["asset_comp"]
+
+
+def control_function_reference(df):
+    import statsmodels.formula.api as smf
+    df = df.dropna(subset=["left_s3"])
+    controls = "".join("+" + X for X in STOCK_CONTROLS)
+    FS = smf.ols("asset_comp ~ 1 + assettreat" + controls + "+C(block13)",
+                 df).fit()
+    df["resid"] = FS.resid
+    CF = smf.ols("left_s3 ~ 1 + asset_comp + resid" + controls
+                 + "+C(block13)", df).fit()
+    return CF.params["asset_comp"]
+
+
+# name: (generator, {backend: method})
+BENCHMARKS = {
+    "ch1_proportions": (chess, {"package": proportions_package,
+                                "reference": proportions_reference}),
+    "ch2_ols": (resumes, {"package": ols_package,
+                          "reference": ols_reference}),
+    "ch3_rd": (elections, {"package": rd_package,
+                           "reference": rd_reference}),
+    "ch4_fuzzy_rd": (municipalities, {"package": fuzzy_rd_package,
+                                      "reference": fuzzy_rd_reference}),
+    "ch5_panel": (firms, {"package": panel_package,
+                          "reference": panel_reference}),
+    "ch6_grid": (canadian_resumes, {"package": grid_package,
+                                    "reference": grid_reference}),
+    "ch8_cluster": (airbnb, {"package": cluster_package,
+                             "reference": cluster_reference}),
+    "ch9_control_function": (stock_survey,
+                             {"package": control_function_package,
+                              "reference": control_function_reference}),
+}
+
+
+def measure(method, data, repeat=3):
+    """Best wall-clock time of ``repeat`` calls of ``method(data)``, the
+    peak memory (bytes) allocated by one more, traced call, and the
+    estimate it returns. Every call gets its own copy of ``data``;
+    warnings of the estimators are silenced."""
+    seconds = np.inf
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        for _ in range(repeat):
+            frame = data.copy()
+            start = time.perf_counter()
+            estimate = method(frame)
+            seconds = min(seconds, time.perf_counter() - start)
+        frame = data.copy()
+        with profiling.Profiler(memory=True) as profiler:
+            with profiling.span(method.__name__):
+                method(frame)
+    return seconds, profiler.records[-1]["peak_bytes"], float(estimate)
+
+
+def run(benchmarks=None, backends=BACKENDS, sizes=SIZES[:3], repeat=3,
+        seed=0, budget=60.0):
+    """Run ``benchmarks`` (names of ``BENCHMARKS``, default all) with
+    every backend at every size.
+
+    The data of each size are generated once, from ``seed``, and shared
+    by the backends. A (benchmark, backend) pair slower than ``budget``
+    seconds is skipped at the larger sizes. Returns a DataFrame indexed by
+    (benchmark, backend, rows) with the seconds, the peak memory in MB and
+    the estimate.
+    """
+    names = list(BENCHMARKS) if benchmarks is None else list(benchmarks)
+    for name in names:
+        if name not in BENCHMARKS:
+            raise ValueError("benchmark must be one of %s, got %r"
+                             % (tuple(BENCHMARKS), name))
+    for backend in backends:
+        if backend not in BACKENDS:
+            raise ValueError("backend must be one of %s, got %r"
+                             % (BACKENDS, backend))
+    records = []
+    for name in names:
+        generator, methods = BENCHMARKS[name]
+        # Imports and first-call caches are not timed
+        sample = generator(1000, np.random.default_rng(seed))
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            for backend in backends:
+                methods[backend](sample.copy())
+        over_budget = set()
+        for rows in sorted(sizes):
+            data = generator(int(rows), np.random.default_rng(seed))
+            for backend in backends:
+                if backend in over_budget:
+                    continue
+                seconds, peak, estimate = measure(methods[backend], data,
+                                                  repeat)
+                records.append((name, backend, int(rows), seconds,
+                                peak / 2**20, estimate))
+                if seconds > budget:
+                    over_budget.add(backend)
+                    warnings.warn("%s (%s) took %.0f s at %d rows; larger "
+                                  "sizes are skipped"
+                                  % (name, backend, seconds, rows))
+            del data
+    table = pd.DataFrame(records, columns=[
+        "benchmark", "backend", "rows", "seconds", "peak_mb", "estimate"])
+    return table.set_index(["benchmark", "backend", "rows"])
+
+
+def environment():
+    """Versions and machine the timings were taken on."""
+    return {"python": platform.python_version(),
+            "numpy": np.__version__, "pandas": pd.__version__,
+            "machine": platform.machine(), "processor": platform.processor(),
+            "system": platform.system()}
+
+
+def save(results, path):
+    """Write ``run`` results and the ``environment`` as a JSON baseline."""
+    with open(path, "w") as f:
+        json.dump({"environment": environment(),
+                   "results": results.reset_index().to_dict("records")},
+                  f, indent=1)
+
+
+def load(path):
+    """Read a baseline written by ``save``; the environment is in
+    ``attrs['environment']``."""
+    with open(path) as f:
+        stored = json.load(f)
+    table = pd.DataFrame(stored["results"]).set_index(
+        ["benchmark", "backend", "rows"])
+    table.attrs["environment"] = stored["environment"]
+    return table
+
+
+def compare(results, baseline, tolerance=0.25, rtol=1e-6, backend=None,
+            min_seconds=0.01):
+    """Compare ``run`` results with a baseline.
+
+    Each result is matched with the baseline row of the same benchmark,
+    backend and size, or, with ``backend``, with that backend's row (to
+    compare one backend with another). ``status`` is ``"slower"`` if the
+    time grew by more than ``tolerance`` (and ``min_seconds``),
+    ``"memory"`` if the peak memory did, ``"estimate"`` if the estimate
+    differs by more than ``rtol`` (relative), ``"new"`` without a baseline
+    row and ``"ok"`` otherwise.
+    """
+    base = baseline.reset_index()
+    current = results.reset_index()
+    if backend is not None:
+        base = base[base["backend"] == backend].drop(columns="backend")
+        keys = ["benchmark", "rows"]
+    else:
+        keys = ["benchmark", "backend", "rows"]
+    base = base[keys + ["seconds", "peak_mb", "estimate"]]
+    table = current.merge(base, on=keys, how="left",
+                          suffixes=("", "_baseline"))
+    table["time_ratio"] = table["seconds"] / table["seconds_baseline"]
+    table["memory_ratio"] = table["peak_mb"] / table["peak_mb_baseline"]
+    scale = np.maximum(np.abs(table["estimate_baseline"]), 1e-300)
+    table["estimate_diff"] = np.abs(table["estimate"]
+                                    - table["estimate_baseline"]) / scale
+    slower = (table["time_ratio"] > 1 + tolerance) & \
+        (table["seconds"] - table["seconds_baseline"] > min_seconds)
+    memory = (table["memory_ratio"] > 1 + tolerance) & \
+        (table["peak_mb"] - table["peak_mb_baseline"] > 1)
+    status = np.select(
+        [table["seconds_baseline"].isna(), table["estimate_diff"] > rtol,
+         slower, memory], ["new", "estimate", "slower", "memory"], "ok")
+    table["status"] = status
+    return table.set_index(["benchmark", "backend", "rows"])[[
+        "seconds", "seconds_baseline", "time_ratio", "peak_mb",
+        "peak_mb_baseline", "memory_ratio", "estimate_diff", "status"]]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--benchmarks", nargs="+", default=None,
+                        choices=list(BENCHMARKS), metavar="NAME",
+                        help="benchmarks to run (default: all)")
+    parser.add_argument("--backends", nargs="+", default=list(BACKENDS),
+                        choices=BACKENDS)
+    parser.add_argument("--sizes", nargs="+", type=int,
+                        default=list(SIZES[:3]),
+                        help="numbers of rows of the synthetic data")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="timed runs per benchmark (the best is kept)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--budget", type=float, default=60.0,
+                        help="seconds after which larger sizes are skipped")
+    parser.add_argument("--save", metavar="PATH",
+                        help="write the results as a JSON baseline")
+    parser.add_argument("--baseline", metavar="PATH",
+                        help="compare with a baseline written by --save")
+    parser.add_argument("--against", choices=BACKENDS, default=None,
+                        help="compare with this backend of the baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="allowed relative increase of time and memory")
+    args = parser.parse_args(argv)
+
+    results = run(args.benchmarks, args.backends, args.sizes, args.repeat,
+                  args.seed, args.budget)
+    with pd.option_context("display.width", 120):
+        print(results.to_string())
+        if args.save:
+            save(results, args.save)
+        if args.baseline:
+            table = compare(results, load(args.baseline), args.tolerance,
+                            backend=args.against)
+            print()
+            print(table.to_string())
+            if table["status"].isin(["slower", "memory",
+                                     "estimate"]).any():
+                return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,217 @@
+"""Parallel execution of the book's notebooks.
+
+The chapters listed in ``_toc.yml`` do not depend on each other, so they can
+be executed at the same time instead of one after the other. ``build``
+executes every notebook in a process pool (one worker, one kernel), writes
+the executed copies to ``_build/jupyter_execute`` in table-of-contents order
+and then lets ``jupyter-book`` render ``_build/html`` from those outputs
+without executing anything again. Unless ``--no-cache`` is given, cells whose
+source and inputs did not change are restored from
+``causal_methods.cellcache`` instead of being executed. With ``--profile
+DIR`` every cell runs under ``causal_methods.profiling`` and the stage
+timings of each notebook are written to ``DIR``.
+
+From the root of the repository::
+
+    python -m causal_methods.build --workers 4
+
+Requires ``nbformat`` and ``nbclient``, which are installed with
+``jupyter-book``.
+"""
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import yaml
+
+ROOT = Path(__file__).resolve().parent.parent
+
+
+def toc_files(toc):
+    """Return the ``file`` entries of a parsed ``_toc.yml`` in order."""
+    files = []
+    if isinstance(toc, list):
+        for entry in toc:
+            files.extend(toc_files(entry))
+    elif isinstance(toc, dict):
+        for key in ("root", "file"):
+            if key in toc:
+                files.append(toc[key])
+        for key in ("parts", "chapters", "sections"):
+            if key in toc:
+                files.extend(toc_files(toc[key]))
+    return files
+
+
+def find_notebook(root, name):
+    """Resolve a toc entry to a notebook path.
+
+    Falls back to a case-insensitive match, since the toc and the file names
+    are not always in sync (e.g. "more" vs "More" in chapter 1). Returns
+    None if there is no such notebook.
+    """
+    path = root / (name + ".ipynb")
+    if path.exists():
+        return path
+    lowered = (name + ".ipynb").lower()
+    for candidate in sorted(root.glob("*.ipynb")):
+        if candidate.name.lower() == lowered:
+            return candidate
+    return None
+
+
+def execute_notebook(path, cwd, timeout=None, kernel_name="python3",
+                     cache=True, profile=None):
+    """Execute one notebook and return (executed JSON, seconds, error).
+
+    Runs in a pool worker; errors are returned rather than raised so that
+    one failing chapter does not abort the others. With ``profile`` (a
+    directory), every cell is executed and profiled, and the cell cache is
+    not used.
+    """
+    import nbformat
+    from nbclient import NotebookClient
+
+    from causal_methods import cellcache, profiling
+
+    nb = nbformat.read(str(path), as_version=4)
+    start = time.perf_counter()
+    error = None
+    try:
+        if profile is not None:
+            profiling.execute(nb, cwd, path.stem, profile, timeout=timeout,
+                              kernel_name=kernel_name)
+        elif cache:
+            cellcache.execute(nb, cwd, timeout=timeout,
+                              kernel_name=kernel_name)
+        else:
+            NotebookClient(nb, timeout=timeout, kernel_name=kernel_name,
+                           resources={"metadata": {"path": str(cwd)}}
+                           ).execute()
+    except Exception as e:  # CellExecutionError, DeadKernelError, timeouts
+        error = "%s: %s" % (type(e).__name__, e)
+    seconds = time.perf_counter() - start
+    return nbformat.writes(nb), seconds, error
+
+
+def execute_all(root=ROOT, workers=None, timeout=None, output=None,
+                cache=True, profile=None):
+    """Execute every notebook in ``root/_toc.yml`` in parallel.
+
+    Executed notebooks are written to ``output`` (default
+    ``root/_build/jupyter_execute``). Returns a list of
+    ``(name, seconds, error)`` tuples in table-of-contents order,
+    independent of the order in which the workers finish. ``profile`` is
+    passed to ``execute_notebook``.
+    """
+    root = Path(root)
+    output = Path(output) if output else root / "_build" / "jupyter_execute"
+    with open(root / "_toc.yml") as f:
+        names = toc_files(yaml.safe_load(f))
+
+    notebooks = []
+    for name in names:
+        path = find_notebook(root, name)
+        if path is None:
+            warnings.warn("%s is listed in _toc.yml but %s.ipynb does not "
+                          "exist" % (name, name))
+        else:
+            notebooks.append((name, path))
+
+    output.mkdir(parents=True, exist_ok=True)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(execute_notebook, path, root, timeout,
+                               cache=cache, profile=profile)
+                   for name, path in notebooks]
+        report = []
+        for (name, path), future in zip(notebooks, futures):
+            text, seconds, error = future.result()
+            (output / path.name).write_text(text, encoding="utf-8")
+            report.append((name, seconds, error))
+    return report
+
+
+def render_html(root=ROOT, executed=None):
+    """Build ``_build/html`` from already executed notebooks.
+
+    The sources are copied to a staging directory, with every notebook
+    replaced by its executed copy and notebook execution switched off in
+    ``_config.yml``, and rendered with ``jupyter-book build``.
+    """
+    root = Path(root)
+    executed = Path(executed) if executed else \
+        root / "_build" / "jupyter_execute"
+    with tempfile.TemporaryDirectory() as staging:
+        staging = Path(staging)
+        for path in root.iterdir():
+            if path.suffix in (".ipynb", ".md", ".yml", ".bib"):
+                shutil.copy2(path, staging / path.name)
+        for path in executed.glob("*.ipynb"):
+            shutil.copy2(path, staging / path.name)
+
+        with open(staging / "_config.yml") as f:
+            config = yaml.safe_load(f) or {}
+        config.setdefault("execute", {})["execute_notebooks"] = "off"
+        with open(staging / "_config.yml", "w") as f:
+            yaml.safe_dump(config, f, sort_keys=False)
+
+        subprocess.run(["jupyter-book", "build", str(staging),
+                        "--path-output", str(root)], check=True)
+
+
+def format_report(report):
+    """Per-notebook execution times, slowest first."""
+    width = max([len(name) for name, _, _ in report] + [8])
+    lines = ["%-*s %9s" % (width, "notebook", "seconds")]
+    for name, seconds, error in sorted(report, key=lambda r: -r[1]):
+        status = "" if error is None else "  FAILED " + error.splitlines()[0]
+        lines.append("%-*s %9.1f%s" % (width, name, seconds, status))
+    lines.append("%-*s %9.1f" % (width, "sum",
+                                 sum(r[1] for r in report)))
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--root", default=str(ROOT),
+                        help="book directory containing _toc.yml")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(),
+                        help="number of notebooks executed at once")
+    parser.add_argument("--timeout", type=int, default=None,
+                        help="per-cell timeout in seconds")
+    parser.add_argument("--no-html", action="store_true",
+                        help="only execute, do not run jupyter-book")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="execute every cell, ignoring the cell cache")
+    parser.add_argument("--profile", metavar="DIR", default=None,
+                        help="profile every cell and write the timings of "
+                        "each notebook to DIR")
+    args = parser.parse_args(argv)
+
+    start = time.perf_counter()
+    report = execute_all(args.root, workers=args.workers,
+                         timeout=args.timeout, cache=not args.no_cache,
+                         profile=args.profile)
+    print(format_report(report))
+    if args.profile is not None:
+        from causal_methods import profiling
+        print(profiling.report(args.profile).to_string())
+    print("wall clock: %.1f s with %d workers"
+          % (time.perf_counter() - start, args.workers))
+    if any(error is not None for _, _, error in report):
+        return 1
+    if not args.no_html:
+        render_html(args.root)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
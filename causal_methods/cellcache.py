@@ -0,0 +1,266 @@
+"""Cell-level execution cache for the book's notebooks.
+
+Each code cell gets a key: the hash of its source, the key of the code cell
+before it and the content hashes of the datasets it reads (any ``"*.dta"``,
+``"*.csv"`` or ``"*.xls"`` string in the source, resolved through
+``causal_methods.data`` and revalidated against the server on every run, so
+a dataset changed upstream invalidates the cells that read it and the ones
+below). Because keys are chained, a cell's key is unchanged exactly when
+nothing above it changed.
+
+After a cell runs, its outputs are stored under its key. Cells that take at
+least ``min_seconds`` also store a snapshot of the kernel's namespace. On the
+next run, the longest cached prefix of the notebook is restored: outputs are
+copied from the cache, the kernel is loaded from the last snapshot in that
+prefix, and only the cells after it are executed. Editing an exercise at the
+bottom of chapter 3 therefore does not re-run ``rdd.optimal_bandwidth``.
+A snapshot restores the random states and pandas options too; one that had
+to drop an unpicklable name used by a later cell is passed over for an
+earlier one.
+"""
+
+import hashlib
+import json
+import os
+import pickle
+import re
+import time
+import types
+
+from causal_methods import data
+
+DATASET = re.compile(r"""["']([^"'\s]+\.(?:dta|csv|xlsx?))["']""")
+
+# Names IPython puts in the user namespace; never snapshotted
+_IPYTHON_NAMES = {"In", "Out", "get_ipython", "exit", "quit"}
+
+
+def _dataset_digest(name):
+    # The notebooks read the live URL, so the cached copy is revalidated
+    # first: a dataset changed upstream changes the keys of its cells
+    try:
+        return data.fetch(name, revalidate=True).stem
+    except Exception:
+        # Unreachable file: the cell will fail anyway, key on the name
+        return name
+
+
+def cell_keys(nb, kernel_name="python3"):
+    """Return one key per cell of ``nb`` (None for non-code cells)."""
+    keys = []
+    previous = kernel_name
+    # Each dataset is revalidated once per notebook
+    seen = {}
+    for cell in nb.cells:
+        if cell.cell_type != "code":
+            keys.append(None)
+            continue
+        for name in DATASET.findall(cell.source):
+            if name not in seen:
+                seen[name] = _dataset_digest(name)
+        digests = sorted(seen[name]
+                         for name in DATASET.findall(cell.source))
+        spec = json.dumps([previous, cell.source, digests])
+        previous = hashlib.sha256(spec.encode()).hexdigest()
+        keys.append(previous)
+    return keys
+
+
+def _random_state():
+    # Global random states and pandas options, which live outside the
+    # namespace but change what the following cells compute
+    import random
+    import sys
+    import warnings
+
+    state = {"random": random.getstate()}
+    if "numpy" in sys.modules:
+        state["numpy"] = sys.modules["numpy"].random.get_state()
+    if "pandas" in sys.modules:
+        pd = sys.modules["pandas"]
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            state["pandas"] = dict(_options(pd.options))
+    return state
+
+
+def _options(options, prefix=""):
+    # (key, value) of every pandas option below ``options``
+    for name in dir(options):
+        value = getattr(options, name)
+        if type(value) is type(options):
+            yield from _options(value, prefix + name + ".")
+        else:
+            yield prefix + name, value
+
+
+def _set_random_state(state):
+    import random
+    import warnings
+
+    random.setstate(state["random"])
+    if "numpy" in state:
+        import numpy as np
+        np.random.set_state(state["numpy"])
+    if "pandas" in state:
+        import pandas as pd
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            for key, value in state["pandas"].items():
+                try:
+                    pd.set_option(key, value)
+                except Exception:
+                    pass
+
+
+def dump_namespace(namespace, path):
+    """Pickle the picklable part of a kernel's namespace to ``path``.
+
+    Modules are recorded by name and re-imported on load. The global
+    states of ``random`` and ``np.random`` and the pandas options are
+    saved with the namespace. Objects that cannot be pickled (open files,
+    plot handles, ...) are skipped and their names recorded, so that
+    ``skipped_names`` can tell whether the snapshot is enough for the
+    cells that follow.
+    """
+    modules, values, skipped = {}, {}, []
+    for name, value in list(namespace.items()):
+        if name.startswith("_") or name in _IPYTHON_NAMES:
+            continue
+        if isinstance(value, types.ModuleType):
+            modules[name] = value.__name__
+            continue
+        try:
+            values[name] = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            skipped.append(name)
+    with open(path, "wb") as f:
+        # The skipped names come first, readable without the values
+        pickle.dump(skipped, f, pickle.HIGHEST_PROTOCOL)
+        pickle.dump({"modules": modules, "values": values,
+                     "state": _random_state()}, f, pickle.HIGHEST_PROTOCOL)
+
+
+def skipped_names(path):
+    """Names ``dump_namespace`` could not pickle into ``path``."""
+    with open(path, "rb") as f:
+        return pickle.load(f)
+
+
+def load_namespace(namespace, path):
+    """Restore a namespace saved by ``dump_namespace``."""
+    import importlib
+
+    with open(path, "rb") as f:
+        pickle.load(f)
+        snapshot = pickle.load(f)
+    for name, module in snapshot["modules"].items():
+        namespace[name] = importlib.import_module(module)
+    for name, value in snapshot["values"].items():
+        namespace[name] = pickle.loads(value)
+    _set_random_state(snapshot["state"])
+
+
+def _usable(path, sources):
+    # A snapshot is only usable if none of the names it dropped appears
+    # in the cells that will run after it
+    if not path.exists():
+        return False
+    try:
+        skipped = skipped_names(path)
+    except Exception:
+        return False
+    return not any(re.search(r"\b%s\b" % re.escape(name), source)
+                   for name in skipped for source in sources)
+
+
+def _restore_outputs(cell, path):
+    import nbformat
+
+    with open(path) as f:
+        stored = json.load(f)
+    cell.outputs = nbformat.from_dict(stored["outputs"])
+    cell.execution_count = stored["execution_count"]
+
+
+def _run_hidden(client, code, index):
+    """Execute ``code`` in the kernel without touching the notebook."""
+    import nbformat
+
+    cell = nbformat.v4.new_code_cell(code)
+    # nbclient stores the executed cell at ``index``; put the real one back
+    original = client.nb.cells[index]
+    try:
+        client.execute_cell(cell, index, store_history=False)
+    finally:
+        client.nb.cells[index] = original
+
+
+def execute(nb, cwd, timeout=None, kernel_name="python3", min_seconds=1.0):
+    """Execute ``nb`` in place, reusing cached cells.
+
+    Returns the number of code cells that were actually executed.
+    """
+    from nbclient import NotebookClient
+
+    root = data.cache_dir() / "cells"
+    root.mkdir(parents=True, exist_ok=True)
+    keys = cell_keys(nb, kernel_name)
+    code = [i for i, key in enumerate(keys) if key is not None]
+
+    cached = 0
+    while cached < len(code) and \
+            (root / (keys[code[cached]] + ".json")).exists():
+        cached += 1
+    if cached == len(code):
+        # Nothing changed: no kernel needed
+        for index in code:
+            _restore_outputs(nb.cells[index], root / (keys[index] + ".json"))
+        return 0
+    resume = cached - 1
+    while resume >= 0 and not _usable(
+            root / (keys[code[resume]] + ".pkl"),
+            [nb.cells[index].source for index in code[resume + 1:]]):
+        resume -= 1
+
+    client = NotebookClient(nb, timeout=timeout, kernel_name=kernel_name,
+                            resources={"metadata": {"path": str(cwd)}})
+    # The hidden snapshot cells import this package, wherever the book is
+    env = dict(os.environ)
+    package = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env["PYTHONPATH"] = os.pathsep.join(
+        filter(None, [package, env.get("PYTHONPATH")]))
+    executed = 0
+    with client.setup_kernel(env=env):
+        if resume >= 0:
+            snapshot = root / (keys[code[resume]] + ".pkl")
+            try:
+                _run_hidden(client, "__import__('causal_methods.cellcache', "
+                            "fromlist=['_']).load_namespace(globals(), %r)"
+                            % str(snapshot), code[resume])
+            except Exception:
+                # Stale or unloadable snapshot; run everything
+                resume = -1
+
+        for j, index in enumerate(code):
+            cell = nb.cells[index]
+            key = keys[index]
+            if j <= resume:
+                _restore_outputs(cell, root / (key + ".json"))
+                continue
+
+            start = time.perf_counter()
+            client.execute_cell(cell, index)
+            seconds = time.perf_counter() - start
+            executed += 1
+
+            tmp = root / (key + ".json.tmp")
+            with open(tmp, "w") as f:
+                json.dump({"outputs": cell.outputs,
+                           "execution_count": cell.execution_count}, f)
+            os.replace(tmp, root / (key + ".json"))
+            if seconds >= min_seconds:
+                _run_hidden(client, "__import__('causal_methods.cellcache', "
+                            "fromlist=['_']).dump_namespace(globals(), %r)"
+                            % str(root / (key + ".pkl")), index)
+    return executed
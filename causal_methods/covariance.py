@@ -0,0 +1,128 @@
+"""Heteroskedasticity- and cluster-robust covariance matrices.
+
+All estimators in this package compute their sandwich covariances here.
+Cluster labels are factorized once to integer codes, and the per-cluster
+sums of the scores are formed with one ``np.bincount`` per column, never
+with a Python loop over clusters, so hundreds of thousands of clusters
+cost about as much as a single pass over the scores.
+
+``groups`` may hold one cluster variable (one-way clustering) or two
+(a DataFrame or an ``(n, 2)`` array), in which case the two-way covariance
+of Cameron, Gelbach & Miller (2011) is returned::
+
+    V = V(firm) + V(year) - V(firm x year)
+"""
+
+import numpy as np
+import pandas as pd
+
+from causal_methods.profiling import span
+
+COV_TYPES = ("nonrobust", "HC0", "HC1", "cluster")
+
+
+def check_cov_type(cov_type, groups):
+    if cov_type not in COV_TYPES:
+        raise ValueError("cov_type must be one of %s, got %r"
+                         % (COV_TYPES, cov_type))
+    if cov_type == "cluster" and groups is None:
+        raise ValueError("cov_type='cluster' needs groups")
+
+
+def encode(groups):
+    """Factorize cluster labels; return a list of one or two code arrays.
+
+    Raises ValueError on missing labels, which callers drop beforehand.
+    """
+    if isinstance(groups, pd.DataFrame):
+        columns = [groups[c].to_numpy() for c in groups.columns]
+    else:
+        groups = np.asarray(groups)
+        columns = [groups] if groups.ndim == 1 else list(groups.T)
+    if len(columns) > 2:
+        raise ValueError("at most two cluster variables are supported")
+    codes = [pd.factorize(c)[0] for c in columns]
+    if any((c < 0).any() for c in codes):
+        raise ValueError("cluster labels contain missing values")
+    return codes
+
+
+def missing_groups(groups):
+    """Boolean mask of rows with a missing cluster label."""
+    if isinstance(groups, pd.DataFrame):
+        return groups.isna().any(axis=1).to_numpy()
+    groups = np.asarray(groups)
+    if groups.dtype.kind in "iub":
+        missing = np.zeros(groups.shape, dtype=bool)
+    else:
+        missing = pd.isna(groups)
+    return missing if missing.ndim == 1 else missing.any(axis=1)
+
+
+def take_rows(groups, rows):
+    """Subset cluster labels (1-d, 2-d or a DataFrame) to ``rows``."""
+    if isinstance(groups, pd.DataFrame):
+        return groups[rows]
+    return np.asarray(groups)[rows]
+
+
+def group_sums(values, codes, n_groups=None):
+    """Sum the rows of ``values`` (n x k) within groups: a G x k array."""
+    if n_groups is None:
+        n_groups = codes.max() + 1
+    values = np.asarray(values, dtype=float)
+    if values.ndim == 1:
+        return np.bincount(codes, weights=values, minlength=n_groups)
+    out = np.empty((n_groups, values.shape[1]))
+    for j in range(values.shape[1]):
+        out[:, j] = np.bincount(codes, weights=values[:, j],
+                                minlength=n_groups)
+    return out
+
+
+def _one_way(scores, codes, diagonal):
+    n_groups = codes.max() + 1
+    sums = group_sums(scores, codes, n_groups)
+    meat = (sums**2).sum(axis=0) if diagonal else sums.T @ sums
+    return meat * (n_groups / (n_groups - 1))
+
+
+def cluster_meat(scores, groups, diagonal=False):
+    """Cluster-robust meat ``sum_g s_g s_g'`` with the G/(G-1) correction.
+
+    ``scores`` are the rows ``x_i * e_i`` (times the weight, for WLS).
+    With ``diagonal=True`` only the diagonal is computed.
+    """
+    codes = encode(groups)
+    meat = _one_way(scores, codes[0], diagonal)
+    if len(codes) == 2:
+        # Intersection clusters: pairs of codes
+        both = pd.factorize(codes[0] * (codes[1].max() + 1) + codes[1])[0]
+        meat = meat + _one_way(scores, codes[1], diagonal) \
+            - _one_way(scores, both, diagonal)
+    return meat
+
+
+@span("covariance")
+def robust_cov(scores, bread=None, cov_type="HC1", groups=None, k=None,
+               diagonal=False):
+    """Sandwich covariance ``bread @ meat @ bread``.
+
+    ``k`` is the number of parameters for the small-sample corrections
+    (including any absorbed fixed effects); it defaults to the number of
+    columns of ``scores``. With ``bread=None`` the scores are taken to be
+    already multiplied by the bread (influence functions), which lets
+    callers ask for a few rows of the covariance only; ``diagonal=True``
+    then returns just the variances, one per column of ``scores``.
+    """
+    n, p = scores.shape
+    k = p if k is None else k
+    if cov_type == "cluster":
+        meat = cluster_meat(scores, groups, diagonal) * ((n - 1) / (n - k))
+    else:
+        meat = (scores**2).sum(axis=0) if diagonal else scores.T @ scores
+        if cov_type == "HC1":
+            meat *= n / (n - k)
+    if bread is None:
+        return meat
+    return bread @ meat @ bread
@@ -0,0 +1,354 @@
+"""Local, content-addressed cache for the datasets used in the book.
+
+Every chapter loads its data from ``BASE_URL``::
+
+    path = "https://github.com/causal-methods/Data/raw/master/"
+    df = pd.read_stata(path + "regdata0.dta")
+
+The readers below take the same arguments as their pandas counterparts, but
+download each file only once, store it under its SHA-256 digest and keep a
+columnar copy of the parsed DataFrame. Later loads skip the Stata, Excel or
+CSV parser and are served from Parquet (if ``pyarrow`` is installed) or from
+one memory-mapped ``.npy`` file per column::
+
+    from causal_methods import data
+    df = data.read_stata(path + "regdata0.dta")
+
+Configuration is read from the environment:
+
+``CAUSAL_METHODS_CACHE``
+    Cache directory (default ``~/.cache/causal-methods``).
+``CAUSAL_METHODS_MIRROR``
+    Directory holding a local copy of the Data repository. Files found there
+    are never downloaded.
+``CAUSAL_METHODS_OFFLINE``
+    If set to ``1``, never touch the network; files must already be cached or
+    present in the mirror.
+"""
+
+import hashlib
+import json
+import os
+import pickle
+import shutil
+import tempfile
+import urllib.error
+import urllib.request
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from causal_methods.profiling import span
+
+BASE_URL = "https://github.com/causal-methods/Data/raw/master/"
+
+# Seconds to wait for the server when revalidating a cached download
+REVALIDATE_TIMEOUT = 10
+
+# Bump when the on-disk layout of the columnar copies changes
+FORMAT_VERSION = 1
+
+READERS = {
+    "stata": pd.read_stata,
+    "excel": pd.read_excel,
+    "csv": pd.read_csv,
+}
+
+
+def cache_dir():
+    """Return the cache directory, creating it if needed."""
+    root = os.environ.get("CAUSAL_METHODS_CACHE",
+                          os.path.join("~", ".cache", "causal-methods"))
+    root = Path(root).expanduser()
+    root.mkdir(parents=True, exist_ok=True)
+    return root
+
+
+def mirror_dir():
+    """Return the local mirror directory, or None if not configured."""
+    mirror = os.environ.get("CAUSAL_METHODS_MIRROR")
+    return Path(mirror).expanduser() if mirror else None
+
+
+def is_offline():
+    return os.environ.get("CAUSAL_METHODS_OFFLINE", "") not in ("", "0")
+
+
+def _sha256(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def _atomic_write(target, data):
+    # Write to a temporary file in the same directory and rename it, so that
+    # concurrent notebook workers never observe a half written file.
+    target.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=target.parent, prefix=".tmp-")
+    with os.fdopen(fd, "wb") as f:
+        f.write(data)
+    os.replace(tmp, target)
+
+
+def _split_source(source):
+    """Return (url or None, file name) for a path, URL or bare file name."""
+    source = str(source)
+    if "://" in source:
+        return source, source.rstrip("/").rsplit("/", 1)[-1]
+    if os.path.exists(source):
+        return None, os.path.basename(source)
+    return BASE_URL + source, source
+
+
+def _download(url, validators, timeout=None):
+    # Conditional GET: (None, validators) if the copy described by
+    # ``validators`` (ETag, Last-Modified) is still current, else the body
+    # and its new validators
+    request = urllib.request.Request(url)
+    if validators.get("etag"):
+        request.add_header("If-None-Match", validators["etag"])
+    if validators.get("last_modified"):
+        request.add_header("If-Modified-Since", validators["last_modified"])
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            return response.read(), {
+                "etag": response.headers.get("ETag"),
+                "last_modified": response.headers.get("Last-Modified")}
+    except urllib.error.HTTPError as error:
+        if error.code == 304:
+            return None, validators
+        raise
+
+
+@span("download")
+def fetch(source, offline=None, revalidate=False):
+    """Return the local path of the cached copy of ``source``.
+
+    ``source`` may be a URL, a local file or a file name relative to
+    ``BASE_URL``. The file is stored as ``blobs/<sha256><suffix>``, so the
+    same bytes are kept only once whatever URL they were fetched from.
+
+    A URL is downloaded once and then served from the cache. With
+    ``revalidate=True`` the cached copy is checked against the server
+    first (a conditional request on its ETag and Last-Modified date, or a
+    new read of the mirror's file) and replaced if the data changed; if the
+    server cannot be reached, or offline, the cached copy is returned.
+    """
+    if offline is None:
+        offline = is_offline()
+    url, name = _split_source(source)
+    root = cache_dir()
+    suffix = Path(name).suffix
+    validators = {}
+
+    if url is None:
+        data = Path(source).read_bytes()
+    else:
+        ref = root / "refs" / _sha256(url.encode())
+        cached = None
+        if ref.exists():
+            blob = root / "blobs" / ref.read_text().strip()
+            cached = blob if blob.exists() else None
+        if cached is not None and (not revalidate or offline):
+            return cached
+        mirror = mirror_dir()
+        if mirror is not None and (mirror / name).exists():
+            data = (mirror / name).read_bytes()
+        elif offline:
+            raise FileNotFoundError(
+                "%s is not cached and no local mirror provides it "
+                "(offline mode)" % name)
+        else:
+            known = {}
+            if cached is not None and ref.with_suffix(".json").exists():
+                known = json.loads(ref.with_suffix(".json").read_text())
+            try:
+                data, validators = _download(
+                    url, known,
+                    REVALIDATE_TIMEOUT if cached is not None else None)
+            except OSError:
+                if cached is None:
+                    raise
+                # Unreachable server: keep the copy we have
+                return cached
+            if data is None:
+                return cached
+
+    digest = _sha256(data)
+    blob = root / "blobs" / (digest + suffix)
+    if not blob.exists():
+        _atomic_write(blob, data)
+    if url is not None:
+        ref = root / "refs" / _sha256(url.encode())
+        _atomic_write(ref.with_suffix(".json"),
+                      json.dumps(validators).encode())
+        _atomic_write(ref, blob.name.encode())
+    return blob
+
+
+def _frame_key(blob, reader, args, kwargs):
+    spec = repr((FORMAT_VERSION, blob.name, reader, args,
+                 sorted(kwargs.items())))
+    return _sha256(spec.encode())[:32]
+
+
+def _has_pyarrow():
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def _save_column(directory, i, series):
+    """Save one column and return its metadata entry."""
+    dtype = series.dtype
+    entry = {"dtype": str(dtype)}
+    stem = directory / ("c%04d" % i)
+    if isinstance(dtype, np.dtype) and dtype.kind in "biufcmM":
+        np.save(stem.with_suffix(".npy"), series.to_numpy())
+        entry["kind"] = "array"
+        return entry
+    if isinstance(dtype, (pd.CategoricalDtype, pd.StringDtype)) \
+            or dtype == object:
+        try:
+            values = pd.Categorical(series)
+        except TypeError:
+            # Unorderable mixed types; fall through to pickle
+            pass
+        else:
+            np.save(stem.with_suffix(".npy"), values.codes)
+            with open(stem.with_suffix(".cat"), "wb") as f:
+                pickle.dump(values.categories, f)
+            categorical = isinstance(dtype, pd.CategoricalDtype)
+            entry["kind"] = "category" if categorical else "codes"
+            entry["ordered"] = bool(values.ordered)
+            return entry
+    with open(stem.with_suffix(".pkl"), "wb") as f:
+        pickle.dump(series.to_numpy(), f)
+    entry["kind"] = "pickle"
+    return entry
+
+
+def _load_column(directory, i, entry, mmap):
+    stem = directory / ("c%04d" % i)
+    kind = entry["kind"]
+    if kind == "pickle":
+        with open(stem.with_suffix(".pkl"), "rb") as f:
+            return pd.array(pickle.load(f), dtype=entry["dtype"])
+    # Copy-on-write mapping: pages are read lazily and in-place edits made
+    # by a notebook never reach the cached file.
+    values = np.load(stem.with_suffix(".npy"),
+                     mmap_mode="c" if mmap else None)
+    if kind == "array":
+        return values
+    with open(stem.with_suffix(".cat"), "rb") as f:
+        categories = pickle.load(f)
+    values = pd.Categorical.from_codes(np.asarray(values), categories,
+                                       ordered=entry["ordered"])
+    # Object and string columns were stored as codes into their categories
+    return values if kind == "category" else values.astype(entry["dtype"])
+
+
+def write_frame(frame, directory, engine=None):
+    """Store ``frame`` in columnar form under ``directory``.
+
+    ``engine`` is "parquet" or "npy"; by default Parquet is used when
+    ``pyarrow`` is available.
+    """
+    directory = Path(directory)
+    if engine is None:
+        engine = "parquet" if _has_pyarrow() else "npy"
+    directory.parent.mkdir(parents=True, exist_ok=True)
+    tmp = Path(tempfile.mkdtemp(dir=directory.parent, prefix=".tmp-"))
+    meta = {"format": FORMAT_VERSION, "engine": engine}
+
+    if engine == "parquet":
+        frame.to_parquet(tmp / "frame.parquet")
+    elif engine == "npy":
+        index_names = None
+        if not isinstance(frame.index, pd.RangeIndex):
+            index_names = list(frame.index.names)
+            frame = frame.reset_index()
+            meta["index"] = list(frame.columns[:len(index_names)])
+        meta["index_names"] = index_names
+        meta["columns"] = list(frame.columns)
+        meta["entries"] = [_save_column(tmp, i, frame.iloc[:, i])
+                           for i in range(frame.shape[1])]
+        meta["length"] = len(frame)
+    else:
+        raise ValueError("unknown engine: %r" % engine)
+
+    (tmp / "meta.json").write_text(json.dumps(meta))
+    try:
+        os.replace(tmp, directory)
+    except OSError:
+        # Another process stored the same frame first
+        shutil.rmtree(tmp, ignore_errors=True)
+    return directory
+
+
+def read_frame(directory, mmap=True):
+    """Load a DataFrame stored by ``write_frame``."""
+    directory = Path(directory)
+    meta = json.loads((directory / "meta.json").read_text())
+    if meta["engine"] == "parquet":
+        return pd.read_parquet(directory / "frame.parquet")
+
+    columns = [_load_column(directory, i, entry, mmap)
+               for i, entry in enumerate(meta["entries"])]
+    frame = pd.DataFrame(dict(enumerate(columns)), copy=False,
+                         index=pd.RangeIndex(meta["length"]))
+    frame.columns = meta["columns"]
+    if meta["index_names"] is not None:
+        frame = frame.set_index(meta["index"])
+        frame.index.names = meta["index_names"]
+    return frame
+
+
+@span("load")
+def load(source, reader, *args, offline=None, mmap=True, **kwargs):
+    """Load ``source`` with one of the pandas ``READERS``, through the cache.
+
+    Extra positional and keyword arguments are passed to the reader and are
+    part of the cache key, so ``read_excel(..., sheet_name=1)`` and
+    ``sheet_name=2`` are cached separately.
+    """
+    if reader not in READERS:
+        raise ValueError("unknown reader %r; expected one of %s"
+                         % (reader, sorted(READERS)))
+    blob = fetch(source, offline=offline)
+    directory = (cache_dir() / "frames"
+                 / _frame_key(blob, reader, args, kwargs))
+    if (directory / "meta.json").exists():
+        return read_frame(directory, mmap=mmap)
+
+    frame = READERS[reader](blob, *args, **kwargs)
+    if isinstance(frame, dict):
+        # read_excel(sheet_name=None) returns every sheet; not worth caching
+        return frame
+    write_frame(frame, directory)
+    return frame
+
+
+def read_stata(source, *args, **kwargs):
+    """Cached ``pd.read_stata``."""
+    return load(source, "stata", *args, **kwargs)
+
+
+def read_excel(source, *args, **kwargs):
+    """Cached ``pd.read_excel``."""
+    return load(source, "excel", *args, **kwargs)
+
+
+def read_csv(source, *args, **kwargs):
+    """Cached ``pd.read_csv``."""
+    return load(source, "csv", *args, **kwargs)
+
+
+def clear(frames_only=False):
+    """Remove the columnar copies, and the downloaded files unless
+    ``frames_only`` is True."""
+    root = cache_dir()
+    names = ["frames"] if frames_only else ["frames", "blobs", "refs"]
+    for name in names:
+        shutil.rmtree(root / name, ignore_errors=True)
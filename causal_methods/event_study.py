@@ -0,0 +1,255 @@
+"""Event studies and difference-in-differences with staggered adoption.
+
+Chapter 5 compares one treated group with one control group over two
+periods, from ``pd.crosstab(df['year_1931'], df['st_louis_fed'], ...)``.
+When units adopt a treatment at different times, the two-way fixed
+effects regression mixes already-treated units into the controls; the
+group-time average effects of Callaway and Sant'Anna (2021) avoid this by
+comparing each adoption cohort ``g`` with units not (yet) treated::
+
+    study = EventStudy(df['y'], df['region'], df['period'],
+                       df['first_treated'])
+    study.att_gt()                 # one row per (cohort, time) cell
+    study.aggregate('event')       # by time relative to adoption
+
+Every cell is a 2x2 difference in differences of cohort means, so all of
+them, and their influence-function variances, follow from three
+sufficient statistics per cohort of the (balanced) entity x time matrix
+of outcomes: the count ``n``, the column sums and the ``T x T`` cross
+products. These come from one grouped pass over the entities (split
+across a process pool with ``workers``); no dummy regression is fitted.
+
+With ``base="universal"`` every cell is compared with the period before
+adoption; with never-treated controls these are the cohort x relative
+time estimates of Sun and Abraham (2021).
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+CONTROLS = ("never", "notyet")
+BASES = ("varying", "universal")
+AGGREGATIONS = ("simple", "event", "group", "calendar")
+
+
+def first_treated(entity, time, treated):
+    """First period in which each row's entity is treated (NaN if never),
+    aligned with the rows."""
+    frame = pd.DataFrame({"entity": np.asarray(entity),
+                          "time": np.asarray(time),
+                          "treated": np.asarray(treated, dtype=float)})
+    first = frame["time"].where(frame["treated"] > 0) \
+        .groupby(frame["entity"]).transform("min")
+    return first.to_numpy(float)
+
+
+def _cohort_moments(Y):
+    # Sufficient statistics of one cohort: n, column sums, cross products
+    return len(Y), Y.sum(axis=0), Y.T @ Y
+
+
+class EventStudy:
+    """Group-time average treatment effects from a long panel.
+
+    ``y``, ``entity``, ``time`` and ``cohort`` are aligned arrays or
+    Series; ``cohort`` is the period in which the entity is first treated,
+    NaN or ``inf`` if never (entities first treated after the last period
+    count as never treated, those treated in the first period are
+    dropped). Only entities observed in every period are kept, as in the
+    balanced-panel estimator of Callaway and Sant'Anna. ``control`` is
+    ``"never"`` (never-treated units) or ``"notyet"`` (units not yet
+    treated at either period of the comparison).
+    """
+
+    def __init__(self, y, entity, time, cohort, control="never",
+                 base="varying", workers=None):
+        if control not in CONTROLS:
+            raise ValueError("control must be one of %s, got %r"
+                             % (CONTROLS, control))
+        if base not in BASES:
+            raise ValueError("base must be one of %s, got %r"
+                             % (BASES, base))
+        self.control = control
+        self.base = base
+        y = np.asarray(y, dtype=float)
+        cohort = np.asarray(cohort, dtype=float)
+        entity_codes, entities = pd.factorize(np.asarray(entity))
+        self.times = np.unique(np.asarray(time))
+        time_codes = np.searchsorted(self.times, np.asarray(time))
+        E, T = len(entities), len(self.times)
+
+        Y = np.full((E, T), np.nan)
+        Y[entity_codes, time_codes] = y
+        if np.bincount(entity_codes * T + time_codes,
+                       minlength=E * T).max() > 1:
+            raise ValueError("duplicate (entity, time) rows")
+        entity_cohort = np.full(E, np.nan)
+        entity_cohort[entity_codes] = cohort
+        if not np.array_equal(entity_cohort[entity_codes], cohort,
+                              equal_nan=True):
+            raise ValueError("cohort must be constant within entities")
+
+        # Cohorts as time indices; T stands for never treated
+        never = np.isnan(entity_cohort) | (entity_cohort > self.times[-1])
+        index = np.searchsorted(self.times, np.where(never, self.times[0],
+                                                     entity_cohort))
+        if (self.times[np.minimum(index, T - 1)] != entity_cohort)[
+                ~never].any():
+            raise ValueError("cohorts must be periods of the panel")
+        index[never] = T
+        keep = ~np.isnan(Y).any(axis=1) & (index > 0)
+        self.n_dropped = E - keep.sum()
+        Y, index = Y[keep], index[keep]
+
+        self.cohorts = np.unique(index)
+        codes = np.searchsorted(self.cohorts, index)
+        order = np.argsort(codes, kind="stable")
+        bounds = np.searchsorted(codes[order],
+                                 np.arange(len(self.cohorts) + 1))
+        blocks = [Y[order[a:b]] for a, b in zip(bounds[:-1], bounds[1:])]
+        if workers is None or workers <= 1:
+            moments = [_cohort_moments(block) for block in blocks]
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                moments = list(pool.map(_cohort_moments, blocks))
+        self.n = np.array([m[0] for m in moments], dtype=float)
+        self.mean = np.array([m[1] for m in moments]) / self.n[:, None]
+        self.cov = np.array([m[2] for m in moments]) / self.n[:, None, None] \
+            - self.mean[:, :, None] * self.mean[:, None, :]
+        self.nobs = len(Y)
+        self._cells()
+
+    def _cells(self):
+        # Every identified (cohort, time) cell: its base period and the
+        # weight of each cohort in the estimate, lambda (K x cohorts)
+        T = len(self.times)
+        rows, weights = [], []
+        for gi, g in enumerate(self.cohorts):
+            if g == T:
+                continue
+            for t in range(T):
+                b = g - 1 if (self.base == "universal" or t >= g) else t - 1
+                if b < 0 or t == b:
+                    continue
+                if self.control == "never":
+                    control = self.cohorts == T
+                else:
+                    control = (self.cohorts > max(t, b)) \
+                        & (self.cohorts != g)
+                n_control = self.n[control].sum()
+                if n_control == 0:
+                    continue
+                weight = np.where(control, -self.n / n_control, 0.0)
+                weight[gi] = 1.0
+                rows.append((gi, t, b, n_control))
+                weights.append(weight)
+        if not rows:
+            raise ValueError("no cohort has a pre-period and controls")
+        cells = np.array(rows)
+        self.cell_cohort = cells[:, 0].astype(int)
+        self.cell_time = cells[:, 1].astype(int)
+        self.cell_base = cells[:, 2].astype(int)
+        self.cell_controls = cells[:, 3]
+        self.weights = np.array(weights)
+        # Change of each cohort's mean between base and time, per cell
+        change = self.mean[:, self.cell_time] - self.mean[:, self.cell_base]
+        self.att = (self.weights * change.T).sum(axis=1)
+
+    def _variance(self, W):
+        # Variance of the linear combinations W (m x K) of the cells; the
+        # cohorts are independent samples of entities
+        T = len(self.times)
+        K = len(self.att)
+        contrast = np.zeros((K, T))
+        contrast[np.arange(K), self.cell_time] = 1
+        contrast[np.arange(K), self.cell_base] = -1
+        variance = np.zeros(len(W))
+        for c in range(len(self.cohorts)):
+            if not self.weights[:, c].any():
+                continue
+            L = (W * self.weights[:, c]) @ contrast
+            variance += np.einsum("it,ts,is->i", L, self.cov[c], L) \
+                / self.n[c]
+        return variance
+
+    def _table(self, estimates, W, index):
+        se = np.sqrt(self._variance(W))
+        z = estimates / se
+        q = stats.norm.isf(0.025)
+        return pd.DataFrame({"att": estimates, "std err": se, "z": z,
+                             "P>|z|": 2 * stats.norm.sf(np.abs(z)),
+                             "[0.025": estimates - q * se,
+                             "0.975]": estimates + q * se}, index=index)
+
+    def att_gt(self):
+        """One row per (cohort, time) cell: the ATT, its analytic
+        (influence-function) standard error and the cell sizes."""
+        cohort = self.times[self.cohorts[self.cell_cohort]]
+        time = self.times[self.cell_time]
+        index = pd.MultiIndex.from_arrays([cohort, time],
+                                          names=["cohort", "time"])
+        table = self._table(self.att, np.eye(len(self.att)), index)
+        table.insert(0, "event", self.cell_time
+                     - self.cohorts[self.cell_cohort])
+        table["base"] = self.times[self.cell_base]
+        table["n_treated"] = self.n[self.cell_cohort].astype(int)
+        table["n_control"] = self.cell_controls.astype(int)
+        return table
+
+    def aggregate(self, kind="event"):
+        """Averages of the cells, weighted by cohort size.
+
+        ``"event"``: by time relative to adoption (including leads);
+        ``"group"``: the post-treatment average of each cohort;
+        ``"calendar"``: by period, over the cohorts treated by then;
+        ``"simple"``: all post-treatment cells. The weights are treated as
+        known; Callaway and Sant'Anna add a term for their estimation.
+        """
+        if kind not in AGGREGATIONS:
+            raise ValueError("kind must be one of %s, got %r"
+                             % (AGGREGATIONS, kind))
+        event = self.cell_time - self.cohorts[self.cell_cohort]
+        size = self.n[self.cell_cohort]
+        post = event >= 0
+        if kind == "simple":
+            keys, labels, name = np.where(post, 0, -1), ["ATT"], None
+        elif kind == "event":
+            keys = event
+            labels = np.unique(event)
+            name = "event"
+        elif kind == "group":
+            keys = np.where(post, self.cell_cohort, -1)
+            labels = np.unique(self.cell_cohort[post])
+            name = "cohort"
+            size = np.ones(len(size))
+        else:
+            keys = np.where(post, self.cell_time, -1)
+            labels = np.unique(self.cell_time[post])
+            name = "time"
+        values = [0] if kind == "simple" else labels
+        W = np.array([np.where(keys == key, size, 0.0) for key in values])
+        W /= W.sum(axis=1, keepdims=True)
+        if kind == "group":
+            labels = self.times[self.cohorts[labels]]
+        elif kind == "calendar":
+            labels = self.times[labels]
+        table = self._table(W @ self.att, W, pd.Index(labels, name=name))
+        if kind == "group":
+            # Overall: the cohort averages weighted by cohort size
+            overall = self.n[values] / self.n[values].sum() @ W
+            table = pd.concat([table, self._table(
+                overall[None] @ self.att, overall[None],
+                pd.Index(["ATT"], name=name))])
+        return table
+
+
+def event_study(y, entity, time, cohort, control="never", base="varying",
+                aggregate="event", workers=None):
+    """Aggregated group-time ATTs; see ``EventStudy``. With
+    ``aggregate=None`` returns the (cohort, time) cells."""
+    study = EventStudy(y, entity, time, cohort, control, base, workers)
+    return study.att_gt() if aggregate is None \
+        else study.aggregate(aggregate)
@@ -0,0 +1,168 @@
+"""Absorbing high-dimensional fixed effects.
+
+Chapter 9 adds the 104 randomization strata as ``C(block13)`` dummies and
+chapter 5 cannot estimate firm and industry fixed effects at the same time.
+With ~10**6 firms an N x G dummy matrix does not fit in memory.
+
+``Absorber`` removes one or more fixed effects from a set of columns by
+demeaning within groups of integer codes (group sums via ``np.bincount``).
+With several fixed effects the demeaning alternates between them until
+convergence (the method of alternating projections). By the Frisch-Waugh-
+Lovell theorem, regressing the demeaned outcome on the demeaned regressors
+gives the same coefficients as the dummy regression::
+
+    absorbed_ols(df['left_s3'], df[['assettreat']], df[['block13']])
+    absorbed_ols(Y, df[dd], df[['firm', 'industrycode']],
+                 cov_type='cluster', groups=df['firm'])
+"""
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from scipy.sparse import csgraph
+
+from causal_methods import covariance
+from causal_methods.covariance import check_cov_type
+from causal_methods.profiling import span
+from causal_methods.regression import column_names, sandwich, solve
+from causal_methods.results import Result
+
+
+class Absorber:
+    """Fixed effects given as integer codes, ready to demean columns.
+
+    ``factors`` is a DataFrame (one column per fixed effect) or a list of
+    1-d arrays; any hashable labels work, they are factorized once.
+    """
+
+    def __init__(self, factors, weights=None):
+        if isinstance(factors, pd.DataFrame):
+            factors = [factors[c] for c in factors.columns]
+        elif isinstance(factors, pd.Series) or np.ndim(factors) == 1:
+            factors = [factors]
+        self.codes = [pd.factorize(np.asarray(f))[0] for f in factors]
+        if any((c < 0).any() for c in self.codes):
+            raise ValueError("fixed effects contain missing values")
+        self.n = len(self.codes[0])
+        self.weights = (np.ones(self.n) if weights is None
+                        else np.asarray(weights, dtype=float))
+        self.group_weights = [np.bincount(c, weights=self.weights)
+                              for c in self.codes]
+
+    @property
+    def n_levels(self):
+        return [len(w) for w in self.group_weights]
+
+    @property
+    def df_absorbed(self):
+        """Number of parameters absorbed by the fixed effects.
+
+        Exact for one or two fixed effects (for two, the levels are
+        counted once per connected component of the bipartite graph, so
+        industry nested in firm costs nothing). With more, each extra
+        fixed effect is assumed to cost all but one of its levels.
+        """
+        levels = self.n_levels
+        if len(levels) == 1:
+            return levels[0]
+        a, b = self.codes[:2]
+        graph = sparse.coo_matrix((np.ones(self.n), (a, b + levels[0])),
+                                  shape=(sum(levels[:2]),) * 2)
+        components, _ = csgraph.connected_components(graph, directed=False)
+        return sum(levels[:2]) - components + sum(
+            g - 1 for g in levels[2:])
+
+    def _sweep(self, values):
+        # Subtract the (weighted) group means, one fixed effect at a time;
+        # return the largest change of each column
+        change = np.zeros(values.shape[1])
+        for codes, group_weights in zip(self.codes, self.group_weights):
+            for j in range(values.shape[1]):
+                sums = np.bincount(codes, weights=self.weights
+                                   * values[:, j])
+                means = sums / group_weights
+                change[j] = max(change[j], np.abs(means).max())
+                values[:, j] -= means[codes]
+        return change
+
+    @span("demean")
+    def demean(self, values, tol=1e-10, maxiter=10000):
+        """Return ``values`` with every fixed effect projected out.
+
+        ``values`` is 1-d or 2-d; all columns are demeaned together.
+        """
+        values = np.array(values, dtype=float)
+        one_dim = values.ndim == 1
+        if one_dim:
+            values = values[:, None]
+        if len(self.codes) == 1:
+            self._sweep(values)
+        else:
+            scale = np.abs(values).max(axis=0)
+            scale[scale == 0] = 1
+            for _ in range(maxiter):
+                if (self._sweep(values) <= tol * scale).all():
+                    break
+            else:
+                raise RuntimeError("fixed effects did not converge in %d "
+                                   "iterations" % maxiter)
+        return values[:, 0] if one_dim else values
+
+
+def absorbed_ols(y, X, absorb, weights=None, cov_type="nonrobust",
+                 groups=None):
+    """OLS of ``y`` on ``X`` plus the fixed effects in ``absorb``.
+
+    Returns the coefficients of ``X`` only; a constant in ``X`` is dropped,
+    since the fixed effects absorb it. Standard errors match the dummy
+    regression: the absorbed levels count in the degrees of freedom and in
+    the small-sample corrections of HC1 and clustered covariances. Rows with
+    a missing value in any input are dropped.
+    """
+    check_cov_type(cov_type, groups)
+    names = column_names(X)
+    y = np.asarray(y, dtype=float)
+    X = np.asarray(X, dtype=float)
+    if X.ndim == 1:
+        X = X[:, None]
+    if isinstance(absorb, pd.Series) or np.ndim(absorb) == 1:
+        absorb = pd.DataFrame({"fe": np.asarray(absorb)})
+    absorb = pd.DataFrame(absorb).reset_index(drop=True)
+    keep = ~(np.isnan(y) | np.isnan(X).any(axis=1)
+             | absorb.isna().any(axis=1).to_numpy())
+    if weights is not None:
+        weights = np.asarray(weights, dtype=float)
+        keep &= ~np.isnan(weights)
+    if groups is not None:
+        keep &= ~covariance.missing_groups(groups)
+        groups = covariance.take_rows(groups, keep)
+    if weights is not None:
+        weights = weights[keep]
+    y, X, absorb = y[keep], X[keep], absorb[keep]
+
+    absorber = Absorber(absorb, weights)
+    demeaned = absorber.demean(np.column_stack([y, X]))
+    yd, Xd = demeaned[:, 0], demeaned[:, 1:]
+    # Columns absorbed by the fixed effects (the constant, time-invariant
+    # regressors under entity effects, ...) are not identified
+    identified = np.linalg.norm(Xd, axis=0) > \
+        1e-8 * np.maximum(np.linalg.norm(X, axis=0), 1)
+    dropped = [name for name, ok in zip(names, identified) if not ok]
+    names = [name for name, ok in zip(names, identified) if ok]
+    Xd = Xd[:, identified]
+
+    beta, bread, resid = solve(Xd, yd, weights)
+    n = len(yd)
+    k = Xd.shape[1] + absorber.df_absorbed
+    w = np.ones(n) if weights is None else weights
+    ssr = w @ resid**2
+    if cov_type == "nonrobust":
+        cov = bread * ssr / (n - k)
+    else:
+        cov = sandwich(Xd, resid, bread, weights, cov_type, groups, k=k)
+    ybar = (w @ y) / w.sum()
+    return Result(pd.Series(beta, names), cov, nobs=n, df_resid=n - k,
+                  cov_type=cov_type, ssr=ssr,
+                  centered_tss=w @ (y - ybar)**2,
+                  df_absorbed=absorber.df_absorbed, dropped=dropped,
+                  within_tss=w @ yd**2)
@@ -0,0 +1,402 @@
+"""Formula regressions with sparse designs for categorical terms.
+
+``smf.ols("callback ~ female*C(type) + C(occupation_type) + C(name)", df)``
+expands every ``C(...)`` term into dense dummy columns. With thousands of
+employers or occupations the dense design alone does not fit in memory,
+although almost all of its entries are zero.
+
+``design`` parses the formula with patsy, so column names, reference levels
+and interaction rules are exactly those of statsmodels, but builds the
+right-hand side as a ``scipy.sparse`` CSR matrix: a categorical factor is a
+row selection of its (sparse) contrast matrix, and interactions are
+row-wise products. ``ols`` fits it with sparse normal equations (or LSQR)
+when the formula has categorical terms, and falls back to the dense
+``regression.ols`` otherwise::
+
+    from causal_methods import formula
+    formula.ols("callback ~ female*C(type)", data, cov_type='HC1')
+"""
+
+import ast
+import builtins
+import collections
+import functools
+import types
+
+import numpy as np
+import pandas as pd
+import patsy
+import patsy.builtins
+from scipy import sparse
+from scipy.sparse import linalg as splinalg
+
+from causal_methods import covariance, regression
+from causal_methods.profiling import span
+from causal_methods.results import Result
+
+SOLVERS = ("normal", "lsqr")
+
+
+class Design:
+    """Outcome, sparse design and column names built from a formula.
+
+    ``rows`` is the boolean mask of the rows of ``data`` kept after
+    dropping missing values, and ``categorical`` tells whether any term
+    involves a categorical factor.
+    """
+
+    def __init__(self, y, X, names, rows, categorical, y_name):
+        self.y = y
+        self.X = X
+        self.names = names
+        self.rows = rows
+        self.categorical = categorical
+        self.y_name = y_name
+
+
+def _factor_values(info, data):
+    """Evaluate one factor: a 2-d float array, or integer codes (-1 for
+    missing) for a categorical factor."""
+    values = info.factor.eval(info.state, data)
+    if info.type == "numerical":
+        values = np.asarray(values, dtype=float)
+        return values.reshape(len(values), -1)
+    if isinstance(values, patsy.categorical._CategoricalBox):
+        values = values.data
+    if isinstance(values, pd.Series):
+        values = values.to_numpy()
+    return pd.Categorical(values, categories=list(info.categories)).codes
+
+
+def _subterm_matrix(subterm, values):
+    """Sparse columns of one subterm, ordered as patsy orders them (the
+    left-most factor varies fastest)."""
+    out = None
+    for factor in subterm.factors:
+        if factor in subterm.contrast_matrices:
+            contrast = sparse.csr_matrix(
+                subterm.contrast_matrices[factor].matrix)
+            part = contrast[values[factor]]
+        else:
+            part = sparse.csr_matrix(values[factor])
+        if out is None:
+            out = part
+        else:
+            out = sparse.hstack([out.multiply(part[:, j].toarray())
+                                 for j in range(part.shape[1])],
+                                format="csr")
+    if out is None:
+        # The intercept
+        n = len(next(iter(values.values()))) if values else 0
+        out = sparse.csr_matrix(np.ones((n, 1)))
+    return out
+
+
+class DesignCache:
+    """Least-recently-used cache of built designs, bounded in bytes.
+
+    Entries are keyed by the terms of one side of a formula, the content
+    (dtype and a hash of the values) of the columns they read, including
+    columns named in strings (``Q("a b")``), and the modules, functions
+    and scalars the other names in the terms resolve to (``np``, a
+    function defined in the notebook, ...). A later call with the same
+    terms on unchanged columns, on the same DataFrame or on a copy,
+    reuses the categorical encodings and the built matrix instead of
+    running patsy again. Terms that read any other object of the
+    notebook, such as an array, are never cached: its content could
+    change in place.
+    """
+
+    def __init__(self, max_bytes=256 * 2**20):
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()
+        self.nbytes = 0
+        self.hits = self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return entry[0]
+
+    def put(self, key, value, nbytes):
+        if nbytes > self.max_bytes:
+            return
+        if key in self.entries:
+            self.nbytes -= self.entries.pop(key)[1]
+        self.entries[key] = (value, nbytes)
+        self.nbytes += nbytes
+        while self.nbytes > self.max_bytes:
+            self.nbytes -= self.entries.popitem(last=False)[1][1]
+
+    def clear(self):
+        self.entries.clear()
+        self.nbytes = 0
+        self.hits = self.misses = 0
+
+
+design_cache = DesignCache()
+
+
+@functools.lru_cache(maxsize=1024)
+def _parse(formula):
+    return patsy.ModelDesc.from_formula(formula)
+
+
+def _fingerprint(column):
+    # Content of a column: its dtype and a hash of its values
+    values = column.array
+    if isinstance(values, pd.Categorical):
+        return (str(column.dtype), values.ordered,
+                hash(tuple(values.categories)), hash(values.codes.tobytes()))
+    if isinstance(column.dtype, np.dtype) and column.dtype.kind != "O":
+        return str(column.dtype), hash(column.to_numpy().tobytes())
+    hashes = pd.util.hash_pandas_object(column, index=False).to_numpy()
+    return str(column.dtype), hash(hashes.tobytes())
+
+
+# Names patsy and Python provide to every formula
+_BUILTINS = frozenset(patsy.builtins.__all__) | frozenset(dir(builtins))
+
+
+def _names(code):
+    # Variable names and string literals of a factor; ``Q("a b")`` reads
+    # the column "a b" through a string
+    names, strings = set(), set()
+    for node in ast.walk(ast.parse(code.strip(), mode="eval")):
+        if isinstance(node, ast.Name):
+            names.add(node.id)
+        elif isinstance(node, ast.Constant) and isinstance(node.value, str):
+            strings.add(node.value)
+    return names, strings
+
+
+def _key(termlist, data, eval_env):
+    # None when a factor reads something whose content cannot be hashed
+    # cheaply (an array or object of the notebook): such sides are not
+    # cached, since a mutated object would return a stale design
+    names, strings = set(), set()
+    for term in termlist:
+        for factor in term.factors:
+            try:
+                found = _names(factor.code)
+            except SyntaxError:
+                return None
+            names |= found[0]
+            strings |= found[1]
+    resolved = []
+    for name in sorted(names | (strings & set(data.columns))):
+        if name in data.columns:
+            resolved.append((name, len(data), _fingerprint(data[name])))
+            continue
+        try:
+            value = eval_env.namespace[name]
+        except KeyError:
+            if name not in _BUILTINS:
+                return None
+            resolved.append((name, "builtin"))
+            continue
+        if isinstance(value, (bool, int, float, complex, str)):
+            resolved.append((name, type(value).__name__, value))
+        elif isinstance(value, types.ModuleType) or (
+                callable(value) and not hasattr(value, "__array__")):
+            resolved.append((name, id(value)))
+        else:
+            return None
+    return tuple(termlist), tuple(resolved)
+
+
+def _build(termlist, data, eval_env):
+    # Sparse matrix, column names, kept rows and whether a factor is
+    # categorical, for one side of a formula
+    info = patsy.design_matrix_builders([termlist], lambda: iter([data]),
+                                        eval_env, NA_action="drop")[0]
+    values = {f: _factor_values(i, data)
+              for f, i in info.factor_infos.items()}
+    rows = np.ones(len(data), dtype=bool)
+    for factor, value in values.items():
+        if info.factor_infos[factor].type == "numerical":
+            rows &= ~np.isnan(value).any(axis=1)
+        else:
+            rows &= value >= 0
+    values = {f: v[rows] for f, v in values.items()}
+    blocks = [_subterm_matrix(subterm, values)
+              for subterms in info.term_codings.values()
+              for subterm in subterms]
+    X = sparse.hstack(blocks, format="csr") if blocks else \
+        sparse.csr_matrix((rows.sum(), 0))
+    categorical = any(i.type == "categorical"
+                      for i in info.factor_infos.values())
+    return X, list(info.column_names), rows, categorical
+
+
+def _side(termlist, data, eval_env, cache):
+    if cache is None:
+        return _build(termlist, data, eval_env)
+    key = _key(termlist, data, eval_env)
+    if key is None:
+        return _build(termlist, data, eval_env)
+    built = cache.get(key)
+    if built is None:
+        built = _build(termlist, data, eval_env)
+        X, _, rows, _ = built
+        cache.put(key, built, X.data.nbytes + X.indices.nbytes
+                  + X.indptr.nbytes + rows.nbytes)
+    return built
+
+
+def design(formula, data, eval_env=0, cache=design_cache):
+    """Build the ``Design`` of ``formula`` on ``data``.
+
+    Rows with a missing value in any term are dropped, as patsy does. A
+    formula without ``~`` is a right-hand side only, and ``y`` is None.
+
+    The two sides are built separately and memoized in ``cache`` (a
+    ``DesignCache``; None disables it), so formulas that only change the
+    outcome, ``var + " ~ 1 + assettreat + C(block13)"``, build the
+    right-hand side once. Returned arrays are shared with the cache and
+    must not be modified in place.
+    """
+    eval_env = patsy.EvalEnvironment.capture(eval_env, reference=1)
+    with span("design"):
+        desc = _parse(formula)
+        X, names, rows, categorical = _side(desc.rhs_termlist, data,
+                                            eval_env, cache)
+        y = y_name = None
+        if desc.lhs_termlist:
+            Y, y_names, y_rows, _ = _side(desc.lhs_termlist, data,
+                                          eval_env, cache)
+            both = rows & y_rows
+            if not both.all():
+                X = X[both[rows]]
+                Y = Y[both[y_rows]]
+            rows = both
+            y, y_name = Y[:, 0].toarray()[:, 0], y_names[0]
+    return Design(y, X, names, rows, categorical, y_name)
+
+
+def _column(data, value, rows):
+    if value is None:
+        return None
+    if isinstance(value, str) or (isinstance(value, list)
+                                  and all(isinstance(v, str)
+                                          for v in value)):
+        value = data[value]
+    return covariance.take_rows(value.reset_index(drop=True)
+                                if isinstance(value, pd.DataFrame)
+                                else value, rows)
+
+
+def ols(formula, data, weights=None, cov_type="nonrobust", groups=None,
+        solver="normal", params=None):
+    """Fit ``formula`` by (weighted) least squares, like
+    ``smf.ols(formula, data).fit(cov_type=...)``.
+
+    ``weights`` and ``groups`` (cluster labels; a list of two names for
+    two-way clustering) are column names or arrays aligned with ``data``.
+    Designs with categorical terms are solved sparsely:
+    ``solver="normal"`` factorizes the sparse ``X'X`` with a sparse LU;
+    ``solver="lsqr"`` never forms ``X'X`` and solves by LSQR (and
+    conjugate gradients for the covariance). ``params`` restricts the
+    returned coefficients and covariance to the named columns, so that
+    thousands of fixed-effect levels never need a dense covariance matrix.
+    """
+    covariance.check_cov_type(cov_type, groups)
+    if solver not in SOLVERS:
+        raise ValueError("solver must be one of %s, got %r"
+                         % (SOLVERS, solver))
+    d = design(formula, data, eval_env=1)
+    w = _column(data, weights, d.rows)
+    g = _column(data, groups, d.rows)
+    keep = np.ones(len(d.y), dtype=bool)
+    if w is not None:
+        keep &= ~np.isnan(w)
+    if g is not None:
+        keep &= ~covariance.missing_groups(g)
+    y, X = d.y[keep], d.X[keep]
+    w = None if w is None else w[keep]
+    g = None if g is None else covariance.take_rows(g, keep)
+
+    if not d.categorical:
+        result = regression.ols(y, pd.DataFrame(X.toarray(),
+                                                columns=d.names),
+                                weights=w, cov_type=cov_type, groups=g)
+        if params is not None:
+            result = Result(result.params[params],
+                            result.cov_params().loc[params, params],
+                            result.nobs, result.df_resid, cov_type,
+                            result.ssr, result.centered_tss,
+                            result.uncentered_tss, result.k_constant)
+    else:
+        result = _sparse_ols(y, X, d.names, w, cov_type, g, solver, params)
+    result.info["dependent"] = d.y_name
+    return result
+
+
+def sparse_solve(X, y, weights=None, columns=None):
+    """``regression.solve`` for a sparse ``X``: (beta, bread, resid) from
+    a sparse LU factorization of ``X'WX``.
+
+    ``bread`` holds the columns ``columns`` (default: all) of
+    ``(X'WX)^-1``. ``y`` may be a matrix, in which case every column is
+    solved against the same factorization.
+    """
+    k = X.shape[1]
+    if weights is None:
+        Xw, yw = X, y
+    else:
+        sw = np.sqrt(weights)
+        Xw = sparse.diags(sw) @ X
+        yw = y * (sw[:, None] if y.ndim == 2 else sw)
+    columns = np.arange(k) if columns is None else np.asarray(columns)
+    unit = np.zeros((k, len(columns)))
+    unit[columns, np.arange(len(columns))] = 1
+    lu = splinalg.splu((Xw.T @ Xw).tocsc())
+    beta = lu.solve(Xw.T @ yw)
+    return beta, lu.solve(unit), y - X @ beta
+
+
+def _sparse_ols(y, X, names, weights, cov_type, groups, solver, params):
+    n, k = X.shape
+    selected = (np.arange(k) if params is None
+                else np.array([names.index(p) for p in params]))
+
+    if solver == "normal":
+        # Rows of (X'WX)^-1 for the selected coefficients only
+        beta, bread, resid = sparse_solve(X, y, weights, selected)
+    else:
+        if weights is None:
+            Xw, yw = X, y
+        else:
+            sw = np.sqrt(weights)
+            Xw, yw = sparse.diags(sw) @ X, y * sw
+        unit = np.zeros((k, len(selected)))
+        unit[selected, np.arange(len(selected))] = 1
+        beta = splinalg.lsqr(Xw, yw, atol=1e-12, btol=1e-12)[0]
+        xtx = splinalg.LinearOperator((k, k), dtype=float,
+                                      matvec=lambda v: Xw.T @ (Xw @ v))
+        bread = np.column_stack([
+            splinalg.cg(xtx, unit[:, j], rtol=1e-12)[0]
+            for j in range(len(selected))])
+        resid = y - X @ beta
+
+    w = np.ones(n) if weights is None else weights
+    ssr = w @ resid**2
+    if cov_type == "nonrobust":
+        cov = bread[selected] * ssr / (n - k)
+    else:
+        # Scores projected on the selected coefficients: n x s
+        influence = (X @ bread) * (resid * w)[:, None]
+        cov = covariance.robust_cov(influence, None, cov_type, groups, k)
+    ybar = (w @ y) / w.sum()
+    return Result(pd.Series(beta[selected], [names[i] for i in selected]),
+                  cov, nobs=n, df_resid=n - k, cov_type=cov_type, ssr=ssr,
+                  centered_tss=w @ (y - ybar)**2, uncentered_tss=w @ y**2,
+                  k_constant=regression.k_constant(
+                      X, bread if params is None else None, weights))
@@ -0,0 +1,204 @@
+"""Fuzzy regression discontinuity over a grid of bandwidths and kernels.
+
+Chapter 4 keeps the municipalities within 5 km of the language border
+(``df5 = df[df['Border_Distance_in_Km'] >= -5]`` ...) and runs one
+``IV2SLS`` of ``Preference_for_Leisure`` on ``Share_of_Protestants``
+instrumented by ``vaud``. Checking the estimate at other distances, with
+another kernel or for other outcomes means filtering and refitting again.
+
+``FuzzyRD`` sorts the rows once by distance to the cutoff, so every window
+``|x - cutoff| <= h`` is a prefix. Moving to a wider bandwidth only adds
+the rows entering the window to running sums of ``v v'`` for
+``v = [exog, instrument, treatment, outcomes]``; the triangular kernel
+``1 - |x|/h`` only needs the same sums weighted by ``|x|``, and the
+heteroskedasticity-robust covariances the fourth moments of ``v``. At each
+bandwidth the first stage, the reduced forms and the Wald (2SLS)
+estimates of all outcomes follow from these sums::
+
+    rd = FuzzyRD(df[['Preference_for_Leisure']], df['Share_of_Protestants'],
+                 df['Border_Distance_in_Km'], instrument=df['vaud'],
+                 controls=df[['t_dist']])
+    rd.sweep(np.arange(1, 26), kernels=('uniform', 'triangular'))
+
+With a uniform kernel the estimates are those of ``IV2SLS`` on the
+truncated data with ``1 + x + controls`` as exogenous regressors.
+"""
+
+import numpy as np
+import pandas as pd
+from scipy import linalg
+
+from causal_methods.rd import COV_TYPES, KERNELS
+
+
+def _names(values, default):
+    # ``default`` is a name, or a pattern such as "z%d" numbered by column
+    def name(i):
+        return default % i if "%d" in default else default
+
+    if isinstance(values, pd.DataFrame):
+        return list(values.columns)
+    if isinstance(values, pd.Series):
+        return [values.name or name(0)]
+    values = np.asarray(values)
+    return [name(i) for i in range(1 if values.ndim == 1
+                                   else values.shape[1])]
+
+
+def _columns(values):
+    values = np.asarray(values, dtype=float)
+    return values[:, None] if values.ndim == 1 else values
+
+
+class FuzzyRD:
+    """Outcomes, treatment and running variable sorted by distance to the
+    cutoff.
+
+    ``y`` holds one or more outcomes. ``instrument`` defaults to the
+    indicator of ``running >= cutoff``. The exogenous regressors are a
+    constant, the centered running variable (and its interaction with the
+    side of the cutoff with ``slopes="separate"``) and ``controls``. Rows
+    with a missing value are dropped.
+    """
+
+    def __init__(self, y, treatment, running, cutoff=0.0, instrument=None,
+                 controls=None, slopes="common"):
+        if slopes not in ("common", "separate"):
+            raise ValueError("slopes must be 'common' or 'separate', got %r"
+                             % slopes)
+        self.outcomes = _names(y, "y%d")
+        self.cutoff = cutoff
+        x = np.asarray(running, dtype=float) - cutoff
+        right = (x >= 0).astype(float)
+        z = right if instrument is None else np.asarray(instrument,
+                                                        dtype=float)
+        exog = [np.ones(len(x)), x] + [right * x] * (slopes == "separate")
+        self.exog_names = ["Intercept", _names(running, "running")[0]] \
+            + ["right:" + _names(running, "running")[0]] \
+            * (slopes == "separate")
+        if controls is not None:
+            exog.append(_columns(controls))
+            self.exog_names += _names(controls, "z%d")
+        V = np.column_stack(exog + [z, np.asarray(treatment, dtype=float),
+                                    _columns(y)])
+        keep = ~(np.isnan(V).any(axis=1) | np.isnan(x))
+        V, x = V[keep], x[keep]
+        order = np.argsort(np.abs(x), kind="stable")
+        self.V = V[order]
+        self.dist = np.abs(x[order])
+        self.n_right = np.concatenate([[0], np.cumsum(x[order] >= 0)])
+        self.k = len(self.exog_names)
+
+    def _estimate(self, S, F, nobs, cov_type):
+        # First stage, reduced forms and 2SLS of every outcome from the
+        # weighted sums S = sum w v v' and F = sum w^2 (v x v)(v x v)'
+        k, p = self.k, len(S)
+        q = list(range(k + 1))
+        x = list(range(k)) + [k + 1]
+        ys = list(range(k + 2, p))
+        bread_q = linalg.inv(S[np.ix_(q, q)])
+        pi_d = bread_q @ S[q, k + 1]
+        pi_y = bread_q @ S[np.ix_(q, ys)]
+        proj = bread_q @ S[np.ix_(q, x)]
+        bread = linalg.inv(S[np.ix_(x, q)] @ proj)
+        beta = bread @ proj.T @ S[np.ix_(q, ys)]
+
+        def residual(columns, coef, target):
+            c = np.zeros(p)
+            c[target] = 1
+            c[columns] -= coef
+            return c
+
+        def variance(c, b, proj=None):
+            # Variance of the last coefficient, residuals v @ c
+            if cov_type == "nonrobust":
+                return b[-1, -1] * (c @ S @ c) / (nobs - len(b))
+            meat = np.einsum("abcd,c,d->ab", F[np.ix_(q, q)], c, c)
+            if proj is not None:
+                meat = proj.T @ meat @ proj
+            var = (b @ meat @ b)[-1, -1]
+            return var * nobs / (nobs - len(b)) if cov_type == "HC1" \
+                else var
+
+        rows = []
+        first = variance(residual(q, pi_d, k + 1), bread_q)
+        for j, target in enumerate(ys):
+            rows.append([
+                beta[-1, j],
+                np.sqrt(variance(residual(x, beta[:, j], target), bread,
+                                 proj)),
+                pi_d[-1], np.sqrt(first),
+                pi_y[-1, j],
+                np.sqrt(variance(residual(q, pi_y[:, j], target),
+                                 bread_q))])
+        return rows
+
+    def sweep(self, bandwidths, kernels=("uniform",), cov_type="HC1"):
+        """Fuzzy RD estimates at every bandwidth and kernel.
+
+        Returns a DataFrame indexed by (kernel, bandwidth, outcome) with
+        the Wald estimate ``tau`` and its standard error, the first-stage
+        jump of the treatment, the reduced-form jump of the outcome, and
+        the number of observations in the window. ``cov_type`` is one of
+        ``rd.COV_TYPES``. Windows too small to identify the model give NaN.
+        """
+        for kernel in kernels:
+            if kernel not in KERNELS:
+                raise ValueError("kernel must be one of %s, got %r"
+                                 % (KERNELS, kernel))
+        if cov_type not in COV_TYPES:
+            raise ValueError("cov_type must be one of %s, got %r"
+                             % (COV_TYPES, cov_type))
+        bandwidths = np.sort(np.asarray(bandwidths, dtype=float))
+        p = self.V.shape[1]
+        robust = cov_type != "nonrobust"
+        # Sums weighted by |x|**j: j < 2 for the cross products, j < 3 for
+        # the fourth moments (the squared triangular weight)
+        cross = np.zeros((2, p, p))
+        fourth = np.zeros((3 if robust else 0, p * p, p * p))
+        done = 0
+        records = []
+        for h in bandwidths:
+            n = int(np.searchsorted(self.dist, h, "right"))
+            V, d = self.V[done:n], self.dist[done:n]
+            done = n
+            cross += [V.T @ V, (V * d[:, None]).T @ V]
+            if robust:
+                outer = (V[:, :, None] * V[:, None, :]).reshape(len(V), -1)
+                for j in range(3):
+                    fourth[j] += (outer * d[:, None]**j).T @ outer
+            n_right = int(self.n_right[n])
+            for kernel in kernels:
+                if kernel == "uniform":
+                    S = cross[0]
+                    F = fourth[0] if robust else None
+                else:
+                    S = cross[0] - cross[1] / h
+                    F = (fourth[0] - 2 * fourth[1] / h + fourth[2] / h**2
+                         if robust else None)
+                if F is not None:
+                    F = F.reshape(p, p, p, p)
+                try:
+                    if n <= self.k + 1:
+                        raise linalg.LinAlgError
+                    rows = self._estimate(S, F, n, cov_type)
+                except linalg.LinAlgError:
+                    rows = [[np.nan] * 6 for _ in self.outcomes]
+                for outcome, row in zip(self.outcomes, rows):
+                    records.append([kernel, h, outcome] + row
+                                   + [n, n - n_right, n_right])
+        table = pd.DataFrame(records, columns=[
+            "kernel", "bandwidth", "outcome", "tau", "se", "first_stage",
+            "first_stage_se", "reduced_form", "reduced_form_se", "n",
+            "n_left", "n_right"])
+        return table.set_index(["kernel", "bandwidth", "outcome"]) \
+            .sort_index()
+
+
+def fuzzy_rd(y, treatment, running, cutoff=0.0, bandwidths=(np.inf,),
+             kernels=("uniform",), instrument=None, controls=None,
+             slopes="common", cov_type="HC1"):
+    """Fuzzy RD estimates over a grid of bandwidths and kernels; see
+    ``FuzzyRD.sweep``."""
+    return FuzzyRD(y, treatment, running, cutoff, instrument, controls,
+                   slopes).sweep(bandwidths, kernels, cov_type)
@@ -0,0 +1,267 @@
+"""Grids of regression specifications, fitted by shared design.
+
+Chapters 6 and 7 fit each table with a loop such as::
+
+    result2 = []
+    for data in sample:
+       ols = smf.ols(model2, data).fit(cov_type='HC1')
+       result2.append(ols)
+
+and pass the list to ``Stargazer``. ``SpecificationGrid`` declares the
+whole grid at once, outcomes x regressor sets x subsamples x covariance
+types, and ``run`` returns one ``Result`` per specification::
+
+    grid = SpecificationGrid(
+        'callback',
+        {'model1': 'female + C(type)', 'model2': 'female*C(type)'},
+        subsamples={'Indian': "name_ethnicity in ['Canada', 'Indian']",
+                    'Greek': "name_ethnicity in ['Canada', 'Greek']"},
+        cov_types=['HC1'])
+    results = grid.run(df2)
+    Stargazer(list(results.xs('model2', level='regressors')))
+
+All specifications with the same regressors and subsample share one
+design matrix: it is built once (``formula.design``; it stays sparse when
+it has categorical terms), factorized once, and every outcome with the
+same missing rows is solved against that factorization, with every
+covariance type computed from the same fit.
+The (regressors, subsample) groups are independent and can run in a
+process pool; the data are sent to each worker once.
+"""
+
+import importlib
+import itertools
+import types
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import patsy
+
+from causal_methods import covariance
+from causal_methods.covariance import check_cov_type
+from causal_methods.formula import _names, _parse, design, sparse_solve
+from causal_methods.regression import k_constant, sandwich, solve
+from causal_methods.results import Result
+
+LEVELS = ["outcome", "regressors", "subsample", "cov_type"]
+
+# Data, subsample masks and formula namespace of the worker processes
+_shared = {}
+
+
+def _as_dict(values, name):
+    if values is None:
+        return {name: None}
+    if isinstance(values, dict):
+        return dict(values)
+    if isinstance(values, str):
+        values = [values]
+    return {value: value for value in values}
+
+
+def _fit_group(data, rhs, eval_env, outcomes, cov_types, weights, groups):
+    # Every outcome and covariance type on the design of ``rhs``. Designs
+    # with categorical terms stay sparse and are solved as in
+    # ``formula.ols``, by a sparse LU of X'WX
+    d = design(rhs, data, eval_env=eval_env)
+    X = d.X if d.categorical else d.X.toarray()
+    Y = data[outcomes].to_numpy(float)[d.rows]
+    keep = np.ones(X.shape[0], dtype=bool)
+    w = g = None
+    if weights is not None:
+        w = data[weights].to_numpy(float)[d.rows]
+        keep &= ~np.isnan(w)
+    if groups is not None:
+        g = covariance.take_rows(data[groups].reset_index(drop=True),
+                                 d.rows)
+        keep &= ~covariance.missing_groups(g)
+
+    results = {}
+    # Outcomes missing on the same rows share one factorization
+    missing = np.isnan(Y)
+    patterns = {}
+    for j in range(Y.shape[1]):
+        patterns.setdefault(np.packbits(missing[:, j]).tobytes(),
+                            []).append(j)
+    for columns in patterns.values():
+        rows = keep & ~missing[:, columns[0]]
+        Xp, Yp = X[rows], Y[rows][:, columns]
+        wp = None if w is None else w[rows]
+        gp = None if g is None else covariance.take_rows(g, rows)
+        if d.categorical:
+            beta, bread, resid = sparse_solve(Xp, Yp, wp)
+        else:
+            beta, bread, resid = solve(Xp, Yp, wp)
+        # X (X'WX)^-1 of a sparse design, shared by the robust
+        # covariances of every outcome
+        projected = None
+        n, k = Xp.shape
+        weight = np.ones(n) if wp is None else wp
+        constant = k_constant(Xp, bread, wp)
+        for j, column in enumerate(columns):
+            ssr = weight @ resid[:, j]**2
+            ybar = (weight @ Yp[:, j]) / weight.sum()
+            centered_tss = weight @ (Yp[:, j] - ybar)**2
+            for cov_type in cov_types:
+                if cov_type == "nonrobust":
+                    cov = bread * ssr / (n - k)
+                elif d.categorical:
+                    if projected is None:
+                        projected = Xp @ bread
+                    cov = covariance.robust_cov(
+                        projected * (resid[:, j] * weight)[:, None], None,
+                        cov_type, gp, k)
+                else:
+                    cov = sandwich(Xp, resid[:, j], bread, wp, cov_type,
+                                   gp)
+                results[outcomes[column], cov_type] = Result(
+                    pd.Series(beta[:, j], d.names), cov, nobs=n,
+                    df_resid=n - k, cov_type=cov_type, ssr=ssr,
+                    centered_tss=centered_tss,
+                    uncentered_tss=weight @ Yp[:, j]**2,
+                    k_constant=constant, dependent=outcomes[column])
+    return results
+
+
+def _namespace(formulas, data, eval_env):
+    # The names the formulas take from ``eval_env``, which does not
+    # pickle, for the worker processes: modules by name, other values
+    # as they are (and so they must pickle)
+    names = set()
+    for rhs in formulas:
+        for term in _parse(rhs).rhs_termlist:
+            for factor in term.factors:
+                names |= _names(factor.code)[0]
+    modules, values = {}, {}
+    for name in names - set(data.columns):
+        if name in eval_env.namespace:
+            value = eval_env.namespace[name]
+            if isinstance(value, types.ModuleType):
+                modules[name] = value.__name__
+            else:
+                values[name] = value
+    return modules, values
+
+
+def _initialize(data, masks, namespace):
+    modules, values = namespace
+    values = dict(values)
+    for name, module in modules.items():
+        values[name] = importlib.import_module(module)
+    _shared["data"] = data
+    _shared["masks"] = masks
+    _shared["eval_env"] = patsy.EvalEnvironment([values])
+
+
+def _fit_shared(rhs, subsample, outcomes, cov_types, weights, groups):
+    data, mask = _shared["data"], _shared["masks"][subsample]
+    return _fit_group(data if mask is None else data[mask], rhs,
+                      _shared["eval_env"], outcomes, cov_types, weights,
+                      groups)
+
+
+class SpecificationGrid:
+    """Outcomes x regressor sets x subsamples x covariance types.
+
+    ``outcomes`` is a column name or a list of them. ``regressors`` maps
+    names to right-hand sides of patsy formulas (``'female*C(type)'``); a
+    list of right-hand sides is named by the formulas themselves.
+    ``subsamples`` maps names to boolean masks aligned with the data or to
+    ``DataFrame.eval`` expressions; by default the whole data (``'all'``).
+    ``cov_types`` are ``covariance.COV_TYPES``; ``weights`` and ``groups``
+    (for ``"cluster"``; a list of two names for two-way clustering) are
+    column names. Rows with missing values are dropped specification by
+    specification, as ``smf.ols`` does.
+    """
+
+    def __init__(self, outcomes, regressors, subsamples=None,
+                 cov_types=("nonrobust",), weights=None, groups=None):
+        self.outcomes = [outcomes] if isinstance(outcomes, str) \
+            else list(outcomes)
+        self.regressors = _as_dict(regressors, None)
+        self.subsamples = _as_dict(subsamples, "all")
+        self.cov_types = [cov_types] if isinstance(cov_types, str) \
+            else list(cov_types)
+        for cov_type in self.cov_types:
+            check_cov_type(cov_type, groups)
+        self.weights = weights
+        self.groups = groups
+
+    def __len__(self):
+        return len(self.outcomes) * len(self.regressors) \
+            * len(self.subsamples) * len(self.cov_types)
+
+    def specifications(self):
+        """The MultiIndex of all specifications, in the order of
+        ``run``."""
+        return pd.MultiIndex.from_tuples(
+            itertools.product(self.outcomes, self.regressors,
+                              self.subsamples, self.cov_types),
+            names=LEVELS)
+
+    def _masks(self, data):
+        masks = {}
+        for name, subsample in self.subsamples.items():
+            if subsample is None:
+                masks[name] = None
+            elif isinstance(subsample, str):
+                masks[name] = data.eval(subsample).to_numpy(bool)
+            else:
+                masks[name] = np.asarray(subsample, dtype=bool)
+        return masks
+
+    def run(self, data, workers=None, eval_env=0):
+        """Fit every specification on ``data``: a Series of ``Result``
+        indexed by (outcome, regressors, subsample, cov_type).
+
+        Names in the formulas that are not columns of ``data`` are looked
+        up in the caller's namespace (``eval_env`` as in
+        ``formula.design``). With ``workers``, the (regressors, subsample)
+        groups are fitted in a process pool; the values of those names
+        are then sent to the workers, and modules are imported there.
+        """
+        eval_env = patsy.EvalEnvironment.capture(eval_env, reference=1)
+        masks = self._masks(data)
+        groups = list(itertools.product(self.regressors, self.subsamples))
+        args = [self.outcomes, self.cov_types, self.weights, self.groups]
+        if workers is None or workers <= 1:
+            fitted = [_fit_group(data if masks[s] is None
+                                 else data[masks[s]],
+                                 self.regressors[r], eval_env, *args)
+                      for r, s in groups]
+        else:
+            namespace = _namespace(self.regressors.values(), data,
+                                   eval_env)
+            with ProcessPoolExecutor(max_workers=workers,
+                                     initializer=_initialize,
+                                     initargs=(data, masks,
+                                               namespace)) as pool:
+                fitted = list(pool.map(
+                    _fit_shared, [self.regressors[r] for r, _ in groups],
+                    [s for _, s in groups],
+                    *[[arg] * len(groups) for arg in args],
+                    chunksize=max(1, len(groups) // (4 * workers))))
+        results = {}
+        for (r, s), group in zip(groups, fitted):
+            for (outcome, cov_type), result in group.items():
+                results[outcome, r, s, cov_type] = result
+        index = self.specifications()
+        return pd.Series([results[key] for key in index], index=index,
+                         dtype=object)
+
+
+def coefficients(results, param):
+    """Estimate, standard error, p-value and number of observations of
+    ``param`` in every specification of ``results`` (as returned by
+    ``SpecificationGrid.run``), e.g. for a specification curve.
+    Specifications without ``param`` give NaN."""
+    rows = []
+    for result in results:
+        if param in result.params.index:
+            rows.append([result.params[param], result.bse[param],
+                         result.pvalues[param], result.nobs])
+        else:
+            rows.append([np.nan, np.nan, np.nan, result.nobs])
+    return pd.DataFrame(rows, index=results.index,
+                        columns=["coef", "std err", "p-value", "nobs"])
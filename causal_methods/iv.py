@@ -0,0 +1,285 @@
+"""Two-stage least squares with one shared factorization.
+
+Chapter 4 fits ``IV2SLS.from_formula('Preference_for_Leisure ~ 1 +
+Border_Distance_in_Km + t_dist + [Share_of_Protestants ~ vaud]', df5)`` and
+then the reduced form with another ``IV2SLS``; chapter 9 runs the first
+stage and a control-function regression by hand. Each fit rebuilds and
+refactorizes the same instrument matrix.
+
+``IV`` factorizes the instruments ``Z = [exog, instruments]`` once (QR).
+The first stage, the reduced form, the weak-instrument diagnostics and the
+second stage all reuse it: the fitted regressors are ``Q Q'X`` and the
+second stage only factorizes the small ``Q'X``. Any number of outcomes is
+estimated with one matrix product::
+
+    exog = df5[['Border_Distance_in_Km', 't_dist']].assign(const=1)
+    model = IV(exog, df5['Share_of_Protestants'], df5['vaud'])
+    model.fit(df5[['Preference_for_Leisure', 'other_outcome']],
+              cov_type='HC0')
+    model.reduced_form(df5['Preference_for_Leisure'], cov_type='HC0')
+    model.weak_instruments()
+
+    iv_formula('Preference_for_Leisure ~ 1 + Border_Distance_in_Km + '
+               't_dist + [Share_of_Protestants ~ vaud]', df5)
+
+``cov_type="HC0"`` is linearmodels' ``"robust"``. The classical covariance
+divides by ``n - k`` like statsmodels (linearmodels' ``"unadjusted"``
+divides by ``n``).
+"""
+
+import re
+
+import numpy as np
+import pandas as pd
+from scipy import linalg, stats
+
+from causal_methods import covariance
+from causal_methods.covariance import check_cov_type
+from causal_methods.formula import design
+from causal_methods.regression import column_names, k_constant, ols
+from causal_methods.results import Result
+
+
+def _matrix(values, default):
+    if values is None:
+        return np.zeros((0, 0)), []
+    if isinstance(values, pd.Series) and values.name is not None:
+        names = [values.name]
+    else:
+        names = column_names(values, default)
+    values = np.asarray(values, dtype=float)
+    return (values[:, None] if values.ndim == 1 else values), names
+
+
+class IV:
+    """Instrumental-variables design: regressors ``exog`` and ``endog``,
+    excluded ``instruments``.
+
+    Arrays, Series or DataFrames aligned on the same rows; ``exog`` should
+    include the constant. Rows with a missing value in any of them (or in
+    ``weights``) are dropped; ``rows`` is the mask of the rows kept, which
+    outcomes passed to the methods are subset with.
+    """
+
+    def __init__(self, exog, endog, instruments, weights=None):
+        endog, self.endog_names = _matrix(endog, "endog%d")
+        instruments, self.instrument_names = _matrix(instruments,
+                                                     "instrument%d")
+        n = len(endog)
+        if exog is None:
+            exog, self.exog_names = np.zeros((n, 0)), []
+        else:
+            exog, self.exog_names = _matrix(exog, "x%d")
+        if instruments.shape[1] < endog.shape[1]:
+            raise ValueError("need at least as many instruments as "
+                             "endogenous regressors")
+        self.names = self.exog_names + self.endog_names
+        keep = ~np.isnan(np.column_stack([exog, endog, instruments])
+                         ).any(axis=1)
+        if weights is not None:
+            weights = np.asarray(weights, dtype=float)
+            keep &= ~np.isnan(weights)
+            weights = weights[keep]
+        self.rows = keep
+        self.weights = weights
+        exog, endog, instruments = exog[keep], endog[keep], \
+            instruments[keep]
+        self.nobs = len(endog)
+        self.sw = np.ones(self.nobs) if weights is None else np.sqrt(weights)
+
+        Z = np.column_stack([exog, instruments]) * self.sw[:, None]
+        self.X = np.column_stack([exog, endog]) * self.sw[:, None]
+        self.k_exog = exog.shape[1]
+        self.q, self.r = linalg.qr(Z, mode="economic")
+        if (np.abs(np.diag(self.r)) < 1e-10 * np.abs(self.r).max()).any():
+            raise ValueError("the instruments are collinear")
+        self.qx = self.q.T @ self.X
+        # Second stage: Xhat = Q (Q'X), so Xhat'Xhat = (Q'X)'(Q'X)
+        self.q2, self.r2 = linalg.qr(self.qx, mode="economic")
+        if (np.abs(np.diag(self.r2))
+                < 1e-10 * np.abs(self.r2).max()).any():
+            raise ValueError("the model is not identified")
+        self.xhat = self.q @ self.qx
+        X = self.X / self.sw[:, None]
+        self.k_constant = k_constant(X, linalg.inv(self.X.T @ self.X),
+                                     weights)
+
+    def _outcomes(self, y):
+        names = ([y.name or "y"] if isinstance(y, pd.Series)
+                 else column_names(y, "y%d"))
+        y = np.asarray(y, dtype=float)
+        y = (y[:, None] if y.ndim == 1 else y)[self.rows]
+        if np.isnan(y).any():
+            raise ValueError("outcomes have missing values in the "
+                             "estimation sample")
+        return y * self.sw[:, None], names
+
+    def _result(self, beta, bread, regressors, resid, y, names, cov_type,
+                groups, **info):
+        # resid, y: transformed by sqrt(weights)
+        n, k = regressors.shape
+        ssr = resid @ resid
+        w = self.sw**2
+        ybar = (self.sw @ y) / w.sum()
+        centered_tss = w @ (y / self.sw - ybar)**2
+        uncentered_tss = y @ y
+        if cov_type == "nonrobust":
+            cov = bread * ssr / (n - k)
+        else:
+            cov = covariance.robust_cov(regressors * resid[:, None], bread,
+                                        cov_type, groups)
+        return Result(pd.Series(beta, names), cov, nobs=n, df_resid=n - k,
+                      cov_type=cov_type, ssr=ssr,
+                      centered_tss=centered_tss,
+                      uncentered_tss=uncentered_tss,
+                      k_constant=self.k_constant, **info)
+
+    def _groups(self, groups):
+        return None if groups is None else covariance.take_rows(
+            groups.reset_index(drop=True)
+            if isinstance(groups, pd.DataFrame) else groups, self.rows)
+
+    def _bread(self, r):
+        r_inv = linalg.solve_triangular(r, np.eye(r.shape[0]))
+        return r_inv @ r_inv.T
+
+    def fit(self, y, cov_type="nonrobust", groups=None):
+        """2SLS of each column of ``y``: a ``Result``, or a list of them
+        when ``y`` has several columns."""
+        check_cov_type(cov_type, groups)
+        y, names = self._outcomes(y)
+        groups = self._groups(groups)
+        beta = linalg.solve_triangular(self.r2,
+                                       self.q2.T @ (self.q.T @ y))
+        resid = y - self.X @ beta
+        bread = self._bread(self.r2)
+        results = [self._result(beta[:, j], bread, self.xhat, resid[:, j],
+                                y[:, j], self.names, cov_type, groups,
+                                dependent=name)
+                   for j, name in enumerate(names)]
+        return results[0] if len(results) == 1 else results
+
+    def _project(self, y, names, cov_type, groups):
+        # Regressions on the instruments, one per column of y
+        beta = linalg.solve_triangular(self.r, self.q.T @ y)
+        resid = y - self.q @ (self.q.T @ y)
+        Z = self.q @ self.r
+        bread = self._bread(self.r)
+        return [self._result(beta[:, j], bread, Z, resid[:, j], y[:, j],
+                             self.exog_names + self.instrument_names,
+                             cov_type, groups, dependent=name)
+                for j, name in enumerate(names)]
+
+    def reduced_form(self, y, cov_type="nonrobust", groups=None):
+        """OLS of each column of ``y`` on the exogenous regressors and the
+        instruments."""
+        check_cov_type(cov_type, groups)
+        y, names = self._outcomes(y)
+        results = self._project(y, names, cov_type, self._groups(groups))
+        return results[0] if len(results) == 1 else results
+
+    def first_stage(self, cov_type="nonrobust", groups=None):
+        """OLS of each endogenous regressor on the instruments: a list of
+        ``Result``."""
+        check_cov_type(cov_type, groups)
+        endog = self.X[:, self.k_exog:]
+        return self._project(endog, self.endog_names, cov_type,
+                             self._groups(groups))
+
+    def weak_instruments(self, cov_type="nonrobust", groups=None):
+        """Partial R-squared and F-statistic of the excluded instruments
+        in each first stage.
+
+        With a robust ``cov_type`` the F-statistic is the robust Wald
+        statistic divided by the number of instruments, and its p-value
+        is from the chi-squared distribution.
+        """
+        check_cov_type(cov_type, groups)
+        endog = self.X[:, self.k_exog:]
+        n, kz = self.q.shape
+        m = kz - self.k_exog
+        projected = self.q.T @ endog
+        ssr_full = (endog**2).sum(axis=0) - (projected**2).sum(axis=0)
+        ssr_exog = ssr_full + (projected[self.k_exog:]**2).sum(axis=0)
+        partial = (ssr_exog - ssr_full) / ssr_exog
+        if cov_type == "nonrobust":
+            f = (ssr_exog - ssr_full) / m / (ssr_full / (n - kz))
+            pvalue = stats.f.sf(f, m, n - kz)
+        else:
+            excluded = self.instrument_names
+            f = np.array([
+                result.params[excluded]
+                @ np.linalg.solve(result.cov_params().loc[excluded,
+                                                          excluded],
+                                  result.params[excluded]) / m
+                for result in self.first_stage(cov_type, groups)])
+            pvalue = stats.chi2.sf(f * m, m)
+        return pd.DataFrame({"partial R2": partial, "F": f,
+                             "p-value": pvalue}, index=self.endog_names)
+
+    def control_function(self, y, cov_type="nonrobust", groups=None):
+        """OLS of ``y`` on the regressors and the first-stage residuals,
+        as in chapter 9. The coefficients of the regressors equal 2SLS;
+        the standard errors ignore that the residuals are estimated."""
+        y, names = self._outcomes(y)
+        groups = self._groups(groups)
+        endog = self.X[:, self.k_exog:]
+        resid = endog - self.q @ (self.q.T @ endog)
+        design = pd.DataFrame(
+            np.column_stack([self.X, resid]) / self.sw[:, None],
+            columns=self.names + ["resid_%s" % e for e in self.endog_names])
+        results = [ols(y[:, j] / self.sw, design, weights=self.weights,
+                       cov_type=cov_type, groups=groups)
+                   for j in range(len(names))]
+        return results[0] if len(results) == 1 else results
+
+
+def iv2sls(y, exog, endog, instruments, weights=None, cov_type="nonrobust",
+           groups=None):
+    """2SLS of ``y`` on ``exog`` and ``endog`` instrumented by
+    ``instruments``; see ``IV``."""
+    return IV(exog, endog, instruments, weights).fit(y, cov_type, groups)
+
+
+def iv_formula(formula, data, weights=None, cov_type="nonrobust",
+               groups=None):
+    """2SLS from a linearmodels formula, ``y ~ exog + [endog ~ instr]``.
+
+    As in linearmodels, the constant must be written explicitly (``1 +``).
+    ``weights`` and ``groups`` are column names or arrays aligned with
+    ``data``; rows with a missing value in any variable are dropped.
+    """
+    match = re.search(r"\[([^\]~]+)~([^\]]+)\]", formula)
+    if match is None:
+        raise ValueError("formula must contain [endog ~ instruments], "
+                         "got %r" % formula)
+    lhs, rhs = (formula[:match.start()] + formula[match.end():]).split("~")
+    rhs = "+".join(t for t in rhs.split("+") if t.strip())
+    # Built through formula.design, so the right-hand sides are cached
+    # across outcomes
+    designs = [design(lhs + "~ 0 + " + (rhs or "0"), data, eval_env=1)]
+    designs += [design("0 + " + part, data, eval_env=1)
+                for part in match.groups()]
+    keep = np.logical_and.reduce([d.rows for d in designs])
+    exog, endog, instruments = [
+        pd.DataFrame(d.X[keep[d.rows]].toarray(), columns=d.names)
+        for d in designs]
+    y = pd.Series(designs[0].y[keep[designs[0].rows]],
+                  name=designs[0].y_name)
+    if isinstance(weights, str):
+        weights = data[weights]
+    if isinstance(groups, (str, list)):
+        groups = data[groups]
+    if groups is not None:
+        groups = covariance.take_rows(
+            groups.reset_index(drop=True)
+            if isinstance(groups, pd.DataFrame) else groups, keep)
+        present = ~covariance.missing_groups(groups)
+        groups = covariance.take_rows(groups, present)
+    else:
+        present = np.ones(len(y), dtype=bool)
+    if weights is not None:
+        weights = np.asarray(weights, dtype=float)[keep][present]
+    model = IV(exog[present] if exog.shape[1] else None, endog[present],
+               instruments[present], weights)
+    return model.fit(y[present], cov_type, groups)
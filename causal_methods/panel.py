@@ -0,0 +1,163 @@
+"""Panel regressions and difference-in-differences with absorbed effects.
+
+Chapter 5 sets a ``(firmid, censusyear)`` MultiIndex, builds
+``louis_1931 = st_louis_fed * year_1931`` by hand and fits
+``PanelOLS(Y, df[dd], entity_effects=True)`` with standard errors
+clustered by firm. ``panel_ols`` fits the same models from integer codes
+of the entity and time (taken from the MultiIndex, or passed as arrays):
+entity, time or two-way effects, plus any other factor, are absorbed by
+group demeaning with ``np.bincount`` (see ``fixed_effects.Absorber``), so
+no dummy matrix and no MultiIndex group-by is ever built::
+
+    panel_ols(Y, df[dd], entity_effects=True, cluster='entity')
+    did(Y, df['st_louis_fed'], df['year_1931'], entity_effects=True)
+
+Coefficients match ``PanelOLS``. The clustered covariance is the CR1 of
+the rest of this package, ``G/(G-1) (n-1)/(n-k)``. As in Stata's ``xtreg,
+fe vce(cluster)``, effects nested within the (one-way) clusters, such as
+entity effects with errors clustered by entity, do not count in ``k``;
+``PanelOLS`` applies no correction by default.
+"""
+
+import numpy as np
+import pandas as pd
+
+from causal_methods import covariance
+from causal_methods.fixed_effects import absorbed_ols
+from causal_methods.regression import ols
+from causal_methods.results import Result
+
+CLUSTERS = ("entity", "time", "both")
+
+
+def panel_index(index):
+    """Integer codes of the entity and time levels of a MultiIndex."""
+    if not isinstance(index, pd.MultiIndex) or index.nlevels < 2:
+        raise ValueError("expected an (entity, time) MultiIndex")
+    return index.codes[0], index.codes[1]
+
+
+def panel_ols(y, X, entity=None, time=None, entity_effects=False,
+              time_effects=False, absorb=None, weights=None,
+              cov_type="cluster", cluster="entity"):
+    """Panel OLS of ``y`` on ``X`` with absorbed fixed effects.
+
+    ``entity`` and ``time`` are labels or integer codes aligned with ``y``;
+    by default they are the two levels of the MultiIndex of ``y``. They
+    are only needed for the effects and clusters that use them: without
+    either, the model is a pooled OLS.
+    ``absorb`` adds further factors (a Series, array or DataFrame).
+    With ``cov_type="cluster"``, ``cluster`` is ``"entity"``, ``"time"``,
+    ``"both"`` (two-way) or an array of cluster labels. Columns of ``X``
+    absorbed by the effects, such as the constant, are dropped and listed
+    in ``info['dropped']``.
+    """
+    # The entity and time codes are only needed by the effects and the
+    # clusters that use them; a pooled model takes any ``y``
+    clustered = cov_type == "cluster" and isinstance(cluster, str)
+    if clustered and cluster not in CLUSTERS:
+        raise ValueError("cluster must be one of %s or labels, got %r"
+                         % (CLUSTERS, cluster))
+    need_entity = entity_effects or (clustered and cluster != "time")
+    need_time = time_effects or (clustered and cluster != "entity")
+    if (need_entity and entity is None) or (need_time and time is None):
+        codes = panel_index(getattr(y, "index", None))
+        entity = codes[0] if entity is None else entity
+        time = codes[1] if time is None else time
+    y = np.asarray(y, dtype=float)
+    entity = None if entity is None else np.asarray(entity)
+    time = None if time is None else np.asarray(time)
+
+    groups = None
+    if clustered:
+        groups = {"entity": entity, "time": time}.get(cluster)
+        if cluster == "both":
+            groups = np.column_stack([entity, time])
+    elif cov_type == "cluster":
+        groups = cluster
+
+    factors = {}
+    if entity_effects:
+        factors["entity"] = entity
+    if time_effects:
+        factors["time"] = time
+    if absorb is not None:
+        extra = pd.DataFrame(absorb)
+        for i, column in enumerate(extra.columns):
+            factors["absorb%d" % i] = extra[column].to_numpy()
+    if not factors:
+        result = ols(y, X, weights=weights, cov_type=cov_type,
+                     groups=groups)
+    else:
+        factors = pd.DataFrame(factors)
+        result = absorbed_ols(y, X, factors, weights=weights,
+                              cov_type=cov_type, groups=groups)
+        nested = _nested_levels(y, X, factors, weights, groups)
+        if nested:
+            result = _exclude_nested(result, nested)
+    result.info.update(entity_effects=entity_effects,
+                       time_effects=time_effects)
+    return result
+
+
+def _nested_levels(y, X, factors, weights, groups):
+    # Number of levels, in the estimation sample, of the factors nested
+    # within one-way clusters (0 if none)
+    if groups is None or isinstance(groups, pd.DataFrame) \
+            or np.ndim(groups) != 1:
+        return 0
+    keep = ~(np.isnan(np.asarray(y, dtype=float))
+             | np.isnan(np.asarray(X, dtype=float).reshape(len(factors),
+                                                           -1)).any(axis=1)
+             | factors.isna().any(axis=1).to_numpy()
+             | covariance.missing_groups(groups))
+    if weights is not None:
+        keep &= ~np.isnan(np.asarray(weights, dtype=float))
+    clusters = pd.factorize(np.asarray(groups)[keep])[0]
+    levels = 0
+    for column in factors.columns:
+        codes = pd.factorize(factors[column].to_numpy()[keep])[0]
+        first = np.full(codes.max() + 1, -1)
+        first[codes] = clusters
+        if (first[codes] == clusters).all():
+            levels = max(levels, codes.max() + 1)
+    return levels
+
+
+def _exclude_nested(result, levels):
+    # Recompute the CR1 correction without the effects nested in the
+    # clusters (but still counting the constant they absorb)
+    n, df_resid = result.nobs, result.df_resid
+    df = min(df_resid + levels - 1, n - 1)
+    return Result(result.params, result.cov_params() * df_resid / df,
+                  nobs=n, df_resid=df, cov_type=result.cov_type,
+                  ssr=result.ssr, centered_tss=result.centered_tss,
+                  uncentered_tss=result.uncentered_tss,
+                  k_constant=result.k_constant,
+                  **result.info)
+
+
+def did(y, treated, post, entity=None, time=None, controls=None,
+        entity_effects=False, time_effects=False, absorb=None,
+        weights=None, cov_type="cluster", cluster="entity"):
+    """Difference-in-differences ``y ~ const + treated + post +
+    treated:post [+ controls]`` as a ``panel_ols``.
+
+    The effect is ``params['treated:post']`` (with the names of the
+    ``treated`` and ``post`` Series when they have one). Terms absorbed by
+    the effects (``treated`` under entity effects, ``post`` under time
+    effects) are dropped.
+    """
+    t_name = getattr(treated, "name", None) or "treated"
+    p_name = getattr(post, "name", None) or "post"
+    treated = np.asarray(treated, dtype=float)
+    post = np.asarray(post, dtype=float)
+    X = pd.DataFrame({"const": np.ones(len(treated)), t_name: treated,
+                      p_name: post,
+                      "%s:%s" % (t_name, p_name): treated * post})
+    if controls is not None:
+        controls = pd.DataFrame(controls)
+        X = pd.concat([X, controls.reset_index(drop=True)], axis=1)
+    return panel_ols(y, X, entity, time,
+                     entity_effects, time_effects, absorb, weights,
+                     cov_type, cluster)
@@ -0,0 +1,368 @@
+"""Opt-in timing and memory spans for the chapters' pipelines.
+
+A chapter run spends its time in a few stages: downloading and parsing the
+data (``pd.read_stata``), copying frames (``dropna``, ``rename``,
+``set_index``), building designs, fitting, computing covariances and
+plotting. ``span`` marks a stage, as a context manager or a decorator;
+spans nest, and while no ``Profiler`` is running they cost one global
+lookup::
+
+    from causal_methods import profiling
+
+    with profiling.Profiler(notebook='chapter5', memory=True) as prof:
+        profiling.patch()           # pandas, statsmodels, linearmodels, ...
+        with profiling.span('load'):
+            df = pd.read_stata(path + 'FRB_1931.dta')
+        ...
+    prof.table()                    # seconds and peak memory per stage
+    prof.to_json('chapter5.json')
+    prof.to_folded('chapter5.folded')   # flamegraph.pl / speedscope
+
+``patch`` wraps the third-party calls the chapters make (readers, frame
+copies, ``fit``, ``PanelData``, ``fig.show()``) in spans;
+``watch_cells`` opens one span per IPython cell, so every record carries
+its notebook and cell. ``python -m causal_methods.build --profile DIR``
+does both for every chapter and writes one JSON and one folded-stack file
+per notebook.
+"""
+
+import functools
+import importlib
+import inspect
+import json
+import os
+import time
+import tracemalloc
+from pathlib import Path
+
+# Third-party callables wrapped by ``patch``, with their stage. Formula
+# constructors (``smf.ols``, ``from_formula``) are left alone: they look
+# up the names of the formula in their caller's frame, which a wrapper
+# would replace; their time shows up in the cell's own time
+PATCHES = {
+    "pandas.io.common._get_filepath_or_buffer": "download",
+    "pandas.read_stata": "read_stata",
+    "pandas.read_csv": "read_csv",
+    "pandas.read_excel": "read_excel",
+    "pandas.DataFrame.dropna": "dropna",
+    "pandas.DataFrame.rename": "rename",
+    "pandas.DataFrame.set_index": "set_index",
+    "pandas.DataFrame.merge": "merge",
+    "pandas.crosstab": "crosstab",
+    "statsmodels.regression.linear_model.RegressionModel.fit": "fit",
+    "statsmodels.regression.linear_model.RegressionResults"
+    ".get_robustcov_results": "covariance",
+    "linearmodels.panel.data.PanelData.__init__": "panel_data",
+    "linearmodels.panel.model.PanelOLS.fit": "fit",
+    "linearmodels.iv.model._IVLSModelBase.fit": "fit",
+    "plotly.basedatatypes.BaseFigure.show": "plot",
+    "matplotlib.pyplot.show": "plot",
+}
+
+# The running profiler, if any
+_active = None
+# (owner, attribute, original) of every patched callable
+_patched = []
+# IPython event callbacks registered by ``watch_cells``
+_callbacks = []
+
+
+class Profiler:
+    """Records the spans opened while it runs.
+
+    ``notebook`` and ``cell`` label every record (``watch_cells`` updates
+    ``cell``). With ``memory=True`` each span also records the peak memory
+    allocated above its starting point, traced with ``tracemalloc`` (which
+    slows allocation-heavy code down).
+    """
+
+    def __init__(self, notebook=None, memory=False):
+        self.notebook = notebook
+        self.cell = None
+        self.memory = memory
+        self.records = []
+        self._stack = []
+        self._tracing = False
+
+    def start(self):
+        global _active
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._tracing = True
+        self.origin = time.perf_counter()
+        _active = self
+        return self
+
+    def stop(self):
+        global _active
+        if _active is self:
+            _active = None
+        if self._tracing:
+            tracemalloc.stop()
+            self._tracing = False
+        self._stack = []
+        return self
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _enter(self, name):
+        frame = {"name": name, "start": time.perf_counter(), "children": 0.0,
+                 "base": 0, "peak": 0}
+        if self.memory:
+            current, peak = tracemalloc.get_traced_memory()
+            if self._stack:
+                parent = self._stack[-1]
+                parent["peak"] = max(parent["peak"], peak)
+            frame["base"] = frame["peak"] = current
+            tracemalloc.reset_peak()
+        self._stack.append(frame)
+
+    def _exit(self):
+        if not self._stack:
+            return
+        frame = self._stack.pop()
+        seconds = time.perf_counter() - frame["start"]
+        peak = None
+        if self.memory:
+            frame["peak"] = max(frame["peak"],
+                                tracemalloc.get_traced_memory()[1])
+            peak = frame["peak"] - frame["base"]
+        if self._stack:
+            parent = self._stack[-1]
+            parent["children"] += seconds
+            parent["peak"] = max(parent["peak"], frame["peak"])
+        self.records.append({
+            "notebook": self.notebook, "cell": self.cell,
+            "stack": [f["name"] for f in self._stack] + [frame["name"]],
+            "name": frame["name"],
+            "start": frame["start"] - self.origin, "seconds": seconds,
+            "self_seconds": seconds - frame["children"],
+            "peak_bytes": peak})
+
+    def table(self, by=("notebook", "cell", "name")):
+        """Calls, total and self seconds and peak memory (MB), grouped by
+        the record fields ``by``, slowest first."""
+        import pandas as pd
+        frame = pd.DataFrame(self.records, columns=[
+            "notebook", "cell", "stack", "name", "start", "seconds",
+            "self_seconds", "peak_bytes"])
+        return _aggregate(frame, list(by))
+
+    def to_dict(self):
+        return {"notebook": self.notebook, "memory": self.memory,
+                "spans": self.records}
+
+    def to_json(self, path):
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f, indent=1, default=str)
+
+    def folded(self):
+        """Self time of every stack in microseconds, in the collapsed
+        format of ``flamegraph.pl`` (also read by speedscope)."""
+        totals = {}
+        for record in self.records:
+            stack = [str(record["notebook"] or "main"),
+                     str(record["cell"] or "-")] + record["stack"]
+            if stack[2] == stack[1]:
+                # The cell span itself
+                del stack[2]
+            key = ";".join(s.replace(";", ",").replace(" ", "_")
+                           for s in stack)
+            totals[key] = totals.get(key, 0) \
+                + int(round(record["self_seconds"] * 1e6))
+        return ["%s %d" % item for item in totals.items() if item[1] > 0]
+
+    def to_folded(self, path):
+        with open(path, "w") as f:
+            f.write("\n".join(self.folded()) + "\n")
+
+
+def _aggregate(frame, by):
+    grouped = frame.groupby(by, dropna=False, sort=False)
+    table = grouped.agg(calls=("seconds", "size"),
+                        seconds=("seconds", "sum"),
+                        self_seconds=("self_seconds", "sum"),
+                        peak_mb=("peak_bytes", "max"))
+    table["peak_mb"] = table["peak_mb"] / 2**20
+    return table.sort_values("seconds", ascending=False)
+
+
+class span:
+    """A timed stage: ``with span('fit'):`` or ``@span('fit')``.
+
+    Does nothing unless a ``Profiler`` is running. A decorated function
+    called directly inside a span of the same name does not open another.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.profiler = None
+
+    def __enter__(self):
+        self.profiler = _active
+        if self.profiler is not None:
+            self.profiler._enter(self.name)
+        return self
+
+    def __exit__(self, *exc):
+        if self.profiler is not None:
+            self.profiler._exit()
+            self.profiler = None
+
+    def __call__(self, func):
+        name = self.name
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            # A stage calling itself (or a wrapped alias) is one span
+            if _active is None or (_active._stack and
+                                   _active._stack[-1]["name"] == name):
+                return func(*args, **kwargs)
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+
+
+def _resolve(target):
+    # (owner, attribute) of a dotted path, importing the longest module
+    # prefix; None if the module is not installed
+    parts = target.split(".")
+    for i in range(len(parts) - 1, 0, -1):
+        try:
+            owner = importlib.import_module(".".join(parts[:i]))
+        except ImportError:
+            continue
+        try:
+            for part in parts[i:-1]:
+                owner = getattr(owner, part)
+        except AttributeError:
+            return None
+        return (owner, parts[-1]) if hasattr(owner, parts[-1]) else None
+    return None
+
+
+def patch(targets=None):
+    """Wrap third-party callables in spans; ``targets`` maps dotted paths
+    to stage names (default ``PATCHES``). Missing packages are skipped.
+    Returns the paths that were patched."""
+    done = []
+    for target, name in (PATCHES if targets is None else targets).items():
+        resolved = _resolve(target)
+        if resolved is None:
+            continue
+        owner, attribute = resolved
+        original = inspect.getattr_static(owner, attribute)
+        if isinstance(original, (classmethod, staticmethod)):
+            wrapped = type(original)(span(name)(original.__func__))
+        else:
+            wrapped = span(name)(original)
+        setattr(owner, attribute, wrapped)
+        _patched.append((owner, attribute, original))
+        done.append(target)
+    return done
+
+
+def unpatch():
+    """Restore everything ``patch`` wrapped."""
+    while _patched:
+        owner, attribute, original = _patched.pop()
+        setattr(owner, attribute, original)
+
+
+def watch_cells(shell=None):
+    """Label records with the IPython cell they ran in, and time every
+    cell as a span of its own."""
+    if shell is None:
+        from IPython import get_ipython
+        shell = get_ipython()
+    cells = []
+
+    def pre_run_cell(info):
+        if _active is not None:
+            _active.cell = "cell %d" % shell.execution_count
+            cells.append(span(_active.cell).__enter__())
+
+    def post_run_cell(result):
+        while cells:
+            cells.pop().__exit__(None, None, None)
+
+    for event, callback in (("pre_run_cell", pre_run_cell),
+                            ("post_run_cell", post_run_cell)):
+        shell.events.register(event, callback)
+        _callbacks.append((shell, event, callback))
+
+
+def unwatch_cells():
+    while _callbacks:
+        shell, event, callback = _callbacks.pop()
+        shell.events.unregister(event, callback)
+
+
+def start_notebook(notebook, memory=False):
+    """Profile the rest of this kernel's session (used by the build)."""
+    Profiler(notebook, memory).start()
+    patch()
+    watch_cells()
+
+
+def finish_notebook(directory):
+    """Stop the session's profiler and write ``<notebook>.json`` and
+    ``<notebook>.folded`` to ``directory``."""
+    profiler = _active
+    unwatch_cells()
+    unpatch()
+    if profiler is None:
+        return
+    profiler.stop()
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    profiler.to_json(directory / (profiler.notebook + ".json"))
+    profiler.to_folded(directory / (profiler.notebook + ".folded"))
+
+
+def execute(nb, cwd, notebook, directory, timeout=None,
+            kernel_name="python3", memory=False):
+    """Execute ``nb`` in place with every cell profiled; see
+    ``start_notebook`` and ``finish_notebook``."""
+    from nbclient import NotebookClient
+
+    from causal_methods.cellcache import _run_hidden
+
+    client = NotebookClient(nb, timeout=timeout, kernel_name=kernel_name,
+                            resources={"metadata": {"path": str(cwd)}})
+    env = dict(os.environ)
+    package = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env["PYTHONPATH"] = os.pathsep.join(
+        filter(None, [package, env.get("PYTHONPATH")]))
+    code = [i for i, cell in enumerate(nb.cells)
+            if cell.cell_type == "code"]
+    with client.setup_kernel(env=env):
+        _run_hidden(client, "__import__('causal_methods.profiling', "
+                    "fromlist=['_']).start_notebook(%r, %r)"
+                    % (notebook, memory), code[0] if code else 0)
+        try:
+            for index in code:
+                client.execute_cell(nb.cells[index], index)
+        finally:
+            _run_hidden(client, "__import__('causal_methods.profiling', "
+                        "fromlist=['_']).finish_notebook(%r)"
+                        % str(Path(directory).resolve()),
+                        code[-1] if code else 0)
+
+
+def report(directory, by=("notebook", "name")):
+    """Aggregate the JSON files written to ``directory`` (see
+    ``Profiler.table``)."""
+    import pandas as pd
+    records = []
+    for path in sorted(Path(directory).glob("*.json")):
+        with open(path) as f:
+            records.extend(json.load(f)["spans"])
+    frame = pd.DataFrame(records, columns=[
+        "notebook", "cell", "stack", "name", "start", "seconds",
+        "self_seconds", "peak_bytes"])
+    return _aggregate(frame, list(by))
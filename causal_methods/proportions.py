@@ -0,0 +1,387 @@
+"""Two-sample proportion tests for every pair of groups at once.
+
+Chapter 1 filters the data once per chess title, counts the games ending
+at each node with ``groupby('EndNode').size()`` and calls
+``proportions_ztest`` with hand-built ``count``/``nobs`` arrays for each
+comparison. With many categories that is one filter per category and one
+call per pair.
+
+``count_table`` builds the whole group x outcome count matrix with one
+``np.bincount``; ``pairwise_tests`` and ``one_vs_rest_tests`` compute the
+pooled z-test of ``proportions_ztest`` for every pair of groups (or every
+group against all the others) and every outcome level as array operations,
+and adjust the p-values for multiple testing.
+
+Small cells such as the 26 out of 26 Grandmasters who stop at the first
+node are where the normal approximation is weakest. ``test="fisher"``,
+``"barnard"`` or ``"permutation"`` replace its p-values with exact or
+resampled ones. The null distributions are computed once per table margin
+from a cached table of log-factorials and reused across tests and calls::
+
+    counts = count_table(chess, 'Title1', 'EndNode')
+    pairwise_tests(counts, levels=[1])
+    pairwise_tests(counts, levels=[1], test='fisher')
+"""
+
+import collections
+import functools
+
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+TESTS = ("z", "fisher", "barnard", "permutation")
+
+# Bytes of binomial tails kept across calls by ``barnard_exact``
+BARNARD_CACHE_BYTES = 2**27
+
+_LOG_FACTORIAL = np.zeros(1)
+_barnard_cache = collections.OrderedDict()
+
+
+def count_table(data, group, outcome):
+    """Counts of each ``outcome`` level within each ``group``.
+
+    Equivalent to ``pd.crosstab(data[group], data[outcome])``, including
+    empty cells as zeros. Rows with a missing group or outcome are dropped.
+    """
+    group_codes, groups = pd.factorize(data[group], sort=True)
+    outcome_codes, outcomes = pd.factorize(data[outcome], sort=True)
+    keep = (group_codes >= 0) & (outcome_codes >= 0)
+    cells = group_codes[keep] * len(outcomes) + outcome_codes[keep]
+    counts = np.bincount(cells, minlength=len(groups) * len(outcomes))
+    return pd.DataFrame(counts.reshape(len(groups), len(outcomes)),
+                        index=pd.Index(groups, name=group),
+                        columns=pd.Index(outcomes, name=outcome))
+
+
+def ztest(count1, nobs1, count2, nobs2):
+    """Pooled two-sided z-test of equal proportions, elementwise.
+
+    Same statistic as ``proportions_ztest([count1, count2], [nobs1,
+    nobs2])``. Returns ``(z, pvalue)``; both are NaN or infinite where the
+    pooled proportion is 0 or 1.
+    """
+    count1, nobs1, count2, nobs2 = (np.asarray(a, dtype=float)
+                                    for a in (count1, nobs1, count2, nobs2))
+    pooled = (count1 + count2) / (nobs1 + nobs2)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        se = np.sqrt(pooled * (1 - pooled) * (1 / nobs1 + 1 / nobs2))
+        z = (count1 / nobs1 - count2 / nobs2) / se
+    return z, 2 * stats.norm.sf(np.abs(z))
+
+
+def log_factorial(n):
+    """``log(k!)`` for ``k = 0..n`` (at least), from a table that grows
+    on demand and is shared by all the exact tests."""
+    global _LOG_FACTORIAL
+    if len(_LOG_FACTORIAL) <= n:
+        size = max(n + 1, 2 * len(_LOG_FACTORIAL))
+        _LOG_FACTORIAL = np.concatenate(
+            [[0.0], np.cumsum(np.log(np.arange(1, size)))])
+    return _LOG_FACTORIAL
+
+
+def _log_comb(n, k):
+    table = log_factorial(np.max(n))
+    return table[n] - table[k] - table[n - k]
+
+
+@functools.lru_cache(maxsize=4096)
+def _fisher_null(nobs1, nobs2, successes):
+    # Hypergeometric pmf of count1 given the margins, and its sorted
+    # cumulative sums: the p-value of any table is one lookup
+    low = max(0, successes - nobs2)
+    x = np.arange(low, min(successes, nobs1) + 1)
+    pmf = np.exp(_log_comb(nobs1, x) + _log_comb(nobs2, successes - x)
+                 - _log_comb(nobs1 + nobs2, successes))
+    ordered = np.sort(pmf)
+    return low, pmf, ordered, np.cumsum(ordered)
+
+
+def fisher_exact(count1, nobs1, count2, nobs2):
+    """Two-sided Fisher exact p-values, elementwise.
+
+    Same as ``scipy.stats.fisher_exact([[count1, count2], [nobs1 - count1,
+    nobs2 - count2]])``: the probability of the tables with the same
+    margins that are no more likely than the observed one.
+    """
+    count1, nobs1, count2, nobs2 = np.broadcast_arrays(
+        *(np.asarray(a, dtype=np.int64)
+          for a in (count1, nobs1, count2, nobs2)))
+    pvalue = np.full(count1.shape, np.nan)
+    keys = np.stack([nobs1.ravel(), nobs2.ravel(),
+                     (count1 + count2).ravel()], axis=1)
+    valid = (keys[:, 0] > 0) & (keys[:, 1] > 0)
+    unique, which = np.unique(keys[valid], axis=0, return_inverse=True)
+    rows = np.flatnonzero(valid)
+    which = which.ravel()
+    flat = pvalue.reshape(-1)
+    for i, key in enumerate(unique):
+        low, pmf, ordered, cumulative = _fisher_null(*map(int, key))
+        sel = rows[which == i]
+        observed = pmf[count1.ravel()[sel] - low] * (1 + 1e-7)
+        flat[sel] = cumulative[np.searchsorted(ordered, observed,
+                                               side="right") - 1]
+    return np.minimum(pvalue, 1.0)
+
+
+def _pooled_z(x1, n1, x2, n2):
+    with np.errstate(divide="ignore", invalid="ignore"):
+        z = ztest(x1, n1, x2, n2)[0]
+    return np.where(x1 * n2 == x2 * n1, 0.0, z)
+
+
+def _binomial_pmf(n, p):
+    # Binomial(n, p) pmf at 0..n, one row per probability in ``p``
+    k = np.arange(n + 1)
+    p = np.atleast_1d(p)[:, None]
+    return np.exp(_log_comb(n, k) + k * np.log(p) + (n - k) * np.log1p(-p))
+
+
+def _barnard_tails(nobs1, nobs2, p):
+    # pmf of x1, and P(x2 < k) and P(x2 >= k) for k = 0..nobs2 + 1, at
+    # each common proportion in ``p``
+    pmf2 = _binomial_pmf(nobs2, p)
+    zeros = np.zeros((len(pmf2), 1))
+    below = np.hstack([zeros, np.cumsum(pmf2, axis=1)])
+    above = np.hstack([np.cumsum(pmf2[:, ::-1], axis=1)[:, ::-1], zeros])
+    return _binomial_pmf(nobs1, p), below, above
+
+
+def _barnard_grid(nobs1, nobs2, points):
+    # ``_barnard_tails`` on the grid of ``points`` proportions, kept in a
+    # least recently used cache of at most BARNARD_CACHE_BYTES
+    key = (nobs1, nobs2, points)
+    if key in _barnard_cache:
+        _barnard_cache.move_to_end(key)
+        return _barnard_cache[key]
+    tails = _barnard_tails(nobs1, nobs2, (np.arange(points) + 0.5) / points)
+    size = sum(a.nbytes for a in tails)
+    if size <= BARNARD_CACHE_BYTES:
+        _barnard_cache[key] = tails
+        total = sum(a.nbytes for v in _barnard_cache.values() for a in v)
+        while total > BARNARD_CACHE_BYTES:
+            total -= sum(a.nbytes
+                         for a in _barnard_cache.popitem(last=False)[1])
+    return tails
+
+
+def _barnard_region(count1, nobs1, count2, nobs2):
+    # For each x1 = 0..nobs1, the x2 of the tables less extreme than the
+    # observed one, as a range [lo, hi] (empty if lo > hi). |z| >= t is
+    # a quadratic inequality in x2, so these form an interval between its
+    # roots; the rounding of the roots is checked on z itself
+    t = abs(_pooled_z(count1, nobs1, count2, nobs2)) - 1e-9
+    x1 = np.arange(nobs1 + 1)
+    total = nobs1 + nobs2
+    a = t * t * (1 / nobs1 + 1 / nobs2) / total**2
+    share = x1 / nobs1
+    qa = 1 / nobs2**2 + a
+    qb = -2 * share / nobs2 - a * (total - 2 * x1)
+    qc = share**2 - a * x1 * (total - x1)
+    root = np.sqrt(np.maximum(qb * qb - 4 * qa * qc, 0))
+    lo = np.clip(np.ceil((-qb - root) / (2 * qa)), 0, nobs2 + 1)
+    hi = np.clip(np.floor((-qb + root) / (2 * qa)), -1, nobs2)
+    lo, hi = lo.astype(np.int64), hi.astype(np.int64)
+
+    def inside(x2):
+        z = _pooled_z(x1, nobs1, np.clip(x2, 0, nobs2), nobs2)
+        return (x2 >= 0) & (x2 <= nobs2) & (np.abs(z) < t)
+
+    lo = np.where(inside(lo - 1), lo - 1, lo)
+    lo = np.where((lo <= hi) & ~inside(lo), lo + 1, lo)
+    hi = np.where(inside(hi + 1), hi + 1, hi)
+    hi = np.where((lo <= hi) & ~inside(hi), hi - 1, hi)
+    # An empty range is any lo = hi + 1
+    hi = np.maximum(hi, lo - 1)
+    return lo, hi
+
+
+def _barnard_pvalue(count1, nobs1, count2, nobs2, points):
+    # Probability of the tables at least as extreme as the observed one,
+    # P(x2 < lo) + P(x2 > hi) summed over x1, maximized over a grid of
+    # the common proportion and refined around the grid's maximum
+    from scipy import optimize
+
+    if nobs1 > nobs2:
+        count1, nobs1, count2, nobs2 = count2, nobs2, count1, nobs1
+    if _pooled_z(count1, nobs1, count2, nobs2) == 0:
+        return 1.0
+    lo, hi = _barnard_region(count1, nobs1, count2, nobs2)
+
+    def pvalue(tails):
+        pmf1, below, above = tails
+        return (pmf1 * (below[:, lo] + above[:, hi + 1])).sum(axis=1)
+
+    values = pvalue(_barnard_grid(nobs1, nobs2, points))
+    best = np.argmax(values)
+    bounds = (max(best - 0.5, 1e-3) / points,
+              min(best + 1.5, points - 1e-3) / points)
+    refined = optimize.minimize_scalar(
+        lambda p: -pvalue(_barnard_tails(nobs1, nobs2, p))[0],
+        bounds=bounds, method="bounded", options={"xatol": 1e-10})
+    return max(values[best], -refined.fun)
+
+
+def barnard_exact(count1, nobs1, count2, nobs2, points=200):
+    """Two-sided Barnard exact p-values (pooled z statistic), elementwise.
+
+    As ``scipy.stats.barnard_exact``, the p-value is maximized over the
+    common success probability: on a grid of ``points`` values, then by a
+    bounded scalar search around the grid's maximum. Each test sums over
+    the smaller sample only (for each of its counts, the tables at least
+    as extreme form two tails of the other binomial), so it costs
+    ``O(points * min(nobs))`` once the binomial tails of the grid are
+    computed, in ``O(points * (nobs1 + nobs2))`` time and memory per pair
+    of sample sizes. Those are cached across calls, up to
+    ``BARNARD_CACHE_BYTES`` in total. It remains much slower than the
+    z-test on large samples, where the two agree.
+    """
+    count1, nobs1, count2, nobs2 = np.broadcast_arrays(
+        *(np.asarray(a, dtype=np.int64)
+          for a in (count1, nobs1, count2, nobs2)))
+    pvalue = np.full(count1.shape, np.nan)
+    flat = pvalue.reshape(-1)
+    keys = np.stack([count1.ravel(), nobs1.ravel(), count2.ravel(),
+                     nobs2.ravel()], axis=1)
+    valid = (keys[:, 1] > 0) & (keys[:, 3] > 0)
+    unique, which = np.unique(keys[valid], axis=0, return_inverse=True)
+    values = [_barnard_pvalue(*map(int, key), points) for key in unique]
+    flat[valid] = np.asarray(values)[which.ravel()]
+    return np.minimum(pvalue, 1.0)
+
+
+def permutation_test(count1, nobs1, count2, nobs2, reps=9999, seed=None,
+                     batch=1000):
+    """Two-sided permutation p-values, elementwise.
+
+    Shuffling the group labels of the pooled sample makes ``count1``
+    hypergeometric, so each batch of ``batch`` shuffles is drawn for all
+    the tests at once as hypergeometric counts. The p-value is
+    ``(1 + #{|diff*| >= |diff|}) / (1 + reps)``.
+    """
+    count1, nobs1, count2, nobs2 = np.broadcast_arrays(
+        *(np.asarray(a, dtype=np.int64)
+          for a in (count1, nobs1, count2, nobs2)))
+    rng = np.random.default_rng(seed)
+    successes = count1 + count2
+    total = nobs1 + nobs2
+    with np.errstate(divide="ignore", invalid="ignore"):
+        expected = successes * nobs1 / total
+    observed = np.abs(count1 - expected) - 1e-9
+    extreme = np.zeros(count1.shape)
+    for start in range(0, reps, batch):
+        size = min(batch, reps - start)
+        draws = rng.hypergeometric(successes, total - successes, nobs1,
+                                   size=(size,) + count1.shape)
+        extreme += (np.abs(draws - expected) >= observed).sum(axis=0)
+    pvalue = (1 + extreme) / (1 + reps)
+    return np.where((nobs1 > 0) & (nobs2 > 0), pvalue, np.nan)
+
+
+def _pvalues(test, count1, nobs1, count2, nobs2, reps, seed):
+    if test == "z":
+        return ztest(count1, nobs1, count2, nobs2)[1]
+    if test == "fisher":
+        return fisher_exact(count1, nobs1, count2, nobs2)
+    if test == "barnard":
+        return barnard_exact(count1, nobs1, count2, nobs2)
+    if test == "permutation":
+        return permutation_test(count1, nobs1, count2, nobs2, reps, seed)
+    raise ValueError("test must be one of %s, got %r" % (TESTS, test))
+
+
+def _adjust(table, adjust):
+    if adjust is None:
+        return table
+    from statsmodels.stats.multitest import multipletests
+
+    pvalues = table["p-value"].to_numpy()
+    adjusted = np.full(len(pvalues), np.nan)
+    valid = ~np.isnan(pvalues)
+    if valid.any():
+        adjusted[valid] = multipletests(pvalues[valid], method=adjust)[1]
+    table["p-adjusted"] = adjusted
+    return table
+
+
+def _levels(counts, levels):
+    if levels is None:
+        return list(counts.columns)
+    missing = [level for level in levels if level not in counts.columns]
+    if missing:
+        raise ValueError("levels must be among %s, got %r"
+                         % (list(counts.columns), missing))
+    return list(levels)
+
+
+def pairwise_tests(counts, levels=None, test="z", adjust="holm",
+                   reps=9999, seed=None):
+    """Tests of equal proportions for every pair of groups.
+
+    ``counts`` is a ``count_table``: groups in rows, outcome levels in
+    columns. For each outcome level in ``levels`` (default: all) and each
+    pair of groups, the share of that level is compared. The ``z`` column
+    is always the pooled z-statistic; the p-values come from ``test``, one
+    of ``TESTS`` (``reps`` and ``seed`` are for ``"permutation"``).
+    ``adjust`` is a ``statsmodels.stats.multitest.multipletests`` method
+    applied across all the tests returned, or None.
+    """
+    if test not in TESTS:
+        raise ValueError("test must be one of %s, got %r" % (TESTS, test))
+    levels = _levels(counts, levels)
+    values = counts[levels].to_numpy(float)
+    nobs = counts.to_numpy(float).sum(axis=1)
+    first, second = np.triu_indices(len(counts), k=1)
+    n_levels, n_pairs = len(levels), len(first)
+
+    count1 = values[first].T.ravel()
+    count2 = values[second].T.ravel()
+    nobs1 = np.tile(nobs[first], n_levels)
+    nobs2 = np.tile(nobs[second], n_levels)
+    z = ztest(count1, nobs1, count2, nobs2)[0]
+    pvalue = _pvalues(test, count1, nobs1, count2, nobs2, reps, seed)
+    index = pd.MultiIndex.from_arrays(
+        [np.repeat(levels, n_pairs),
+         np.tile(counts.index.to_numpy()[first], n_levels),
+         np.tile(counts.index.to_numpy()[second], n_levels)],
+        names=[counts.columns.name, "group1", "group2"])
+    with np.errstate(divide="ignore", invalid="ignore"):
+        table = pd.DataFrame({"prop1": count1 / nobs1,
+                              "prop2": count2 / nobs2,
+                              "nobs1": nobs1.astype(int),
+                              "nobs2": nobs2.astype(int),
+                              "z": z, "p-value": pvalue}, index=index)
+    return _adjust(table, adjust)
+
+
+def one_vs_rest_tests(counts, levels=None, test="z", adjust="holm",
+                      reps=9999, seed=None):
+    """Tests of each group against all the other groups pooled.
+
+    Same arguments as ``pairwise_tests``; ``prop2`` is the share among
+    the rest of the sample.
+    """
+    if test not in TESTS:
+        raise ValueError("test must be one of %s, got %r" % (TESTS, test))
+    levels = _levels(counts, levels)
+    values = counts[levels].to_numpy(float)
+    nobs = counts.to_numpy(float).sum(axis=1)
+    count1 = values.T.ravel()
+    count2 = (values.sum(axis=0)[:, None] - values.T).ravel()
+    nobs1 = np.tile(nobs, len(levels))
+    nobs2 = nobs.sum() - nobs1
+    z = ztest(count1, nobs1, count2, nobs2)[0]
+    pvalue = _pvalues(test, count1, nobs1, count2, nobs2, reps, seed)
+    index = pd.MultiIndex.from_arrays(
+        [np.repeat(levels, len(counts)),
+         np.tile(counts.index.to_numpy(), len(levels))],
+        names=[counts.columns.name, counts.index.name])
+    with np.errstate(divide="ignore", invalid="ignore"):
+        table = pd.DataFrame({"prop1": count1 / nobs1,
+                              "prop2": count2 / nobs2,
+                              "nobs1": nobs1.astype(int),
+                              "nobs2": nobs2.astype(int),
+                              "z": z, "p-value": pvalue}, index=index)
+    return _adjust(table, adjust)
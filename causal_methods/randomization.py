@@ -0,0 +1,157 @@
+"""Fisher randomization tests for randomized experiments.
+
+Chapters 2, 8 and 9 analyze randomized treatments (``Treatment`` in the
+résumé experiment, ``guest_black`` on Airbnb, ``assettreat`` within the
+``block13`` strata) but only report model-based OLS p-values. A
+randomization test instead compares the estimate with its distribution
+over re-randomizations of the treatment under the design that was
+actually used: here, complete randomization within strata.
+
+The statistic is the OLS coefficient of the treatment with stratum fixed
+effects, ``sum_i (d_i - dbar_s) y_i / sum_i (d_i - dbar_s)**2`` (the
+difference in means when there are no strata). Permuting the treatment
+within strata leaves the denominator unchanged, so the statistics of a
+whole batch of re-randomizations are one matrix product of the ``B x n``
+matrix of permuted treatments with the outcomes, for every outcome at
+once. Batches bound the memory, and shards of the draws can run in a
+process pool::
+
+    from causal_methods.randomization import randomization_test
+    randomization_test(df['call_back'], df['black'], reps=100000, seed=0)
+    randomization_test(df[control], df['assettreat'], strata=df['block13'])
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+
+def _outcomes(y):
+    if isinstance(y, pd.DataFrame):
+        return y.to_numpy(float), list(y.columns)
+    if isinstance(y, pd.Series):
+        return y.to_numpy(float)[:, None], [y.name or "y"]
+    y = np.asarray(y, dtype=float)
+    if y.ndim == 1:
+        return y[:, None], ["y"]
+    return y, ["y%d" % i for i in range(y.shape[1])]
+
+
+class RandomizationTest:
+    """Randomization distribution of the treatment coefficient.
+
+    ``y`` holds one or more outcomes (Series, DataFrame or array),
+    ``treatment`` the assigned treatment (binary or not) and ``strata``
+    the randomization strata, if any. Rows with a missing value in any of
+    them are dropped.
+    """
+
+    def __init__(self, y, treatment, strata=None):
+        y, self.names = _outcomes(y)
+        d = np.asarray(treatment, dtype=float)
+        keep = ~(np.isnan(y).any(axis=1) | np.isnan(d))
+        if strata is None:
+            codes = np.zeros(len(d), dtype=int)
+        else:
+            codes = pd.factorize(np.asarray(strata))[0]
+            keep &= codes >= 0
+        y, d, codes = y[keep], d[keep], codes[keep]
+
+        order = np.argsort(codes, kind="stable")
+        y, d, codes = y[order], d[order], codes[order]
+        bounds = np.flatnonzero(np.diff(codes)) + 1
+        # Per stratum: the slice of rows and its treatment values
+        self.blocks = [slice(a, b) for a, b in
+                       zip(np.r_[0, bounds], np.r_[bounds, len(d)])]
+        self.y = y
+        self.d = d
+        means = np.bincount(codes, weights=d) / np.bincount(codes)
+        centered = d - means[codes]
+        self.denominator = centered @ centered
+        if self.denominator == 0:
+            raise ValueError("the treatment does not vary within strata")
+        # sum_i dbar_s y_i, subtracted from every permuted d @ y
+        self.offset = means[codes] @ y
+        self.coef = (d @ y - self.offset) / self.denominator
+        self.nobs = len(d)
+
+    def statistics(self, rng, size):
+        """Coefficients for ``size`` re-randomizations: a size x k array."""
+        total = np.zeros((size, self.y.shape[1]))
+        for block in self.blocks:
+            d, y = self.d[block], self.y[block]
+            values = np.unique(d)
+            if len(values) == 1:
+                total += d[0] * y.sum(axis=0)
+            elif len(values) == 2:
+                # Binary treatment: the m units with the smallest random
+                # keys are treated, which is cheaper than a full shuffle
+                m = (d == values[1]).sum()
+                keys = rng.random((size, len(d)))
+                kth = np.partition(keys, m - 1, axis=1)[:, m - 1:m]
+                total += values[0] * y.sum(axis=0) \
+                    + (values[1] - values[0]) * ((keys <= kth) @ y)
+            else:
+                permuted = rng.permuted(np.broadcast_to(d, (size, len(d))),
+                                        axis=1)
+                total += permuted @ y
+        return (total - self.offset) / self.denominator
+
+    def draws(self, reps, seed=None, batch=1000):
+        """``reps`` coefficients from re-randomized treatments."""
+        rng = np.random.default_rng(seed)
+        return np.concatenate([
+            self.statistics(rng, min(batch, reps - start))
+            for start in range(0, reps, batch)])
+
+    def _tally(self, reps, seed=None, batch=1000):
+        # Counts of |coef*| >= |coef| and the sums needed for the mean and
+        # standard deviation of the draws, without keeping the draws
+        rng = np.random.default_rng(seed)
+        extreme = np.zeros(len(self.names))
+        sums = np.zeros((2, len(self.names)))
+        threshold = np.abs(self.coef) * (1 - 1e-12)
+        for start in range(0, reps, batch):
+            stat = self.statistics(rng, min(batch, reps - start))
+            extreme += (np.abs(stat) >= threshold).sum(axis=0)
+            sums += [stat.sum(axis=0), (stat**2).sum(axis=0)]
+        return extreme, sums
+
+    def test(self, reps=10000, seed=None, batch=1000, workers=None):
+        """Two-sided randomization p-values, one row per outcome.
+
+        The p-value is ``(1 + #{|coef*| >= |coef|}) / (1 + reps)``;
+        ``std err`` is the standard deviation of the randomization
+        distribution. With ``workers`` the draws are split into one shard
+        per worker, each with an independent random stream.
+        """
+        if workers is None or workers <= 1:
+            extreme, sums = self._tally(reps, seed, batch)
+        else:
+            seeds = np.random.SeedSequence(seed).spawn(workers)
+            sizes = [len(s) for s in np.array_split(np.arange(reps),
+                                                    workers)]
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                shards = list(pool.map(self._tally, sizes, seeds,
+                                       [batch] * workers))
+            extreme = sum(s[0] for s in shards)
+            sums = sum(s[1] for s in shards)
+        mean = sums[0] / reps
+        return pd.DataFrame({
+            "coef": self.coef,
+            "std err": np.sqrt(np.maximum(sums[1] / reps - mean**2, 0)),
+            "p-value": (1 + extreme) / (1 + reps),
+            "reps": reps,
+            "nobs": self.nobs,
+        }, index=self.names)
+
+
+def randomization_test(y, treatment, strata=None, reps=10000, seed=None,
+                       batch=1000, workers=None):
+    """Fisher randomization test of no treatment effect on ``y``.
+
+    See ``RandomizationTest`` and ``RandomizationTest.test``.
+    """
+    return RandomizationTest(y, treatment, strata).test(reps, seed, batch,
+                                                        workers)
@@ -0,0 +1,425 @@
+"""Sharp regression discontinuity from sorted cumulative moments.
+
+Chapter 3 uses the ``rdd`` package, which filters and copies the DataFrame
+for every bandwidth (``truncated_data``), bins with one boolean mask per bin
+(``bin_data``) and fits a statsmodels formula at each step of the
+Imbens-Kalyanaraman bandwidth (``optimal_bandwidth``).
+
+``RDData`` sorts each side of the cutoff once by distance to the cutoff and
+keeps prefix sums of ``x**k * y**m`` (``x`` centered at the cutoff, ``y``
+at its mean, so that sums of squares do not cancel). Every window
+``|x - cutoff| <= h`` is then a prefix on each side, so counts come from
+``np.searchsorted`` and the IK bandwidth and the local linear fits are
+evaluated from a handful of sums, without touching the rows again::
+
+    rd = RDData(df['hischshr1520f'], df['iwm94'], cutoff=0)
+    h = rd.optimal_bandwidth()             # rdd.optimal_bandwidth
+    binned = rd.bin_data(10, bandwidth=h)  # rdd.bin_data(truncated_data)
+    rd.fit(h).params['treated']            # tau at h
+    rd.fit(0.05).params['treated']         # no re-sorting, no copies
+    rd.sweep(np.linspace(0.02, 0.5, 200))  # tau, se and N per bandwidth
+
+The results match ``rdd`` and ``sm.OLS`` on the truncated data.
+"""
+
+import math
+
+import numpy as np
+import pandas as pd
+from scipy import linalg
+
+from causal_methods.regression import ols
+from causal_methods.results import Result
+
+KERNELS = ("uniform", "triangular")
+COV_TYPES = ("nonrobust", "HC0", "HC1")
+
+# Highest power of x kept in the prefix sums: enough for the cubic in the
+# IK pilot step and for HC meat with triangular weights.
+_MAX_POWER = 6
+
+
+class RDData:
+    """Outcome and running variable, sorted once by distance to the cutoff.
+
+    Rows with a missing outcome, running variable or control are dropped.
+    ``controls`` (a DataFrame or 2-d array) are only used by ``fit``.
+    """
+
+    def __init__(self, y, running, cutoff=0.0, controls=None):
+        self.y_name = getattr(y, "name", None) or "y"
+        self.x_name = getattr(running, "name", None) or "running"
+        self.cutoff = cutoff
+        y = np.asarray(y, dtype=float)
+        x = np.asarray(running, dtype=float) - cutoff
+        keep = ~(np.isnan(y) | np.isnan(x))
+        if controls is not None:
+            self.control_names = (list(controls.columns)
+                                  if isinstance(controls, pd.DataFrame) else
+                                  ["z%d" % i for i in
+                                   range(np.shape(controls)[1])])
+            controls = np.asarray(controls, dtype=float)
+            keep &= ~np.isnan(controls).any(axis=1)
+            controls = controls[keep]
+        self.controls = controls
+        self.y, self.x = y[keep], x[keep]
+        self.n = len(self.y)
+        self.y_mean = self.y.mean() if self.n else 0.0
+
+        # side -> row positions ordered by distance, and sorted distances
+        self.order, self.dist = {}, {}
+        for side, mask in (("left", self.x < 0), ("right", self.x >= 0)):
+            rows = np.flatnonzero(mask)
+            rows = rows[np.argsort(np.abs(self.x[rows]), kind="stable")]
+            self.order[side] = rows
+            self.dist[side] = np.abs(self.x[rows])
+        self._cum = {}
+
+    def count(self, h):
+        """Number of rows within ``h`` of the cutoff on each side."""
+        return (int(np.searchsorted(self.dist["left"], h, "right")),
+                int(np.searchsorted(self.dist["right"], h, "right")))
+
+    def moments(self, side, n):
+        """Table ``M[m, k] = sum(y**m * x**k)`` over the ``n`` rows
+        closest to the cutoff on ``side``, where ``y`` is centered at
+        ``y_mean`` and ``x`` at the cutoff."""
+        if side not in self._cum:
+            rows = self.order[side]
+            x, y = self.x[rows], self.y[rows] - self.y_mean
+            xk = x ** np.arange(_MAX_POWER + 1)[:, None]
+            terms = np.stack([xk, xk * y, xk * y**2])
+            cum = np.zeros(terms.shape[:2] + (len(rows) + 1,))
+            np.cumsum(terms, axis=2, out=cum[:, :, 1:])
+            self._cum[side] = cum
+        return self._cum[side][:, :, n]
+
+    def window(self, h):
+        """Row positions within ``h`` of the cutoff, left side first."""
+        nl, nr = self.count(h)
+        return np.concatenate([self.order["left"][:nl],
+                               self.order["right"][:nr]])
+
+    def bin_data(self, bins=50, bandwidth=None):
+        """Mean outcome in equal-width bins of the running variable.
+
+        Same output as ``rdd.bin_data(rdd.truncated_data(...), ...)``:
+        one row per bin with the mean outcome, the bin midpoint and the
+        number of observations.
+        """
+        rows = (np.arange(self.n) if bandwidth is None
+                else self.window(bandwidth))
+        x = self.x[rows] + self.cutoff
+        edges = np.histogram_bin_edges(x, bins=bins)
+        # Bins are half open except the last one, as in np.histogram
+        which = np.clip(np.searchsorted(edges, x, "right") - 1, 0, bins - 1)
+        n_obs = np.bincount(which, minlength=bins)
+        sums = np.bincount(which, weights=self.y[rows], minlength=bins)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            means = sums / n_obs
+        return pd.DataFrame({self.y_name: means,
+                             self.x_name: (edges[:-1] + edges[1:]) / 2,
+                             "n_obs": n_obs})
+
+    def _poly_fit(self, windows, degree, treat):
+        """Least squares of y on (1, [D,] x, ..., x**degree) from moments.
+
+        ``windows`` is a list of (side, n). Returns the coefficients; the
+        intercept is that of ``y - y_mean``.
+        """
+        tables = [(side, self.moments(side, n)) for side, n in windows]
+        # Rescale x so the normal equations stay well conditioned
+        total = sum(M[0, 0] for _, M in tables)
+        scale = np.sqrt(sum(M[0, 2] for _, M in tables) / total) or 1.0
+        powers = scale ** -np.arange(_MAX_POWER + 1)
+        k = degree + 1 + treat
+        xtx, xty = np.zeros((k, k)), np.zeros(k)
+        for side, M in tables:
+            M = M * powers
+            basis = np.zeros((k, degree + 1))
+            basis[0, 0] = 1
+            basis[k - degree:, 1:] = np.eye(degree)
+            if treat:
+                basis[1, 0] = side == "right"
+            hankel = M[0, np.add.outer(np.arange(degree + 1),
+                                       np.arange(degree + 1))]
+            xtx += basis @ hankel @ basis.T
+            xty += basis @ M[1, :degree + 1]
+        beta = linalg.solve(xtx, xty, assume_a="sym")
+        beta[k - degree:] *= powers[1:degree + 1]
+        return beta
+
+    def optimal_bandwidth(self):
+        """Imbens & Kalyanaraman (2012) bandwidth, as in ``rdd``."""
+        n = self.n
+        std = self.x.std(ddof=1)
+
+        # Step 1: density and conditional variance at the cutoff
+        h1 = 1.84 * std * n**-0.2
+        nl, nr = self.count(h1)
+        left, right = self.moments("left", nl), self.moments("right", nr)
+        ss = (left[2, 0] - left[1, 0]**2 / nl) + \
+            (right[2, 0] - right[1, 0]**2 / nr)
+        sig2c = ss / (nl + nr)
+        fxc = (nl + nr) / (2 * n * h1)
+
+        # Step 2: curvature on each side
+        n_left, n_right = len(self.order["left"]), len(self.order["right"])
+        med_left = np.median(self.dist["left"])
+        med_right = np.median(self.dist["right"])
+        cubic = self._poly_fit(
+            [("left", int(np.searchsorted(self.dist["left"], med_left,
+                                          "right"))),
+             ("right", int(np.searchsorted(self.dist["right"], med_right,
+                                           "right")))],
+            degree=3, treat=True)
+        m3 = 6 * cubic[-1]
+        pilot = (sig2c / (fxc * max(m3**2, 0.01))) ** (1 / 7)
+        h2_right = 3.56 * n_right**(-1 / 7) * pilot
+        h2_left = 3.56 * n_left**(-1 / 7) * pilot
+        nl2, _ = self.count(h2_left)
+        _, nr2 = self.count(h2_right)
+        m2_right = 2 * self._poly_fit([("right", nr2)], 2, False)[-1]
+        m2_left = 2 * self._poly_fit([("left", nl2)], 2, False)[-1]
+
+        # Step 3: regularized bandwidth
+        r_right = 720 * sig2c / (nr2 * h2_right**4)
+        r_left = 720 * sig2c / (nl2 * h2_left**4)
+        return 3.4375 * (2 * sig2c / (fxc * ((m2_right - m2_left)**2
+                                             + r_right + r_left)))**0.2 \
+            * n**-0.2
+
+    def _kernel_moments(self, side, n, h, kernel, power):
+        """Moments weighted by ``kernel(|x| / h) ** power``."""
+        M = self.moments(side, n)
+        if kernel == "uniform":
+            return M
+        # Triangular weight 1 - |x|/h is a polynomial in x on each side
+        sign = 1.0 if side == "right" else -1.0
+        out = np.zeros_like(M)
+        for j in range(power + 1):
+            coef = math.comb(power, j) * (-sign / h)**j
+            out[:, :M.shape[1] - j] += coef * M[:, j:]
+        return out
+
+    def _names(self, kernel, slopes, cov_type):
+        """Validate the fit options; return the names of the RD terms."""
+        if kernel not in KERNELS:
+            raise ValueError("kernel must be one of %s, got %r"
+                             % (KERNELS, kernel))
+        if slopes not in ("common", "separate"):
+            raise ValueError("slopes must be 'common' or 'separate', got %r"
+                             % slopes)
+        if cov_type not in COV_TYPES:
+            raise ValueError("cov_type must be one of %s, got %r"
+                             % (COV_TYPES, cov_type))
+        names = ["Intercept", "treated", self.x_name]
+        if slopes == "separate":
+            names.append("treated:" + self.x_name)
+        return names
+
+    def _design(self, side, slopes):
+        """Map from (1, x) on one side to the columns of the RD design."""
+        right = side == "right"
+        if slopes == "common":
+            return np.array([[1, 0], [right, 0], [0, 1]], dtype=float)
+        return np.array([[1, 0], [right, 0], [0, 1], [0, right]],
+                        dtype=float)
+
+    def fit(self, bandwidth=None, kernel="uniform", slopes="common",
+            cov_type="nonrobust"):
+        """Local linear RD fit within ``bandwidth`` of the cutoff.
+
+        ``slopes="common"`` fits ``y ~ 1 + treated + x`` as chapter 3 does;
+        ``"separate"`` adds ``treated:x``. The effect at the cutoff is
+        ``params['treated']``. With ``controls``, they are added linearly
+        and the fit runs on the rows of the window; otherwise it is computed
+        from the prefix sums alone. ``bandwidth=None`` uses every row.
+        A window with no more observations than parameters raises
+        ValueError.
+        """
+        names = self._names(kernel, slopes, cov_type)
+        if bandwidth is None:
+            if kernel != "uniform":
+                raise ValueError("a %s kernel needs a bandwidth" % kernel)
+            bandwidth = np.inf
+
+        nl, nr = self.count(bandwidth)
+        k = len(names) + (0 if self.controls is None
+                          else len(self.control_names))
+        if nl + nr <= k:
+            raise ValueError("%d observations within bandwidth %r, need "
+                             "more than %d" % (nl + nr, bandwidth, k))
+        if self.controls is not None:
+            return self._fit_rows(bandwidth, kernel, names, cov_type)
+
+        sides = [("left", nl), ("right", nr)]
+        xtx, xty = np.zeros((k, k)), np.zeros(k)
+        for side, n in sides:
+            A = self._design(side, slopes)
+            W = self._kernel_moments(side, n, bandwidth, kernel, 1)
+            xtx += A @ W[0, [[0, 1], [1, 2]]] @ A.T
+            xty += A @ W[1, :2]
+        beta = linalg.solve(xtx, xty, assume_a="sym")
+        bread = linalg.inv(xtx)
+
+        nobs = nl + nr
+        ssr = tss_y = tss_yy = sum_w = 0.0
+        meat = np.zeros((k, k))
+        for side, n in sides:
+            A = self._design(side, slopes)
+            c0, c1 = A.T @ beta
+            W = self._kernel_moments(side, n, bandwidth, kernel, 1)
+            ssr += (W[2, 0] - 2 * (c0 * W[1, 0] + c1 * W[1, 1])
+                    + c0**2 * W[0, 0] + 2 * c0 * c1 * W[0, 1]
+                    + c1**2 * W[0, 2])
+            sum_w += W[0, 0]
+            tss_y += W[1, 0]
+            tss_yy += W[2, 0]
+            if cov_type != "nonrobust":
+                V = self._kernel_moments(side, n, bandwidth, kernel, 2)
+                e2 = [V[2, j] - 2 * c0 * V[1, j] - 2 * c1 * V[1, j + 1]
+                      + c0**2 * V[0, j] + 2 * c0 * c1 * V[0, j + 1]
+                      + c1**2 * V[0, j + 2] for j in range(3)]
+                meat += A @ np.array([[e2[0], e2[1]], [e2[1], e2[2]]]) @ A.T
+        if cov_type == "nonrobust":
+            cov = bread * ssr / (nobs - k)
+        else:
+            cov = bread @ meat @ bread
+            if cov_type == "HC1":
+                cov *= nobs / (nobs - k)
+        # The moments are of y - y_mean: shift the intercept back
+        params = pd.Series(beta, names)
+        params.iloc[0] += self.y_mean
+        return Result(params, cov, nobs=nobs,
+                      df_resid=nobs - k, cov_type=cov_type, ssr=ssr,
+                      centered_tss=tss_yy - tss_y**2 / sum_w,
+                      bandwidth=bandwidth, kernel=kernel,
+                      n_left=nl, n_right=nr)
+
+    def _rows(self, rows, separate):
+        """RD design (with controls) for the given row positions."""
+        x = self.x[rows]
+        treated = (x >= 0).astype(float)
+        columns = [np.ones(len(rows)), treated, x]
+        if separate:
+            columns.append(treated * x)
+        return np.column_stack(columns + [self.controls[rows]])
+
+    def _fit_rows(self, bandwidth, kernel, names, cov_type):
+        rows = self.window(bandwidth)
+        x = self.x[rows]
+        X = self._rows(rows, len(names) == 4)
+        weights = None
+        if kernel == "triangular":
+            weights = 1 - np.abs(x) / bandwidth
+        result = ols(self.y[rows], pd.DataFrame(
+            X, columns=names + self.control_names), weights=weights,
+            cov_type=cov_type)
+        nl, nr = self.count(bandwidth)
+        result.info.update(bandwidth=bandwidth, kernel=kernel,
+                           n_left=nl, n_right=nr)
+        return result
+
+    def sweep(self, bandwidths, kernel="uniform", slopes="common",
+              cov_type="nonrobust"):
+        """RD estimate at every bandwidth in ``bandwidths``.
+
+        Returns a DataFrame indexed by bandwidth (ascending) with the effect
+        ``tau``, its standard error ``se`` and the number of observations.
+        Without controls every bandwidth costs O(1) from the prefix sums.
+        With controls the bandwidths are visited in increasing order and
+        only the rows entering the window are added to running ``X'X``,
+        ``X'y`` and ``y'y`` sums, so the whole sweep reads each row once;
+        HC covariances additionally need one pass over the window per
+        bandwidth to form the residuals. Bandwidths with too few
+        observations to identify the model give NaN.
+        """
+        names = self._names(kernel, slopes, cov_type)
+        bandwidths = np.sort(np.asarray(bandwidths, dtype=float))
+        table = pd.DataFrame(np.nan, index=pd.Index(bandwidths,
+                                                     name="bandwidth"),
+                             columns=["tau", "se", "n", "n_left",
+                                      "n_right"])
+        counts = np.array([self.count(h) for h in bandwidths]).reshape(-1, 2)
+        table["n_left"], table["n_right"] = counts[:, 0], counts[:, 1]
+        table["n"] = counts.sum(axis=1)
+
+        if self.controls is None:
+            for i, h in enumerate(bandwidths):
+                if counts[i].sum() <= len(names):
+                    continue
+                try:
+                    result = self.fit(h, kernel, slopes, cov_type)
+                except linalg.LinAlgError:
+                    continue
+                table.iloc[i, :2] = (result.params["treated"],
+                                     result.bse["treated"])
+            return table
+
+        k = len(names) + len(self.control_names)
+        # Running sums of [X, y]'[X, y] (y centered as in ``moments``), and
+        # the same weighted by |x| for the triangular kernel, whose weight
+        # 1 - |x|/h depends on h.
+        s0 = np.zeros((k + 1, k + 1))
+        s1 = np.zeros((k + 1, k + 1))
+        done = {"left": 0, "right": 0}
+        for i, h in enumerate(bandwidths):
+            for side, n in zip(("left", "right"), counts[i]):
+                rows = self.order[side][done[side]:n]
+                done[side] = n
+                Z = np.column_stack([self._rows(rows, len(names) == 4),
+                                     self.y[rows] - self.y_mean])
+                s0 += Z.T @ Z
+                if kernel == "triangular":
+                    s1 += (Z * self.dist[side][n - len(rows):n, None]).T @ Z
+            S = s0 if kernel == "uniform" else s0 - s1 / h
+            nobs = counts[i].sum()
+            try:
+                beta = linalg.solve(S[:k, :k], S[:k, k], assume_a="sym")
+                bread = linalg.inv(S[:k, :k])
+            except linalg.LinAlgError:
+                continue
+            if nobs <= k:
+                continue
+            if cov_type == "nonrobust":
+                ssr = S[k, k] - beta @ S[:k, k]
+                var = bread[1, 1] * ssr / (nobs - k)
+            else:
+                rows = self.window(h)
+                X = self._rows(rows, len(names) == 4)
+                resid = self.y[rows] - self.y_mean - X @ beta
+                scores = X * resid[:, None]
+                if kernel == "triangular":
+                    scores *= 1 - np.abs(self.x[rows, None]) / h
+                g = bread[1] @ scores.T
+                var = g @ g
+                if cov_type == "HC1":
+                    var *= nobs / (nobs - k)
+            table.iloc[i, :2] = beta[1], np.sqrt(var)
+        return table
+
+
+def optimal_bandwidth(y, running, cutoff=0.0):
+    """Imbens & Kalyanaraman (2012) bandwidth; see ``RDData``."""
+    return RDData(y, running, cutoff).optimal_bandwidth()
+
+
+def bin_data(y, running, bins=50, cutoff=0.0, bandwidth=None):
+    """Binned means of ``y``; see ``RDData.bin_data``."""
+    return RDData(y, running, cutoff).bin_data(bins, bandwidth)
+
+
+def rd_sweep(y, running, cutoff=0.0, bandwidths=(), controls=None,
+             kernel="uniform", slopes="common", cov_type="nonrobust"):
+    """Sharp RD estimates over a grid of bandwidths; see ``RDData.sweep``.
+    """
+    return RDData(y, running, cutoff, controls).sweep(
+        bandwidths, kernel=kernel, slopes=slopes, cov_type=cov_type)
+
+
+def sharp_rd(y, running, cutoff=0.0, bandwidth=None, controls=None,
+             kernel="uniform", slopes="common", cov_type="nonrobust"):
+    """One sharp RD fit; see ``RDData.fit``."""
+    return RDData(y, running, cutoff, controls).fit(
+        bandwidth, kernel=kernel, slopes=slopes, cov_type=cov_type)
@@ -0,0 +1,130 @@
+"""Least squares on arrays, shared by the estimators in this package.
+
+``ols`` is a lean replacement for ``sm.OLS(y, X, missing='drop').fit()``:
+it takes the same ``y`` and ``X`` (Series/DataFrames or arrays), solves by
+QR and returns a ``causal_methods.results.Result``.
+"""
+
+import numpy as np
+import pandas as pd
+from scipy import linalg, sparse
+
+from causal_methods import covariance
+from causal_methods.covariance import COV_TYPES, check_cov_type  # noqa: F401
+from causal_methods.profiling import span
+from causal_methods.results import Result
+
+
+def column_names(X, default="x%d"):
+    if isinstance(X, pd.DataFrame):
+        return list(X.columns)
+    X = np.asarray(X)
+    return [default % i for i in range(1 if X.ndim == 1 else X.shape[1])]
+
+
+@span("fit")
+def solve(X, y, weights=None):
+    """Return (beta, bread, resid) for weighted least squares.
+
+    ``bread`` is ``(X'WX)^-1``; ``resid`` are the unweighted residuals.
+    ``y`` may be a matrix, in which case every column is solved against the
+    same factorization.
+    """
+    if weights is None:
+        Xw, yw = X, y
+    else:
+        sw = np.sqrt(weights)
+        Xw = X * sw[:, None]
+        yw = y * (sw[:, None] if y.ndim == 2 else sw)
+    q, r = linalg.qr(Xw, mode="economic")
+    beta = linalg.solve_triangular(r, q.T @ yw)
+    r_inv = linalg.solve_triangular(r, np.eye(r.shape[0]))
+    bread = r_inv @ r_inv.T
+    return beta, bread, y - X @ beta
+
+
+def k_constant(X, bread, weights=None):
+    """1 if the columns of ``X`` (dense or sparse) span a constant, else
+    0, as statsmodels' ``k_constant``.
+
+    A column that is constant and non-zero counts, and so does a full set
+    of dummies: regressing a column of ones on ``X`` then leaves no
+    residual. ``bread`` is ``(X'WX)^-1``, or None to run that regression
+    by LSQR.
+    """
+    if X.shape[0] == 0:
+        return 0
+    high, low = X.max(axis=0), X.min(axis=0)
+    if sparse.issparse(high):
+        high, low = high.toarray().ravel(), low.toarray().ravel()
+    if ((high == low) & (high != 0)).any():
+        return 1
+    w = np.ones(X.shape[0]) if weights is None else weights
+    if bread is None:
+        from scipy.sparse import linalg as splinalg
+
+        sw = np.sqrt(w)
+        Xw = sparse.diags(sw) @ X
+        resid = sw - Xw @ splinalg.lsqr(Xw, sw, atol=1e-12,
+                                        btol=1e-12)[0]
+        unexplained = resid @ resid
+    else:
+        sums = X.T @ w
+        unexplained = w.sum() - sums @ bread @ sums
+    return int(unexplained <= 1e-8 * w.sum())
+
+
+def sandwich(X, resid, bread, weights=None, cov_type="HC1", groups=None,
+             k=None):
+    """Heteroskedasticity- or cluster-robust covariance for one outcome.
+
+    ``groups`` are the cluster labels (one or two variables) for
+    ``cov_type="cluster"``. ``k`` is the number of parameters used in the
+    small-sample correction; it defaults to the columns of ``X`` but must
+    also count absorbed fixed effects. See ``covariance.robust_cov``.
+    """
+    scores = X * resid[:, None]
+    if weights is not None:
+        scores *= weights[:, None]
+    return covariance.robust_cov(scores, bread, cov_type, groups, k)
+
+
+def ols(y, X, weights=None, cov_type="nonrobust", groups=None):
+    """Ordinary (or weighted) least squares; rows with NaN are dropped.
+
+    ``cov_type`` is one of ``COV_TYPES``; ``"cluster"`` needs the cluster
+    labels in ``groups`` (two columns for two-way clustering). Unlike
+    statsmodels, rows with a missing cluster label are dropped too.
+    """
+    check_cov_type(cov_type, groups)
+    names = column_names(X)
+    y = np.asarray(y, dtype=float)
+    X = np.asarray(X, dtype=float)
+    if X.ndim == 1:
+        X = X[:, None]
+    keep = ~(np.isnan(y) | np.isnan(X).any(axis=1))
+    if weights is not None:
+        weights = np.asarray(weights, dtype=float)
+        keep &= ~np.isnan(weights)
+    if groups is not None:
+        keep &= ~covariance.missing_groups(groups)
+        groups = covariance.take_rows(groups, keep)
+    if not keep.all():
+        y, X = y[keep], X[keep]
+    if weights is not None:
+        weights = weights[keep]
+
+    beta, bread, resid = solve(X, y, weights)
+    n, k = X.shape
+    w = np.ones(n) if weights is None else weights
+    ssr = w @ resid**2
+    ybar = (w @ y) / w.sum()
+    centered_tss = w @ (y - ybar)**2
+    if cov_type == "nonrobust":
+        cov = bread * ssr / (n - k)
+    else:
+        cov = sandwich(X, resid, bread, weights, cov_type, groups)
+    return Result(pd.Series(beta, names), cov, nobs=n, df_resid=n - k,
+                  cov_type=cov_type, ssr=ssr, centered_tss=centered_tss,
+                  uncentered_tss=w @ y**2,
+                  k_constant=k_constant(X, bread, weights))
@@ -0,0 +1,236 @@
+"""Result objects returned by the estimators in this package.
+
+A statsmodels results object keeps its model, and with it the data, the
+design matrix and the weights, alive. A ``Result`` only holds the
+estimates, their covariance, the degrees of freedom and a few fit
+statistics, as plain arrays in ``__slots__``: thousands of them, e.g. from
+a ``grid.SpecificationGrid``, cost little memory and pickle in a few
+hundred bytes each. Pandas objects and summary tables are only built
+when asked for::
+
+    print(result.summary())
+    result.summary().tables[1]
+
+and ``stargazer`` builds a ``Stargazer`` table from a list of results::
+
+    from causal_methods.results import stargazer
+    stargazer(result2).title('Table 2 - Callback Rates by Resume Type')
+"""
+
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+# Names of the constant, excluded from the F-test of the regression
+CONSTANTS = ("Intercept", "const")
+
+
+class Result:
+    """Estimates, covariance and fit statistics of a linear model.
+
+    Follows the attribute names of statsmodels results (``params``,
+    ``bse``, ``pvalues``, ``nobs``, ...), so code written for
+    ``sm.OLS(...).fit()`` works unchanged. ``k_constant`` is 0 for a
+    model without a constant, whose R-squared is then measured against
+    ``uncentered_tss``. Inference uses the t
+    distribution for the classical covariance and the normal distribution
+    for robust and clustered covariances, as statsmodels does.
+    """
+
+    __slots__ = ("names", "values", "cov", "nobs", "df_resid", "cov_type",
+                 "ssr", "centered_tss", "uncentered_tss", "k_constant",
+                 "info")
+
+    def __init__(self, params, cov, nobs, df_resid, cov_type="nonrobust",
+                 ssr=None, centered_tss=None, uncentered_tss=None,
+                 k_constant=1, **info):
+        params = pd.Series(params)
+        self.names = list(params.index)
+        self.values = params.to_numpy(float)
+        self.cov = np.asarray(cov, dtype=float)
+        self.nobs = nobs
+        self.df_resid = df_resid
+        self.cov_type = cov_type
+        self.ssr = ssr
+        self.centered_tss = centered_tss
+        self.uncentered_tss = uncentered_tss
+        self.k_constant = k_constant
+        self.info = info
+
+    @property
+    def params(self):
+        return pd.Series(self.values, self.names)
+
+    @property
+    def use_t(self):
+        return self.cov_type == "nonrobust"
+
+    def cov_params(self):
+        return pd.DataFrame(self.cov, self.names, self.names)
+
+    @property
+    def bse(self):
+        return pd.Series(np.sqrt(np.diag(self.cov)), self.names)
+
+    @property
+    def tvalues(self):
+        return self.params / self.bse
+
+    @property
+    def pvalues(self):
+        t = np.abs(self.tvalues)
+        if self.use_t:
+            p = 2 * stats.t.sf(t, self.df_resid)
+        else:
+            p = 2 * stats.norm.sf(t)
+        return pd.Series(p, self.names)
+
+    @property
+    def rsquared(self):
+        # Without a constant, statsmodels compares the fit with y = 0
+        tss = self.centered_tss if self.k_constant \
+            else self.uncentered_tss
+        if self.ssr is None or tss is None:
+            return np.nan
+        return 1 - self.ssr / tss
+
+    @property
+    def rsquared_adj(self):
+        return 1 - (1 - self.rsquared) * (self.nobs - self.k_constant) \
+            / self.df_resid
+
+    @property
+    def df_model(self):
+        return self.nobs - self.df_resid - self.k_constant
+
+    @property
+    def resid_std_err(self):
+        if self.ssr is None:
+            return np.nan
+        return np.sqrt(self.ssr / self.df_resid)
+
+    def _f_test(self):
+        # Wald test that all coefficients but the constant are zero, with
+        # the covariance of the fit, as statsmodels' ``fvalue``
+        tested = [i for i, name in enumerate(self.names)
+                  if name not in CONSTANTS]
+        if not tested:
+            return np.nan, np.nan
+        b = self.values[tested]
+        try:
+            wald = b @ np.linalg.solve(self.cov[np.ix_(tested, tested)], b)
+        except np.linalg.LinAlgError:
+            return np.nan, np.nan
+        f = wald / len(tested)
+        return f, stats.f.sf(f, len(tested), self.df_resid)
+
+    @property
+    def fvalue(self):
+        return self._f_test()[0]
+
+    @property
+    def f_pvalue(self):
+        return self._f_test()[1]
+
+    def conf_int(self, alpha=0.05):
+        if self.use_t:
+            q = stats.t.isf(alpha / 2, self.df_resid)
+        else:
+            q = stats.norm.isf(alpha / 2)
+        bse = self.bse
+        return pd.DataFrame({0: self.params - q * bse,
+                             1: self.params + q * bse})
+
+    def summary(self):
+        """A ``Summary``, rendered when printed or displayed."""
+        return Summary(self)
+
+    def __repr__(self):
+        return "<%s nobs=%d cov_type=%s>\n%s" % (
+            type(self).__name__, self.nobs, self.cov_type,
+            self.summary().tables[1])
+
+
+class Summary:
+    """Summary tables of a ``Result``, like statsmodels' ``summary()``.
+
+    ``tables[0]`` holds the fit statistics and ``tables[1]`` the
+    coefficient table; both are built on access.
+    """
+
+    __slots__ = ("result",)
+
+    def __init__(self, result):
+        self.result = result
+
+    @property
+    def tables(self):
+        r = self.result
+        ci = r.conf_int()
+        label = "t" if r.use_t else "z"
+        f, f_pvalue = r._f_test()
+        fit = pd.DataFrame({"": [
+            r.info.get("dependent", ""), r.nobs, r.df_resid, r.df_model,
+            r.cov_type, r.rsquared, r.rsquared_adj, f, f_pvalue]},
+            index=["Dep. Variable", "No. Observations", "Df Residuals",
+                   "Df Model", "Covariance Type", "R-squared",
+                   "Adj. R-squared", "F-statistic", "Prob (F-statistic)"])
+        coefficients = pd.DataFrame({"coef": r.params,
+                                     "std err": r.bse,
+                                     label: r.tvalues,
+                                     "P>|%s|" % label: r.pvalues,
+                                     "[0.025": ci[0],
+                                     "0.975]": ci[1]})
+        return [fit, coefficients]
+
+    def as_text(self):
+        fit, coefficients = self.tables
+        return "%s\n\n%s" % (fit.to_string(header=False),
+                             coefficients.to_string())
+
+    def as_html(self):
+        fit, coefficients = self.tables
+        return fit.to_html(header=False) + coefficients.to_html()
+
+    def __str__(self):
+        return self.as_text()
+
+    def _repr_html_(self):
+        return self.as_html()
+
+
+def _stargazer_data(result):
+    # The fields Stargazer reads from a fitted model
+    ci = result.conf_int()
+    f, f_pvalue = result._f_test()
+    return {
+        "dependent_variable": result.info.get("dependent", "y"),
+        "cov_names": np.array(result.names, dtype=object),
+        "cov_values": result.params,
+        "cov_std_err": result.bse,
+        "p_values": result.pvalues,
+        "conf_int_low_values": ci[0],
+        "conf_int_high_values": ci[1],
+        "r2": result.rsquared,
+        "r2_adj": result.rsquared_adj,
+        "pseudo_r2": None,
+        "f_statistic": f,
+        "f_p_value": f_pvalue,
+        "degree_freedom": result.df_model,
+        "degree_freedom_resid": result.df_resid,
+        "nobs": result.nobs,
+        "resid_std_err": result.resid_std_err,
+    }
+
+
+def register_stargazer():
+    """Let ``Stargazer`` accept ``Result`` objects (needs stargazer)."""
+    from stargazer.translators import register_class
+    register_class(Result, _stargazer_data)
+
+
+def stargazer(results):
+    """A ``Stargazer`` table of a list (or Series) of ``Result``."""
+    from stargazer.stargazer import Stargazer
+    register_stargazer()
+    return Stargazer(list(results))
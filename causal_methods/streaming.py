@@ -0,0 +1,275 @@
+"""Out-of-core OLS and 2SLS from an iterator of chunks.
+
+``sm.OLS``, ``smf.ols``, ``PanelOLS`` and ``IV2SLS`` need the whole
+DataFrame in memory. The estimates and their covariances only depend on
+sums over rows, so they can be accumulated one chunk at a time, from a CSV
+reader or a memory-mapped frame of ``causal_methods.data``::
+
+    chunks = pd.read_csv(path + "Airbnb.csv", chunksize=100000)
+    streaming_ols(chunks, 'yes', ['guest_black'], cov_type='cluster',
+                  groups='name_by_city')
+
+For the variables ``v = [y, X, instruments]`` an ``Accumulator`` keeps
+``sum w v v'`` and, depending on the covariance, either the fourth moments
+``sum w^2 (v x v)(v x v)'`` (heteroskedasticity-robust) or ``sum w v v'``
+within each cluster (cluster-robust). The residual of any coefficient
+vector is linear in ``v``, so the sandwich "meat" follows exactly after
+the last chunk, in a single pass over the data.
+
+Accumulators pickle, and two accumulators of the same regression built on
+different shards ``merge`` into the accumulator of the pooled data, in any
+order. ``map_reduce`` uses this to fit one regression over partitioned
+files with a process pool, shipping sums instead of rows::
+
+    acc = Accumulator('call_back', ['black'], cov_type='HC1')
+    map_reduce(paths, acc, workers=4).fit()
+"""
+
+import copy
+from concurrent.futures import ProcessPoolExecutor
+from functools import reduce
+
+import numpy as np
+import pandas as pd
+from scipy import linalg
+
+from causal_methods import covariance
+from causal_methods.covariance import check_cov_type
+from causal_methods.results import Result
+
+
+def iter_chunks(frame, chunksize=100000):
+    """Yield consecutive row slices of ``frame``.
+
+    With a frame read by ``data.read_frame`` the columns are memory-mapped,
+    so only the current slice is read from disk.
+    """
+    for start in range(0, len(frame), chunksize):
+        yield frame.iloc[start:start + chunksize]
+
+
+class Accumulator:
+    """Sufficient statistics of a linear (IV) regression, chunk by chunk.
+
+    ``y`` is the outcome column; ``exog`` the exogenous regressors,
+    ``endog`` the endogenous ones and ``instruments`` the excluded
+    instruments (all column names). With ``constant=True`` a ``const``
+    column of ones is prepended to ``exog``. ``cov_type`` decides which
+    statistics are kept; ``"cluster"`` needs ``groups``, the name of the
+    cluster column (or a list of two names for two-way clustering). Rows
+    with a missing value are dropped chunk by chunk.
+    """
+
+    def __init__(self, y, exog, endog=(), instruments=(), weights=None,
+                 cov_type="nonrobust", groups=None, constant=True):
+        check_cov_type(cov_type, groups)
+        exog, endog, instruments = list(exog), list(endog), \
+            list(instruments)
+        if len(instruments) < len(endog):
+            raise ValueError("need at least as many instruments as "
+                             "endogenous regressors")
+        self.constant = constant
+        self.names = ["const"] * constant + exog + endog
+        self.columns = [y] + exog + endog + instruments
+        self.weights = weights
+        self.cov_type = cov_type
+        self.groups = ([groups] if isinstance(groups, str)
+                       else list(groups or []))
+        p = len(self.columns) + constant
+        # Positions in v = [y, const, exog, endog, instruments]
+        self.x = list(range(1, 1 + len(self.names)))
+        self.q = list(range(1, 1 + constant + len(exog))) \
+            + list(range(p - len(instruments), p))
+        if not endog:
+            self.q = self.x
+
+        self.nobs = 0
+        self.sum_weights = 0.0
+        self.total = np.zeros(p)
+        self.cross = np.zeros((p, p))
+        self.fourth = (np.zeros((p * p, p * p))
+                       if cov_type in ("HC0", "HC1") else None)
+        self.labels = [pd.Index([]) for _ in self.groups]
+        self.cells = pd.Index([], dtype="int64")
+        self.cell_groups = np.zeros((0, len(self.groups)), dtype=np.int64)
+        self.cell_cross = np.zeros((0, p, p))
+
+    def _spec(self):
+        return (self.columns, self.names, self.x, self.q, self.weights,
+                self.cov_type, self.groups)
+
+    def _codes(self, i, values):
+        # Codes of the labels of cluster variable i, extending the labels
+        # seen so far
+        new = pd.unique(values[self.labels[i].get_indexer(values) < 0])
+        if len(new):
+            self.labels[i] = self.labels[i].append(pd.Index(new))
+        return self.labels[i].get_indexer(values)
+
+    def _cells(self, codes):
+        # Index of the cluster (or two-way intersection) cell of each row,
+        # adding the cells not seen so far
+        key = codes[0].astype(np.int64)
+        if len(codes) == 2:
+            key = key * 2**32 + codes[1]
+        cells = self.cells.get_indexer(key)
+        fresh = cells < 0
+        if fresh.any():
+            new, first = np.unique(key[fresh], return_index=True)
+            self.cells = self.cells.append(pd.Index(new))
+            self.cell_groups = np.vstack(
+                [self.cell_groups,
+                 np.column_stack(codes)[np.flatnonzero(fresh)[first]]])
+            self.cell_cross = np.concatenate(
+                [self.cell_cross,
+                 np.zeros((len(new),) + self.cross.shape)])
+            cells = self.cells.get_indexer(key)
+        return cells
+
+    def update(self, chunk):
+        """Add the rows of the DataFrame ``chunk``."""
+        needed = self.columns + self.groups \
+            + ([self.weights] if self.weights is not None else [])
+        frame = chunk[list(dict.fromkeys(needed))].dropna()
+        if not len(frame):
+            return self
+        v = frame[self.columns].to_numpy(float)
+        if self.constant:
+            v = np.column_stack([v[:, :1], np.ones(len(v)), v[:, 1:]])
+        w = (np.ones(len(v)) if self.weights is None
+             else frame[self.weights].to_numpy(float))
+        wv = v * w[:, None]
+        self.nobs += len(v)
+        self.sum_weights += w.sum()
+        self.total += wv.sum(axis=0)
+        self.cross += wv.T @ v
+        p = v.shape[1]
+        if self.fourth is not None:
+            outer = (wv[:, :, None] * v[:, None, :]).reshape(len(v), p * p)
+            self.fourth += outer.T @ outer
+        if self.cov_type == "cluster":
+            cells = self._cells([self._codes(i, frame[column].to_numpy())
+                                 for i, column in enumerate(self.groups)])
+            outer = (wv[:, :, None] * v[:, None, :]).reshape(len(v), p * p)
+            self.cell_cross += covariance.group_sums(
+                outer, cells, len(self.cells)).reshape(-1, p, p)
+        return self
+
+    def merge(self, other):
+        """Add the statistics of ``other``, an accumulator of the same
+        regression built on other rows; returns ``self``."""
+        if self._spec() != other._spec():
+            raise ValueError("cannot merge accumulators of different "
+                             "regressions")
+        self.nobs += other.nobs
+        self.sum_weights += other.sum_weights
+        self.total += other.total
+        self.cross += other.cross
+        if self.fourth is not None:
+            self.fourth += other.fourth
+        if len(other.cells):
+            # Cluster labels are numbered in the order each shard saw them
+            codes = [self._codes(i, other.labels[i].to_numpy()
+                                 [other.cell_groups[:, i]])
+                     for i in range(len(self.groups))]
+            cells = self._cells(codes)
+            self.cell_cross[cells] += other.cell_cross
+        return self
+
+    def fit(self):
+        """The OLS (or 2SLS, with instruments) fit of the data seen so far,
+        as a ``Result`` like ``regression.ols``."""
+        x, q, cross = self.x, self.q, self.cross
+        n, k = self.nobs, len(x)
+        # Projection of the regressors on the instruments (identity for
+        # OLS): the scores are pi' q e
+        pi = linalg.solve(cross[np.ix_(q, q)], cross[np.ix_(q, x)],
+                          assume_a="pos")
+        xx = cross[np.ix_(x, q)] @ pi
+        bread = linalg.inv(xx)
+        beta = bread @ (pi.T @ cross[q, 0])
+        # Residuals are v @ c
+        c = np.zeros(len(cross))
+        c[0] = 1
+        c[x] = -beta
+        ssr = c @ cross @ c
+        mean = self.total[0] / self.sum_weights
+        centered_tss = cross[0, 0] - self.sum_weights * mean**2
+        # Without ``const``, the regressors may still span a constant
+        # (see ``regression.k_constant``)
+        sums = self.total[x]
+        unexplained = self.sum_weights - sums @ linalg.solve(
+            cross[np.ix_(x, x)], sums, assume_a="pos")
+        constant = int(self.constant
+                       or unexplained <= 1e-8 * self.sum_weights)
+
+        if self.cov_type == "nonrobust":
+            cov = bread * ssr / (n - k)
+        elif self.cov_type == "cluster":
+            scores = self.cell_cross[:, q, :] @ c @ pi
+            meat = covariance.cluster_meat(scores, self.cell_groups) \
+                * ((n - 1) / (n - k))
+            cov = bread @ meat @ bread
+        else:
+            p = len(cross)
+            fourth = self.fourth.reshape(p, p, p, p)
+            meat_q = np.einsum("abcd,c,d->ab", fourth[np.ix_(q, q)], c, c)
+            meat = pi.T @ meat_q @ pi
+            if self.cov_type == "HC1":
+                meat *= n / (n - k)
+            cov = bread @ meat @ bread
+        return Result(pd.Series(beta, self.names), cov, nobs=n,
+                      df_resid=n - k, cov_type=self.cov_type, ssr=ssr,
+                      centered_tss=centered_tss, uncentered_tss=cross[0, 0],
+                      k_constant=constant)
+
+
+def streaming_ols(chunks, y, X, weights=None, cov_type="nonrobust",
+                  groups=None, constant=True):
+    """OLS of column ``y`` on the columns ``X`` over an iterable of
+    DataFrame chunks; the same ``Result`` as the in-memory ``ols``."""
+    acc = Accumulator(y, X, weights=weights, cov_type=cov_type,
+                      groups=groups, constant=constant)
+    for chunk in chunks:
+        acc.update(chunk)
+    return acc.fit()
+
+
+def streaming_iv(chunks, y, exog, endog, instruments, weights=None,
+                 cov_type="nonrobust", groups=None, constant=True):
+    """2SLS of ``y`` on ``exog`` and ``endog``, instrumenting ``endog``
+    with ``instruments``, over an iterable of DataFrame chunks."""
+    acc = Accumulator(y, exog, endog, instruments, weights=weights,
+                      cov_type=cov_type, groups=groups, constant=constant)
+    for chunk in chunks:
+        acc.update(chunk)
+    return acc.fit()
+
+
+def _accumulate(accumulator, source, reader, kwargs):
+    data = reader(source, **kwargs)
+    for chunk in [data] if isinstance(data, pd.DataFrame) else data:
+        accumulator.update(chunk)
+    return accumulator
+
+
+def map_reduce(sources, accumulator, reader=pd.read_csv, workers=None,
+               **kwargs):
+    """Accumulate every source into ``accumulator`` and return it.
+
+    ``reader(source, **kwargs)`` must return a DataFrame or an iterator of
+    chunks (e.g. ``pd.read_csv`` with ``chunksize``). With ``workers``
+    each source is read into a copy of the (empty) ``accumulator`` in a
+    process pool, and the partial accumulators are merged.
+    """
+    if workers is None or workers <= 1:
+        for source in sources:
+            _accumulate(accumulator, source, reader, kwargs)
+        return accumulator
+    sources = list(sources)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        parts = pool.map(_accumulate,
+                         [copy.deepcopy(accumulator) for _ in sources],
+                         sources, [reader] * len(sources),
+                         [kwargs] * len(sources))
+        return reduce(Accumulator.merge, parts, accumulator)
@@ -0,0 +1,207 @@
+"""Synthetic control with a batched simplex-constrained solver.
+
+Chapter 7 compares the cities that opened a tippelzone with the others
+through ``df.groupby('group')[outcome].mean()``, and chapter 5 draws the
+counterfactual of the Atlanta Fed as a parallel shift of its line. A
+synthetic control instead weights the donor units, ``w >= 0`` and
+``sum(w) = 1``, to reproduce the treated unit before treatment::
+
+    wide = df.pivot_table('lnrapeN', 'year', 'city')   # time x unit
+    sc = SyntheticControl(wide, 'Amsterdam', 2004)
+    sc.weights          # donor weights
+    sc.gap              # treated minus synthetic, every period
+    sc.placebos(workers=4)
+
+The weights minimize ``||x1 - X0 w||**2`` over the simplex. Written in
+terms of the Gram matrix ``G = X'X`` of all units, every such problem,
+the treated unit's and one per placebo-in-space run, is
+``min 1/2 w'Gw - c'w`` over a masked simplex with the same ``G``, formed
+once. ``simplex_weights`` solves a batch of them exactly with an
+active-set method whose linear systems are no larger than the number of
+predictors, instead of a generic ``scipy.optimize`` call per problem. The
+placebo batch can be split across a process pool.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+
+def _active_set(gram, c, allowed, start, tol, maxiter):
+    # Primal active-set method from the vertex ``start``: minimize on the
+    # current support (a small equality-constrained least squares), step
+    # back to feasibility by dropping units whose weight would turn
+    # negative, and add the unit with the most negative reduced gradient
+    # until the optimality (KKT) conditions hold
+    w = np.zeros(len(c))
+    w[start] = 1
+    support = [start]
+    scale = tol * max(np.abs(c).max(), 1)
+    for _ in range(maxiter):
+        m = len(support)
+        A = np.ones((m + 1, m + 1))
+        A[:m, :m] = gram[np.ix_(support, support)]
+        A[m, m] = 0
+        v = np.linalg.lstsq(A, np.r_[c[support], 1], rcond=None)[0][:m]
+        current = w[support]
+        negative = v < 0
+        if negative.any():
+            ratio = current[negative] / (current[negative] - v[negative])
+            step = current + ratio.min() * (v - current)
+            w[support] = np.where(step > tol, step, 0)
+            support = [j for j in support if w[j] > 0]
+            continue
+        w[support] = v
+        gradient = gram[:, support] @ v - c
+        level = gradient[support].mean()
+        candidates = allowed.copy()
+        candidates[support] = False
+        if not candidates.any():
+            break
+        j = np.flatnonzero(candidates)[np.argmin(gradient[candidates])]
+        if gradient[j] >= level - scale:
+            break
+        support.append(j)
+    else:
+        raise RuntimeError("simplex weights did not converge in %d "
+                           "iterations" % maxiter)
+    return w
+
+
+def simplex_weights(gram, c, mask=None, tol=1e-10, maxiter=10000):
+    """Solve ``min 1/2 w'Gw - c'w`` over the (masked) simplex for every row
+    of ``c``.
+
+    ``gram`` is the ``n x n`` matrix ``G``, ``c`` an ``m x n`` array and
+    ``mask`` an ``m x n`` boolean array of the allowed entries. Returns
+    the ``m x n`` weights. With ``G = X'X`` and ``c = X'x`` this is the
+    least-squares fit of ``x`` by a convex combination of the columns of
+    ``X``.
+
+    Each problem is solved exactly by an active-set method started from
+    its best single unit; the solution has at most ``rank(G) + 1``
+    nonzero weights, so every step only solves a small linear system.
+    """
+    gram = np.asarray(gram, dtype=float)
+    c = np.atleast_2d(np.asarray(c, dtype=float))
+    if mask is None:
+        mask = np.ones(c.shape, dtype=bool)
+    mask = np.atleast_2d(mask)
+    if not mask.any(axis=1).all():
+        raise ValueError("every problem needs at least one allowed entry")
+    # Objective at every vertex, for all problems at once
+    vertex = np.where(mask, np.diag(gram) / 2 - c, np.inf)
+    starts = vertex.argmin(axis=1)
+    return np.array([_active_set(gram, c[i], mask[i], starts[i], tol,
+                                 maxiter)
+                     for i in range(len(c))])
+
+
+def _fit(X, targets, masks, tol):
+    # Weights of the target columns of X, each on its masked donors
+    gram = X.T @ X
+    return simplex_weights(gram, X[:, targets].T @ X, masks, tol)
+
+
+class SyntheticControl:
+    """Synthetic control of one treated unit.
+
+    ``outcomes`` is a DataFrame with one row per period (sorted) and one
+    column per unit; ``treated`` is the column of the treated unit and
+    ``start`` the first treated period. The weights fit the pre-treatment
+    outcomes, plus the rows of ``predictors`` (a DataFrame with one column
+    per unit, e.g. averages of covariates) standardized across units and
+    scaled by the square root of ``importance`` (1 by default). ``donors``
+    restricts the donor pool. Columns with missing values are dropped.
+    """
+
+    def __init__(self, outcomes, treated, start, predictors=None,
+                 importance=None, donors=None, tol=1e-10):
+        outcomes = outcomes.sort_index().dropna(axis=1)
+        if treated not in outcomes.columns:
+            raise ValueError("treated unit %r has missing or no outcomes"
+                             % (treated,))
+        if donors is None:
+            donors = outcomes.columns
+        outcomes = outcomes[[treated] + [d for d in donors if d != treated
+                                         and d in outcomes.columns]]
+        pre = outcomes.index < start
+        if not pre.any() or pre.all():
+            raise ValueError("start must leave periods before and after "
+                             "the treatment")
+        self.outcomes = outcomes
+        self.treated = treated
+        self.start = start
+        self.pre = pre
+        X = outcomes[pre].to_numpy(float)
+        if predictors is not None:
+            extra = predictors[outcomes.columns].to_numpy(float)
+            scale = extra.std(axis=1, keepdims=True)
+            scale[scale == 0] = 1
+            extra = (extra - extra.mean(axis=1, keepdims=True)) / scale
+            if importance is not None:
+                extra *= np.sqrt(np.asarray(importance, dtype=float))[:, None]
+            X = np.vstack([X, extra])
+        self.X = X
+        self.tol = tol
+        mask = np.ones((1, X.shape[1]), dtype=bool)
+        mask[0, 0] = False
+        weights = _fit(X, [0], mask, tol)[0]
+        self.weights = pd.Series(weights[1:], outcomes.columns[1:])
+        self.synthetic = outcomes.iloc[:, 1:] @ self.weights
+        self.gap = outcomes[treated] - self.synthetic
+
+    @staticmethod
+    def rmspe(gap, pre):
+        """Pre- and post-treatment root mean squared prediction errors and
+        their ratio, for each column of ``gap``."""
+        gap = pd.DataFrame(gap)
+        before = np.sqrt((gap[pre]**2).mean())
+        after = np.sqrt((gap[~pre]**2).mean())
+        return pd.DataFrame({"pre rmspe": before, "post rmspe": after,
+                             "ratio": after / before})
+
+    def placebos(self, workers=None):
+        """Placebo-in-space runs: every donor treated in turn, fitted on
+        the other donors (never on the treated unit).
+
+        Returns ``(gaps, table)``: the gaps of the treated unit and of every
+        placebo (time x unit), and their RMSPEs with the rank-based p-value
+        of the treated unit's post/pre ratio in ``table.attrs['p-value']``.
+        """
+        n = self.X.shape[1]
+        targets = np.arange(1, n)
+        masks = np.ones((n - 1, n), dtype=bool)
+        masks[:, 0] = False
+        masks[np.arange(n - 1), targets] = False
+        if workers is None or workers <= 1:
+            weights = _fit(self.X, targets, masks, self.tol)
+        else:
+            shards = np.array_split(np.arange(n - 1), workers)
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                weights = np.vstack(list(pool.map(
+                    _fit, [self.X] * workers,
+                    [targets[s] for s in shards],
+                    [masks[s] for s in shards],
+                    [self.tol] * workers)))
+        Y = self.outcomes.to_numpy(float)
+        gaps = Y[:, targets] - Y @ weights.T
+        gaps = pd.DataFrame(np.column_stack([self.gap, gaps]),
+                            self.outcomes.index, self.outcomes.columns)
+        table = self.rmspe(gaps, self.pre)
+        ratio = table["ratio"]
+        table.attrs["p-value"] = (ratio >= ratio[self.treated]).mean()
+        return gaps, table
+
+
+def synthetic_control(outcomes, treated, start, predictors=None,
+                      importance=None, donors=None, placebos=False,
+                      workers=None):
+    """Fit a ``SyntheticControl``; with ``placebos=True`` also return its
+    placebo gaps and RMSPE table."""
+    sc = SyntheticControl(outcomes, treated, start, predictors, importance,
+                          donors)
+    if placebos:
+        return (sc,) + sc.placebos(workers)
+    return sc
@@ -0,0 +1,26 @@
+import numpy as np
+import pandas as pd
+
+from causal_methods.fuzzy_rd import FuzzyRD
+
+
+def _data(n=500, seed=0):
+    rng = np.random.default_rng(seed)
+    x = rng.uniform(-1, 1, n)
+    d = (rng.random(n) < 0.2 + 0.6 * (x >= 0)).astype(float)
+    y = 1 + 2 * d + x + rng.normal(size=n)
+    return y, d, x
+
+
+def test_unnamed_running_variable():
+    y, d, x = _data()
+    named = FuzzyRD(pd.Series(y, name="y"), pd.Series(d, name="d"),
+                    pd.Series(x, name="x"), slopes="separate")
+    assert named.exog_names == ["Intercept", "x", "right:x"]
+    expected = named.sweep([0.5, np.inf])["tau"].to_numpy()
+    for running in (x, pd.Series(x)):
+        rd = FuzzyRD(y, d, running, slopes="separate")
+        assert rd.exog_names == ["Intercept", "running", "right:running"]
+        assert rd.outcomes == ["y0"]
+        np.testing.assert_allclose(
+            rd.sweep([0.5, np.inf])["tau"].to_numpy(), expected)
@@ -0,0 +1,30 @@
+import numpy as np
+import pytest
+
+from causal_methods.rd import RDData
+
+
+def _data(n=400, seed=0):
+    rng = np.random.default_rng(seed)
+    x = np.concatenate([[-0.001, 0.0005, 0.0015], rng.uniform(-1, 1, n)])
+    x[3:] = np.where(np.abs(x[3:]) < 0.01, 0.5, x[3:])
+    y = 1 + 0.5 * (x >= 0) + x + rng.normal(scale=0.1, size=len(x))
+    return y, x
+
+
+@pytest.mark.parametrize("cov_type", ["nonrobust", "HC1"])
+def test_sweep_too_few_observations(cov_type):
+    rd = RDData(*_data())
+    assert sum(rd.count(0.002)) == 3
+    table = rd.sweep([0.002, 0.01, 0.5], cov_type=cov_type)
+    assert table.loc[0.002, ["tau", "se"]].isna().all()
+    assert table.loc[0.002, "n"] == 3
+    assert np.isfinite(table.loc[0.5, ["tau", "se"]]).all()
+    assert table.loc[0.5, "tau"] == rd.fit(0.5, cov_type=cov_type) \
+        .params["treated"]
+
+
+def test_fit_too_few_observations():
+    rd = RDData(*_data())
+    with pytest.raises(ValueError, match="3 observations"):
+        rd.fit(0.002, cov_type="HC1")
@@ -0,0 +1,50 @@
+import numpy as np
+import pandas as pd
+import pytest
+import statsmodels.api as sm
+import statsmodels.formula.api as smf
+
+from causal_methods import formula, regression
+
+
+def _data(n=200, seed=0):
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame({"x1": rng.normal(size=n), "x2": rng.normal(size=n),
+                       "g": rng.integers(0, 4, n),
+                       "w": rng.uniform(0.5, 2, n)})
+    df["y"] = 0.5 + df.x1 - df.x2 + df.g + rng.normal(size=n)
+    return df
+
+
+def _check(result, reference):
+    assert result.k_constant == reference.k_constant
+    assert result.df_model == reference.df_model
+    assert np.isclose(result.rsquared, reference.rsquared)
+    assert np.isclose(result.rsquared_adj, reference.rsquared_adj)
+
+
+@pytest.mark.parametrize("columns", [["x1", "x2"], ["const", "x1", "x2"]])
+@pytest.mark.parametrize("weighted", [False, True])
+def test_ols_constant(columns, weighted):
+    df = sm.add_constant(_data())
+    w = df.w if weighted else None
+    result = regression.ols(df.y, df[columns], weights=w)
+    reference = sm.WLS(df.y, df[columns],
+                       weights=1.0 if w is None else w).fit()
+    _check(result, reference)
+
+
+def test_ols_implicit_constant():
+    df = _data()
+    dummies = pd.get_dummies(df.g, dtype=float)
+    result = regression.ols(df.y, dummies.join(df.x1))
+    _check(result, sm.OLS(df.y, dummies.join(df.x1)).fit())
+
+
+@pytest.mark.parametrize("rhs", ["x1 + x2 - 1", "C(g) + x1 - 1",
+                                 "C(g) + x1"])
+def test_formula_constant(rhs):
+    df = _data()
+    reference = smf.ols("y ~ " + rhs, df).fit()
+    _check(formula.ols("y ~ " + rhs, df), reference)
+    _check(formula.ols("y ~ " + rhs, df, solver="lsqr"), reference)